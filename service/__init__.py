@@ -31,3 +31,8 @@ from service.reconcile.reconcile import reconcile
 
 # Here we register the various blue_prints of our app
 app.register_blueprint(reconcile)
+
+# Warm up the property suggestions of the configured languages
+from service.properties.property_suggest import start_property_suggest_refresher
+
+start_property_suggest_refresher()
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+
+# Interchangeable backends of the upstream response cache.
+# Every backend stores json serializable values with a per-entry ttl, and
+# treats its own failures as cache misses so the upstream request is made.
+
+
+import contextlib
+import itertools
+import json
+import os
+import queue
+import socket
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+from service.cache import cache
+
+
+class ConnectionPool(object):
+    """Connections of a backend shared by the threads of the process
+
+    A connection is used by one thread at a time, and handed back to the pool
+    afterwards for the next caller. The pool is emptied when the process id
+    changes, so workers forked from a parent never use its connections.
+
+    Args:
+        connect (function): Function opening a new connection.
+        close (function): Function closing a connection.
+        maxsize (int): Maximum number of idle connections kept.
+    """
+
+    def __init__(self, connect, close, maxsize=16):
+        self.connect = connect
+        self.close = close
+        self.maxsize = maxsize
+        self._idle = queue.LifoQueue(maxsize)
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def _get_idle(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._idle = queue.LifoQueue(self.maxsize)
+                    self._pid = os.getpid()
+        return self._idle
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Borrow a connection, which is closed instead of handed back when the block raises
+
+        Yields:
+            obj: An idle connection of the pool, or a new one.
+        """
+
+        idle = self._get_idle()
+        try:
+            connection = idle.get_nowait()
+        except queue.Empty:
+            connection = self.connect()
+
+        try:
+            yield connection
+        except BaseException:
+            self.close(connection)
+            raise
+
+        try:
+            idle.put_nowait(connection)
+        except queue.Full:
+            self.close(connection)
+
+
+class MemoryBackend(object):
+    """Response cache kept in the memory of the worker
+
+    Values are returned as stored, callers must not modify them. Responses are
+    measured by the length of their JSON serialization.
+
+    Args:
+        maxsize (int): Maximum number of responses kept.
+        maxbytes (int): Maximum total size of the responses kept, 0 for no limit.
+    """
+
+    def __init__(self, maxsize, maxbytes=0):
+        self._cache = cache.LRUCache(maxsize, 0, maxbytes)
+
+    def get(self, key):
+        value = self._cache.get(key)
+        return None if value is cache.MISSING else value
+
+    def set(self, key, value, ttl):
+        self._cache.set(key, value, ttl, len(json.dumps(value)))
+
+    def clear(self):
+        self._cache.clear()
+
+
+class SQLiteBackend(object):
+    """Response cache stored in a SQLite database in WAL mode
+
+    The database survives restarts and is shared by the workers of a host.
+
+    Args:
+        path (str): Path of the database file.
+    """
+
+    # Expired responses are purged once every this many writes
+    PURGE_INTERVAL = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self._writes = itertools.count(1)
+        self._pool = ConnectionPool(self._connect, self._disconnect)
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE IF NOT EXISTS responses "
+                           "(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+        return connection
+
+    def _disconnect(self, connection):
+        try:
+            connection.close()
+        except sqlite3.Error:
+            pass
+
+    def get(self, key):
+        try:
+            with self._pool.connection() as connection:
+                row = connection.execute("SELECT value FROM responses WHERE key = ? AND expires > ?",
+                                         (key, time.time())).fetchone()
+        except sqlite3.Error:
+            return None
+        return json.loads(row[0]) if row is not None else None
+
+    def set(self, key, value, ttl):
+        try:
+            with self._pool.connection() as connection:
+                connection.execute("INSERT OR REPLACE INTO responses (key, value, expires) VALUES (?, ?, ?)",
+                                   (key, json.dumps(value), time.time() + ttl))
+                if next(self._writes) % self.PURGE_INTERVAL == 0:
+                    connection.execute("DELETE FROM responses WHERE expires <= ?", (time.time(),))
+        except sqlite3.Error:
+            pass
+
+    def clear(self):
+        with self._pool.connection() as connection:
+            connection.execute("DELETE FROM responses")
+
+
+class RedisError(Exception):
+    """Exception raised when a Redis server replies with an error"""
+    pass
+
+
+class RedisBackend(object):
+    """Response cache stored in a server speaking the Redis protocol
+
+    Args:
+        url (str): Server url, as redis://[:password@]host[:port][/db]
+        timeout (float): Socket timeout in seconds.
+    """
+
+    def __init__(self, url, timeout=1.0):
+        parsed_url = urlparse(url)
+        self.host = parsed_url.hostname or "localhost"
+        self.port = parsed_url.port or 6379
+        self.password = parsed_url.password
+        self.db = int(parsed_url.path.strip("/") or 0)
+        self.timeout = timeout
+        self._pool = ConnectionPool(self._connect, self._disconnect)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        connection = (sock, sock.makefile("rb"))
+        try:
+            if self.password:
+                self._command(connection, "AUTH", self.password)
+            if self.db:
+                self._command(connection, "SELECT", str(self.db))
+        except BaseException:
+            self._disconnect(connection)
+            raise
+        return connection
+
+    def _disconnect(self, connection):
+        for stream in reversed(connection):
+            try:
+                stream.close()
+            except OSError:
+                pass
+
+    def _command(self, connection, *args):
+        sock, reader = connection
+        request = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            arg = arg.encode("utf-8") if isinstance(arg, str) else arg
+            request.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        sock.sendall(b"".join(request))
+        return self._read_reply(reader)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Connection closed by the Redis server")
+        reply_type, reply = line[:1], line[1:-2]
+        if reply_type == b"+":
+            return reply.decode("utf-8")
+        if reply_type == b"-":
+            raise RedisError(reply.decode("utf-8"))
+        if reply_type == b":":
+            return int(reply)
+        if reply_type == b"$":
+            length = int(reply)
+            if length < 0:
+                return None
+            return reader.read(length + 2)[:-2]
+        if reply_type == b"*":
+            return [self._read_reply(reader) for i in range(int(reply))]
+        raise RedisError("Unknown reply type " + repr(reply_type))
+
+    def execute(self, *args):
+        """Send a command on a pooled connection, which is closed if the command fails
+
+        Returns:
+            obj: Reply of the server.
+        """
+        with self._pool.connection() as connection:
+            return self._command(connection, *args)
+
+    def get(self, key):
+        try:
+            value = self.execute("GET", key)
+        except (OSError, RedisError, ValueError):
+            return None
+        return json.loads(value.decode("utf-8")) if value is not None else None
+
+    def set(self, key, value, ttl):
+        try:
+            self.execute("SET", key, json.dumps(value), "EX", str(int(ttl)))
+        except (OSError, RedisError, ValueError):
+            pass
+
+    def clear(self):
+        self.execute("FLUSHDB")
+
+
+def build_backend(config):
+    """Build the response cache backend selected in the configuration
+
+    Args:
+        config (dict): Configuration of the application.
+
+    Returns:
+        obj: The cache backend, None when caching is disabled.
+    """
+    backend = config.get("UPSTREAM_CACHE_BACKEND", "none")
+
+    if backend == "memory":
+        return MemoryBackend(config.get("UPSTREAM_CACHE_SIZE", 10000), config.get("UPSTREAM_CACHE_MAX_BYTES", 67108864))
+    elif backend == "sqlite":
+        return SQLiteBackend(config.get("UPSTREAM_CACHE_PATH", "upstream_cache.sqlite3"))
+    elif backend == "redis":
+        return RedisBackend(config.get("UPSTREAM_CACHE_REDIS_URL", "redis://localhost:6379/0"))
+    elif backend in (None, "none"):
+        return None
+    else:
+        raise ValueError("Unknown upstream cache backend: " + str(backend))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# In-process caches of the reconciliation service
+
+
+import threading
+import time
+from collections import OrderedDict
+
+
+# Returned by LRUCache.get for keys which are not cached
+MISSING = object()
+
+
+class LRUCache(object):
+    """Thread safe cache evicting the least recently used entries and the expired ones
+
+    Args:
+        maxsize (int): Maximum number of entries kept in the cache.
+        ttl (int): Number of seconds an entry stays valid.
+        maxbytes (int): Maximum total size of the entries, as given to set, 0 for no limit.
+    """
+
+    def __init__(self, maxsize, ttl, maxbytes=0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, default=MISSING):
+        """Get the value cached for key
+
+        Args:
+            key (obj): Hashable key of the entry.
+            default (obj): Value returned when key is not cached or has expired.
+
+        Returns:
+            obj: The cached value or default.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None, size=0):
+        """Cache value for key, evicting the least recently used entries when full
+
+        Args:
+            key (obj): Hashable key of the entry.
+            value (obj): Value to cache.
+            ttl (int): Number of seconds the entry stays valid, defaults to the cache ttl.
+            size (int): Size of the value in bytes, counted towards maxbytes.
+        """
+        if self.maxsize <= 0 or (self.maxbytes and size > self.maxbytes):
+            return
+
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (expires, value, size)
+            self._bytes += size
+            while len(self._entries) > self.maxsize or (self.maxbytes and self._bytes > self.maxbytes):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[2]
+
+    def delete(self, key):
+        """Remove the entry of key from the cache"""
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        """Remove every entry and reset the counters"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Get the usage counters of the cache
+
+        Returns:
+            dict: Number of entries, hits and misses.
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
@@ -4,25 +4,78 @@
 # Functions which interract with Wikimedia Commons
 
 
-import requests
-
 from service import app
+from service.upstream import microbatch, upstream
+
+
+# Maximum number of titles or page ids the API accepts in one request
+TITLES_PER_REQUEST = 50
+
+
+class CommonsApiError(Exception):
+    """Raised when the Commons API answers a request with an error"""
 
+    def __init__(self, error):
+        super().__init__("The Commons API answered with an error: {} ({})".format(
+            error.get("info", ""), error.get("code", "unknown")))
+        self.code = error.get("code")
+
+
+def get_query_result(data):
+    """ Get the query object of an API response.
+
+        Parameters:
+            data (obj): Json object of the response.
 
-def make_api_request(url, PARAMS):
+        Returns:
+            query (obj): The query object, empty when the response has none.
+
+        Raises:
+            CommonsApiError: The response is an API error, e.g. maxlag once the throttle retries ran out.
+    """
+
+    if "error" in data:
+        raise CommonsApiError(data["error"])
+    return data.get("query", {})
+
+
+def make_api_request(url, PARAMS, use_cache=True):
     """ Makes request to an end point to get data
 
+        Responses are kept in the upstream response cache for the time
+        set by the UPSTREAM_CACHE_TTL policy of the request, and identical
+        requests made at the same time share one upstream call. The
+        returned data may be shared, callers must not modify it.
+
         Parameters:
             url (str): The Api url end point
             PARAMS (obj): The parameters to be used as arguments
+            use_cache (bool): Whether a cached response may be returned, False
+                to fetch it again and cache the fresh response.
 
         Returns:
             data (obj): Json object of the recieved data.
     """
 
-    S = requests.Session()
-    r = S.get(url=url, params=PARAMS)
-    data = r.json()
+    response_cache = upstream.get_response_cache()
+    cache_ttl = upstream.get_cache_ttl(url, PARAMS) if response_cache is not None else 0
+    if cache_ttl:
+        cache_key = upstream.build_cache_key(url, PARAMS)
+        data = response_cache.get(cache_key) if use_cache else None
+        if data is not None:
+            return data
+
+    def request_data():
+        r = upstream.get(url, PARAMS)
+        data = r.json()
+
+        # Errors are not cached so that the next request tries again
+        if cache_ttl and data is not None and "error" not in data:
+            response_cache.set(cache_key, data, cache_ttl)
+        return data
+
+    # Concurrent identical requests share a single upstream call
+    data = upstream.upstream_flights.do(upstream.canonicalize_request(url, PARAMS), request_data)
 
     if data is None:
         return None
@@ -53,98 +106,292 @@ def get_media_info_from_id(media_id):
         return None
 
 
-def make_commons_search(query_string):
-    """ Makes request to commons API to get images info
+def get_pages_from_ids(page_ids):
+    """ Query a batch of commons pages using their ids
 
         Parameters:
-            query_string (str): The concatenated file names.
+            page_ids (str): At most TITLES_PER_REQUEST concatenated page ids.
 
         Returns:
-            pages (obj): Json object of image inforamtion.
+            pages (obj): Json object of the pages keyed by page id.
+    """
+
+    PARAMS = {
+        "action": "query",
+        "pageids": page_ids,
+        "format": "json"
+    }
+
+    pages_info = make_api_request(app.config["API_URL"], PARAMS)
+    return get_query_result(pages_info).get("pages", {})
+
+
+def get_media_titles_from_ids(media_ids):
+    """ Query commons file names of many ids, TITLES_PER_REQUEST ids per request
+
+        Parameters:
+            media_ids (list): Page ids of the files, without the M prefix.
+
+        Returns:
+            file_names (obj): Commons file name of every id, None for ids without a page.
+    """
+
+    media_ids = list(dict.fromkeys(media_ids))
+    chunks = upstream.chunk(media_ids, TITLES_PER_REQUEST, "|")
+
+    pages = {}
+    for chunk_pages in upstream.fan_out(get_pages_from_ids, chunks):
+        pages.update(chunk_pages)
+
+    return {media_id: pages.get(media_id, {}).get("title") for media_id in media_ids}
+
+
+def search_commons_titles(query_string):
+    """ Makes a single request to commons API to get images info
+
+        Parameters:
+            query_string (str): At most TITLES_PER_REQUEST concatenated file names.
+
+        Returns:
+            query (obj): Json object of image inforamtion, with the pages and
+                the normalized and redirects arrays of the API.
     """
 
     PARAMS = {
         "action": "query",
         "format": "json",
         "prop": "imageinfo",
+        "redirects": 1,
         "titles": query_string
     }
 
     data = make_api_request(app.config["API_URL"], PARAMS)
-    pages = data["query"]["pages"]
 
-    return pages
+    return get_query_result(data)
+
+
+def make_commons_query(query_string):
+    """ Makes requests to commons API to get images info
+
+        The file names are split into chunks the API accepts, which are
+        requested concurrently and merged back together. When
+        QUERY_BATCH_WINDOW_MS is set, the file names are instead merged with
+        those of concurrent requests into full chunks, so the result can
+        also hold pages which were not asked for.
+
+        Parameters:
+            query_string (str): The concatenated file names.
+
+        Returns:
+            query (obj): Merged pages map, normalized and redirects arrays.
+    """
+
+    query = {
+        "pages": {},
+        "normalized": [],
+        "redirects": []
+    }
+    if not query_string:
+        return query
+
+    titles = query_string.split("|")
+    batch_window = app.config.get("QUERY_BATCH_WINDOW_MS", 0)
+    if batch_window:
+        # Share full upstream calls with the requests arriving at the same time
+        chunk_queries = title_batcher.submit(titles, batch_window / 1000.0)
+    else:
+        chunks = upstream.chunk(titles, TITLES_PER_REQUEST, "|")
+        chunk_queries = upstream.fan_out(search_commons_titles, chunks)
+
+    missing_pages = 0
+    for chunk_query in chunk_queries:
+        for page_id, page in chunk_query.get("pages", {}).items():
+            # Missing pages are keyed -1, -2, ... in every response, renumber them
+            if page_id.startswith("-"):
+                missing_pages += 1
+                page_id = str(-missing_pages)
+            query["pages"][page_id] = page
+        query["normalized"].extend(chunk_query.get("normalized", []))
+        query["redirects"].extend(chunk_query.get("redirects", []))
+
+    return query
+
+
+# Merges the titles of concurrent reconciliation requests into full upstream calls
+title_batcher = microbatch.MicroBatcher(search_commons_titles, TITLES_PER_REQUEST)
+
+
+def make_commons_search(query_string):
+    """ Makes request to commons API to get images info
+
+        Parameters:
+            query_string (str): The concatenated file names.
+
+        Returns:
+            pages (obj): Json object of image inforamtion.
+    """
+
+    return make_commons_query(query_string)["pages"]
+
 
+def get_pages_revision_content(page_ids):
+    """ Fetch the latest revision content of a batch of commons pages.
 
-def get_page_wikitext(media_id):
-    """ Fetch wikitext for a commons image.
+        Pages over the result size limit of the API come back without their
+        revisions, the continuation requests are followed until every page
+        has its content.
 
         Parameters:
-            media_id (str): ID of the commons image.
+            page_ids (str): At most TITLES_PER_REQUEST concatenated page ids.
 
         Returns:
-            wikitext (str): Wikitext of the requested page.
+            pages (obj): Json object of the pages keyed by page id.
     """
 
     PARAMS = {
-        "action": "parse",
+        "action": "query",
         "format": "json",
-        "prop": "wikitext",
-        "language": "en",
-        "pageid": media_id[len('M'):]
+        "prop": "revisions",
+        "rvprop": "content",
+        "rvslots": "main",
+        "pageids": page_ids
     }
 
-    page_data = make_api_request(app.config["API_URL"], PARAMS)
-    return page_data["parse"]["wikitext"]["*"]
+    pages = {}
+    while True:
+        pages_data = make_api_request(app.config["API_URL"], PARAMS)
+        for page_id, page in get_query_result(pages_data).get("pages", {}).items():
+            if page_id not in pages or "revisions" in page:
+                pages[page_id] = page
+        if "continue" not in pages_data:
+            return pages
+        PARAMS = dict(PARAMS, **pages_data["continue"])
 
 
-def get_media_preview_data(media_id):
-    """Get the url of a Commons media file
+def get_pages_wikitext(media_ids):
+    """ Fetch wikitext for many commons images, TITLES_PER_REQUEST pages per request.
+
+        Parameters:
+            media_ids (list): IDs of the commons images.
+
+        Returns:
+            wikitexts (obj): Wikitext of every requested page, None for missing pages.
+    """
+
+    page_ids = list(dict.fromkeys(media_id[len('M'):] for media_id in media_ids))
+    chunks = upstream.chunk(page_ids, TITLES_PER_REQUEST, "|")
+
+    pages = {}
+    for chunk_pages in upstream.fan_out(get_pages_revision_content, chunks):
+        pages.update(chunk_pages)
+
+    wikitexts = {}
+    for media_id in media_ids:
+        revisions = pages.get(media_id[len('M'):], {}).get("revisions")
+        wikitexts[media_id] = revisions[0]["slots"]["main"]["*"] if revisions else None
+
+    return wikitexts
+
+
+def build_media_preview_params(page_ids):
+    """Build the parameters of an imageinfo request for previews
+
+    Thumbnails scaled to MEDIA_PREV_W x MEDIA_PREV_H are requested along
+    with the original files.
 
     Args:
-        media_id (str): ID of the media file
+        page_ids (str): Concatenated page ids of the media files
 
     Returns:
-        url, title (str): strings of media file url and the media title
+        obj: Parameters of the request
     """
-    media_id = media_id[len('M'):]
 
-    PARAMS = {
+    return {
         "action": "query",
-        "pageids": media_id,
+        "pageids": page_ids,
         "format": "json",
         "prop": "imageinfo",
-        "iiprop": "url|size"
+        "iiprop": "url|size",
+        "iiurlwidth": app.config["MEDIA_PREV_W"],
+        "iiurlheight": app.config["MEDIA_PREV_H"]
     }
+
+
+def build_media_preview_data(page):
+    """Extract the preview data of a media file from its page
+
+    Args:
+        page (obj): Page object of an imageinfo request
+
+    Returns:
+        obj: Title, url, thumbnail url, width, height and size of the media file, None without imageinfo
+    """
+
+    if "imageinfo" not in page.keys():
+        return None
+
     preview_data = {}
-    media_data = make_api_request(app.config["API_URL"], PARAMS)
+    preview_data["title"] = page["title"]
+    preview_data["url"] = page["imageinfo"][0]["url"]
+    preview_data["thumb_url"] = page["imageinfo"][0].get("thumburl")
+    preview_data["width"] = str(page["imageinfo"][0]["width"])
+    preview_data["height"] = str(page["imageinfo"][0]["height"])
+    preview_data["size"] = page["imageinfo"][0]["size"]
+    return preview_data
+
+
+def get_media_preview_data(media_id):
+    """Get the url of a Commons media file
+
+    Args:
+        media_id (str): ID of the media file
+
+    Returns:
+        url, title (str): strings of media file url and the media title
+    """
+    media_id = media_id[len('M'):]
+
+    media_data = make_api_request(app.config["API_URL"], build_media_preview_params(media_id))
 
     if "query" in media_data.keys() and media_id in media_data["query"]["pages"].keys():
-        preview_data["title"] = media_data["query"]["pages"][media_id]["title"]
-        preview_data["url"] = media_data["query"]["pages"][media_id]["imageinfo"][0]["url"]
-        preview_data["width"] = str(media_data["query"]["pages"][media_id]["imageinfo"][0]["width"])
-        preview_data["height"] = str(media_data["query"]["pages"][media_id]["imageinfo"][0]["height"])
-        preview_data["size"] = media_data["query"]["pages"][media_id]["imageinfo"][0]["size"]
-        return preview_data
+        return build_media_preview_data(media_data["query"]["pages"][media_id])
     else:
         return "", "File not Found"
 
 
-def get_commons_file_captions(image_id):
-    """Get file captions for a commons file with id:imageid
+def get_preview_pages_from_ids(page_ids):
+    """Query the preview information of a batch of Commons media files
 
     Args:
-        image_id (str): Image id of the file
+        page_ids (str): At most TITLES_PER_REQUEST concatenated page ids
 
     Returns:
-        Obj: A dictionary of Captions(labels) in different languages
+        obj: Pages with their imageinfo, keyed by page id
     """
 
-    PARAMS = {
-        "action": "wbgetentities",
-        "format": "json",
-        "sites": "commonswiki",
-        "ids": image_id
-    }
-    page_data = make_api_request(app.config["API_URL"], PARAMS)
-    return page_data["entities"][str(image_id)]["labels"]
+    media_data = make_api_request(app.config["API_URL"], build_media_preview_params(page_ids))
+    return get_query_result(media_data).get("pages", {})
+
+
+def get_media_previews_data(media_ids):
+    """Get the preview data of many Commons media files, TITLES_PER_REQUEST files per request
+
+    Args:
+        media_ids (list): IDs of the media files
+
+    Returns:
+        obj: Preview data of every media id, None for files without a preview
+    """
+
+    page_ids = list(dict.fromkeys(media_id[len('M'):] for media_id in media_ids))
+    chunks = upstream.chunk(page_ids, TITLES_PER_REQUEST, "|")
+
+    pages = {}
+    for chunk_pages in upstream.fan_out(get_preview_pages_from_ids, chunks):
+        pages.update(chunk_pages)
+
+    previews_data = {}
+    for media_id in media_ids:
+        page = pages.get(media_id[len('M'):])
+        previews_data[media_id] = build_media_preview_data(page) if page is not None else None
+    return previews_data
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+# Local catalog of the Wikidata properties, searched by prefix for the
+# property suggest typeahead of the reconciliation service
+
+
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+
+from service import app
+from service.commons import commons
+from service.upstream import upstream
+from service.wikidata import wikidata
+
+
+# Number of suggestions returned for a prefix, as for wbsearchentities
+SUGGEST_LIMIT = 7
+
+# Wikidata namespace of the property pages
+PROPERTY_NAMESPACE = 120
+
+_catalog = {
+    "path": None,
+    "mtime": None,
+    "checked": 0,
+    "properties": None,
+    "indexes": {}
+}
+_catalog_lock = threading.Lock()
+
+
+def normalize_term(term):
+    """Normalize a label, alias or prefix for prefix comparison
+
+    Args:
+        term (str): Term to normalize.
+
+    Returns:
+        str: Case folded term without surrounding whitespace.
+    """
+
+    return term.strip().casefold()
+
+
+def build_pseudo_properties(lang):
+    """Build the catalog entries of the properties which are not Wikidata properties
+
+    Args:
+        lang (str): Language of the caption pseudo-property.
+
+    Returns:
+        list: Catalog entries of the wikitext and caption pseudo-properties.
+    """
+
+    return [
+        {
+            "id": "wikitext",
+            "labels": {lang: "Wikitext"},
+            "descriptions": {lang: "Text associated with the file, in wiki markup"},
+            "aliases": {lang: ["wikitext"]}
+        },
+        {
+            "id": "C" + lang,
+            "labels": {lang: "Caption [" + lang + "]"},
+            "descriptions": {lang: "file caption"},
+            "aliases": {lang: ["caption", "C" + lang]}
+        }
+    ]
+
+
+class PropertyIndex(object):
+    """Prefix index of the properties of one language, as sorted arrays searched with bisect
+
+    Args:
+        properties (list): Catalog entries with ids, labels, descriptions and aliases by language.
+        lang (str): Language of the index, English is used for missing terms.
+    """
+
+    def __init__(self, properties, lang):
+        languages = list(dict.fromkeys([lang, "en"]))
+        self.results = []
+        terms = []
+
+        for prop in properties:
+            label = next((prop["labels"][code] for code in languages if code in prop.get("labels", {})), prop["id"])
+            description = next((prop["descriptions"][code] for code in languages
+                                if code in prop.get("descriptions", {})), "")
+            result_index = len(self.results)
+            self.results.append({"id": prop["id"], "name": label, "description": description})
+
+            # Rank 0 for the id and labels, 1 for the aliases
+            terms.append((normalize_term(prop["id"]), 0, result_index))
+            for code in languages:
+                if code in prop.get("labels", {}):
+                    terms.append((normalize_term(prop["labels"][code]), 0, result_index))
+                for alias in prop.get("aliases", {}).get(code, []):
+                    terms.append((normalize_term(alias), 1, result_index))
+
+        terms.sort()
+        self.terms = [term for term, rank, result_index in terms]
+        self.entries = [(rank, result_index) for term, rank, result_index in terms]
+
+    def search(self, prefix, limit=SUGGEST_LIMIT):
+        """Find the properties with a label, alias or id starting with prefix
+
+        Args:
+            prefix (str): Prefix typed by the user.
+            limit (int): Maximum number of results.
+
+        Returns:
+            list: Suggest result items, exact matches first, then labels before aliases.
+        """
+
+        prefix = normalize_term(prefix)
+        if not prefix:
+            return []
+
+        best_ranks = {}
+        position = bisect.bisect_left(self.terms, prefix)
+        while position < len(self.terms) and self.terms[position].startswith(prefix):
+            rank, result_index = self.entries[position]
+            term_rank = (self.terms[position] != prefix, rank, len(self.terms[position]), result_index)
+            if result_index not in best_ranks or term_rank < best_ranks[result_index]:
+                best_ranks[result_index] = term_rank
+            position += 1
+
+        ranked = sorted(best_ranks, key=best_ranks.get)[:limit]
+        return [self.results[result_index] for result_index in ranked]
+
+
+def load_property_catalog(path):
+    """Load the properties of a catalog snapshot file
+
+    Args:
+        path (str): Path of the snapshot file.
+
+    Returns:
+        list: Catalog entries of the properties.
+    """
+
+    with open(path, encoding="utf-8") as snapshot:
+        return json.load(snapshot)["properties"]
+
+
+def refresh_property_catalog():
+    """Reload the catalog snapshot when it changed, at most every PROPERTY_CATALOG_REFRESH_INTERVAL seconds
+
+    Returns:
+        list: Catalog entries of the properties, None if there is no snapshot.
+    """
+
+    path = app.config.get("PROPERTY_CATALOG_PATH")
+    if not path:
+        return None
+
+    now = time.monotonic()
+    if _catalog["path"] == path and now - _catalog["checked"] < app.config.get("PROPERTY_CATALOG_REFRESH_INTERVAL", 3600):
+        return _catalog["properties"]
+
+    with _catalog_lock:
+        _catalog["checked"] = now
+        try:
+            mtime = os.stat(path).st_mtime
+            if _catalog["path"] != path or _catalog["mtime"] != mtime:
+                _catalog["properties"] = load_property_catalog(path)
+                _catalog["indexes"] = {}
+                _catalog["path"] = path
+                _catalog["mtime"] = mtime
+        except (OSError, ValueError, KeyError) as e:
+            app.logger.warning("Could not load the property catalog %s: %s", path, e)
+            _catalog["path"] = path
+
+    return _catalog["properties"]
+
+
+def get_property_index(lang):
+    """Get the prefix index of the properties in a language, building it on first use
+
+    Indexes are only built for the PROPERTY_CATALOG_LANGUAGES of the
+    snapshot, so that requests in other languages neither grow the memory of
+    the worker nor get the terms of another language.
+
+    Args:
+        lang (str): Language of the index.
+
+    Returns:
+        obj: PropertyIndex of the language, None if there is no catalog snapshot or it lacks the language.
+    """
+
+    if lang not in app.config.get("PROPERTY_CATALOG_LANGUAGES", ["en"]):
+        return None
+
+    properties = refresh_property_catalog()
+    if properties is None:
+        return None
+
+    indexes = _catalog["indexes"]
+    if lang not in indexes:
+        indexes[lang] = PropertyIndex(build_pseudo_properties(lang) + properties, lang)
+    return indexes[lang]
+
+
+def search_properties(prefix, lang, limit=SUGGEST_LIMIT):
+    """Search the local property catalog
+
+    Args:
+        prefix (str): Prefix typed by the user.
+        lang (str): Language of the search.
+        limit (int): Maximum number of results.
+
+    Returns:
+        list: Suggest result items, None if there is no catalog snapshot for the language.
+    """
+
+    property_index = get_property_index(lang)
+    if property_index is None:
+        return None
+    return property_index.search(prefix, limit)
+
+
+def get_property_ids():
+    """List the ids of all Wikidata properties
+
+    Returns:
+        list: Property ids.
+    """
+
+    PARAMS = {
+        "action": "query",
+        "format": "json",
+        "list": "allpages",
+        "apnamespace": PROPERTY_NAMESPACE,
+        "aplimit": "max"
+    }
+
+    property_ids = []
+    while True:
+        data = commons.make_api_request(app.config["WD_API_URL"], PARAMS)
+        property_ids.extend(page["title"].split(":")[-1] for page in data["query"]["allpages"])
+        if "continue" not in data:
+            return property_ids
+        PARAMS = dict(PARAMS, **data["continue"])
+
+
+def get_property_terms(property_ids, languages):
+    """Fetch the labels, descriptions and aliases of a batch of properties
+
+    Args:
+        property_ids (list): At most wikidata.IDS_PER_REQUEST property ids.
+        languages (list): Languages of the terms.
+
+    Returns:
+        list: Catalog entries of the properties.
+    """
+
+    PARAMS = {
+        "action": "wbgetentities",
+        "format": "json",
+        "props": "labels|descriptions|aliases",
+        "languages": "|".join(languages),
+        "ids": "|".join(property_ids)
+    }
+
+    data = commons.make_api_request(app.config["WD_API_URL"], PARAMS)
+    properties = []
+    for prop in data.get("entities", {}).values():
+        properties.append({
+            "id": prop["id"],
+            "labels": {code: label["value"] for code, label in prop.get("labels", {}).items()},
+            "descriptions": {code: description["value"] for code, description in prop.get("descriptions", {}).items()},
+            "aliases": {code: [alias["value"] for alias in aliases] for code, aliases in prop.get("aliases", {}).items()}
+        })
+    return properties
+
+
+def build_property_catalog(path, languages):
+    """Write a catalog snapshot of all Wikidata properties
+
+    Args:
+        path (str): Path of the snapshot file, replaced atomically.
+        languages (list): Languages of the terms to include.
+    """
+
+    property_ids = get_property_ids()
+    batches = upstream.chunk(property_ids, wikidata.IDS_PER_REQUEST)
+
+    properties = []
+    for batch_properties in upstream.fan_out(lambda batch: get_property_terms(batch, languages), batches):
+        properties.extend(batch_properties)
+
+    with open(path + ".tmp", "w", encoding="utf-8") as snapshot:
+        json.dump({"properties": properties}, snapshot, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+# Rebuild the snapshot, e.g. from a daily cron job:
+# python -m service.properties.property_catalog [path]
+if __name__ == "__main__":
+    build_property_catalog(sys.argv[1] if len(sys.argv) > 1 else app.config["PROPERTY_CATALOG_PATH"],
+                           app.config.get("PROPERTY_CATALOG_LANGUAGES", ["en"]))
@@ -1,13 +1,24 @@
+import os
+import threading
+import time
 
 from service import app
-from service.commons import commons
+from service.wikidata import wikidata
 
 
-def get_property_suggest_results(lang):
-    """Get property suggest results
+# Property suggest results of the PROPERTIES_LANGUAGES, keyed by language
+property_suggest_results = {}
+
+_refresher_pid = None
+_refresher_lock = threading.Lock()
+
+
+def build_property_suggest_results(lang, use_cache=True):
+    """Build property suggest results
 
     Args:
         lang (str): Language to return the property labels
+        use_cache (bool): Whether cached labels may be used, False to request them again
 
     Returns:
         obj: Object of suggested properties
@@ -27,19 +38,88 @@ def get_property_suggest_results(lang):
         else:
             valid_wd_prop_ids.append(key)
 
-    PARAMS = {
-        "action": "wbgetentities",
-        "format": "json",
-        "languages": lang,
-        "props": "labels",
-        "ids": "|".join(id for id in valid_wd_prop_ids)
-    }
-
-    data = commons.make_api_request(app.config["WD_API_URL"], PARAMS)
+    data = wikidata.make_wd_properties_request(valid_wd_prop_ids, lang, use_cache)
     if "entities" in data.keys():
         for prop in valid_wd_prop_ids:
             prop_entry = {}
             prop_entry["id"] = prop
-            prop_entry["name"] = data["entities"][prop]["labels"][lang]["value"]
+            # Properties without a label in lang are named by their id
+            prop_entry["name"] = data["entities"].get(prop, {}).get("labels", {}).get(lang, {}).get("value", prop)
             suggest_properties["properties"].append(prop_entry)
     return suggest_properties
+
+
+def refresh_property_suggest_results(languages):
+    """Rebuild the property suggest results of some languages
+
+    The labels are requested again, bypassing the label and response
+    caches. A language whose results can not be built keeps its previous
+    results.
+
+    Args:
+        languages (list): Languages to rebuild the results of
+    """
+
+    for lang in languages:
+        try:
+            property_suggest_results[lang] = build_property_suggest_results(lang, use_cache=False)
+        except Exception as e:
+            app.logger.warning("Could not refresh property suggestions in %s: %s", lang, e)
+
+
+def run_property_suggest_refresher(interval):
+    """Warm the configured languages, then refresh them periodically
+
+    Args:
+        interval (int): Number of seconds between two refreshes
+    """
+
+    refresh_property_suggest_results(app.config.get("PROPERTIES_LANGUAGES", []))
+    while True:
+        time.sleep(interval)
+        refresh_property_suggest_results(app.config.get("PROPERTIES_LANGUAGES", []))
+
+
+def start_property_suggest_refresher():
+    """Start the background refresh of property suggest results in this process
+
+    The refresh is started once per process, as threads do not survive a fork.
+    It is disabled when PROPERTIES_REFRESH_INTERVAL is 0.
+    """
+
+    global _refresher_pid
+
+    interval = app.config.get("PROPERTIES_REFRESH_INTERVAL", 3600)
+    if not interval or _refresher_pid == os.getpid():
+        return
+
+    with _refresher_lock:
+        if _refresher_pid != os.getpid():
+            _refresher_pid = os.getpid()
+            threading.Thread(target=run_property_suggest_refresher, args=(interval,),
+                             name="property-suggest-refresher", daemon=True).start()
+
+
+def get_property_suggest_results(lang):
+    """Get property suggest results
+
+    Results of the PROPERTIES_LANGUAGES are served from memory, they are
+    only built on the request path if they could not be warmed up. Results
+    of other languages are built for each request, from the label cache, so
+    that arbitrary language codes do not grow the memory or the refresh work.
+
+    Args:
+        lang (str): Language to return the property labels
+
+    Returns:
+        obj: Object of suggested properties
+    """
+
+    start_property_suggest_refresher()
+
+    suggest_properties = property_suggest_results.get(lang)
+    if suggest_properties is None:
+        suggest_properties = build_property_suggest_results(lang)
+        if lang in app.config.get("PROPERTIES_LANGUAGES", []):
+            property_suggest_results[lang] = suggest_properties
+    return suggest_properties
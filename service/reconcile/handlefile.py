@@ -6,11 +6,27 @@
 from service.commons import commons
 from service import app
 
-def check_query_file_type(file_name):
+def get_entity_media_id(file_name):
+    """ Get the media id of an entity link from query data
+
+        Parameters:
+            file_name (str): File name in query data
+
+        Returns:
+            media_id (str): Page id of the entity, None if file_name is not an entity link
+    """
+
+    if 'http' in file_name and 'entity/' in file_name:
+        return file_name.split('entity/M')[1]
+    return None
+
+
+def check_query_file_type(file_name, media_titles=None):
     """ Check file type from query data
 
         Parameters:
             file_name (str): File name in query data
+            media_titles (obj): File names of already resolved media ids
 
         Returns:
             file_name (str): Processed file name ready for query
@@ -21,7 +37,9 @@ def check_query_file_type(file_name):
         # case of just file ids given
         if 'entity/' in file_name:
 
-            media_id = file_name.split('entity/M')[1]
+            media_id = get_entity_media_id(file_name)
+            if media_titles is not None and media_id in media_titles:
+                return media_titles[media_id]
             file_name = commons.get_media_info_from_id(media_id)
             return file_name
 
@@ -43,31 +61,36 @@ def check_query_file_type(file_name):
     return file_name.replace("_", " ")
 
 
-def find_best_match_file(query_values, file_name):
-    """ Find match in list of files which was provided as queries
+def build_query_index(query_data):
+    """ Index the keys of the queries data by file name.
 
         Parameters:
-            query_values (lst): Fueries file names
-            file_name (str): File returned from commons search
+            query_data (obj): The queries data object.
 
         Returns:
-            match (obj): Matched file or original file if not matched
+            query_index (obj): Processed file names mapped to the list of query
+                keys asking for them, in the order of the queries.
     """
-    for value in query_values:
-        if file_name == value:
-            return value
-        else:
-            return file_name
 
+    # Resolve the file names of all entity links in batches first
+    media_ids = [get_entity_media_id(entry["query"]) for entry in query_data.values()]
+    media_titles = commons.get_media_titles_from_ids([media_id for media_id in media_ids if media_id is not None])
 
-def extract_file_names(query_data):
-    """ Extract file name from the queries data.
+    query_index = {}
+    for query_key, entry in query_data.items():
+        query_index.setdefault(check_query_file_type(entry["query"], media_titles), []).append(query_key)
+
+    return query_index
+
+
+def join_file_names(query_index):
+    """ Join the file names of a query index.
 
         Parameters:
-            query_data (obj): The queries data object.
+            query_index (obj): File names mapped to query keys.
 
         Returns:
             query_string (str): A concatenated string of file names.
     """
 
-    return "|".join(check_query_file_type(entry["query"]) for entry in query_data.values())
+    return "|".join(file_name for file_name in query_index if file_name is not None)
@@ -1,9 +1,18 @@
 
 import math
 from service import app
-from service.commons.commons import get_media_preview_data
+from service.cache import cache
+from service.commons.commons import get_media_preview_data, get_media_previews_data
 
 
+# Preview templates, compiled once
+PREVIEW_TEMPLATES = {
+    name: app.jinja_env.get_template("preview/" + name + ".html")
+    for name in ["image", "audio", "video", "unavailable"]
+}
+
+# Rendered previews keyed by (media id, preview width, preview height)
+preview_cache = cache.LRUCache(app.config.get("PREVIEW_CACHE_SIZE", 10000), app.config.get("PREVIEW_CACHE_TTL", 3600))
 
 
 def convert_size(size_bytes):
@@ -22,17 +31,18 @@ def convert_size(size_bytes):
     i = int(math.floor(math.log(size_bytes, 1024)))
     p = math.pow(1024, i)
     s = round(size_bytes / p, 2)
-    size = "%s %s" % (s, size_name[i])
-    print(size)
 
     return "%s %s" % (s, size_name[i])
 
 
 def build_preview_file_from_type(url, title, preview_width,
                                  preview_height, file_width,
-                                 file_height, file_size):
+                                 file_height, file_size, thumb_url=None):
     """Build the actual preview
 
+    Images are shown from their thumbnail, and videos use it as poster
+    frame, so that the original file is not downloaded by the browser.
+
     Args:
         url (str): Media file url
         title (str): Media file title.
@@ -41,6 +51,7 @@ def build_preview_file_from_type(url, title, preview_width,
         file_width (str): Image file width.
         file_height (str): Image file height.
         file_size (str): media file size.
+        thumb_url (str): Url of the scaled thumbnail of the media file, if any.
     Returns:
         HTML: HTML DOM preview object
     """
@@ -49,54 +60,29 @@ def build_preview_file_from_type(url, title, preview_width,
 
     # image options
     if file_extension in ["svg", "png", "jpg", "gif", "tiff", "webp", "xcf"]:
-        return "<div width='1024' height='100px' style='position: fixed; overflow:hidden; width:400px'> " \
-            "<span style='float: left'>" \
-            "<img style='padding-right: 5px' src=" + url + " width=" + preview_width + " \
-                height=" + preview_height + " style='float: left'>"\
-            "</span>" \
-            "<span style='float: left; margin-top: -10px'>" \
-            "<p style='color: #11c; font-weight: bold; position: fixed; font-size: 10px; font-family: Arial, sans-serif'>" + title + " </p>"\
-            "</span>" \
-            "<span style='float: left; margin-top:20px'>" \
-            "<p style='font-size: 10px;'>" + file_width + " x " + file_height + "; " + convert_size(file_size) + "</p>"\
-            "</span></div>"
+        template = PREVIEW_TEMPLATES["image"]
+        url = thumb_url or url
 
     # Audio options
-
     elif file_extension in ["mp3", "midi", "ogg", "webm", "flac", "wav"]:
-        
-        return "<div width='1024' height='100px' style='position: fixed; overflow:hidden; width:400px'> " \
-            "<span style='float: left'>" \
-            "<audio style='width: 175px; height:30px' controls><source src=" + url + " type='audio/" + file_extension + "'>"\
-            "</span>" \
-            "<span style='float: left; margin-top: -5px; margin-left: 5px'>" \
-            "<p style=' color: #11c; font-weight: bold; position: fixed; font-size: 10px; font-family: Arial, sans-serif'>" + title + " </p>"\
-            "</span>" \
-            "<span style='float: left; margin-top:10px; margin-left: 5px'>" \
-            "<p style='font-size: 10px;'>" + convert_size(file_size) + "</p>"\
-            "</span>" \
-            "</div>"
+        template = PREVIEW_TEMPLATES["audio"]
 
     # Video formats
-    elif file_extension in ["webm", "webm", "mpeg", "ogv"]:
-        return "<div width='1024' height='100px' style='position: fixed; overflow:hidden; width:400px'> " \
-            "<span style='float: left'>" \
-            "<video style='width: 200px; height:60px' controls><source src=" + url + " type='video/" + file_extension + "'>" \
-            "</span>" \
-            "<span style='float: left; margin-top: -5px; margin-left: 10px'>" \
-            "<p style=' color: #11c; font-weight: bold; position: fixed; font-size: 10px; font-family: Arial, sans-serif'>" + title + " </p>" \
-            "</span>" \
-            "<span style='float: left; margin-top:10px; margin-left: 10px'>" \
-            "<p style='font-size: 10px;'>" + convert_size(file_size) + "</p>" \
-            "</span>" \
-            "</div>"
+    elif file_extension in ["webm", "mpeg", "ogv"]:
+        template = PREVIEW_TEMPLATES["video"]
     else:
-        return "<strong> <h4>Preview not available</h4>"
+        return PREVIEW_TEMPLATES["unavailable"].render()
+
+    return template.render(url=url, title=title, preview_width=preview_width, preview_height=preview_height,
+                           file_width=file_width, file_height=file_height, file_size=convert_size(file_size),
+                           file_extension=file_extension, poster_url=thumb_url)
 
 
 def build_preview_content(media_id):
     """Builds HTMl preview for a media given the id
 
+    Previews are cached by media id and preview size.
+
     Args:
         media_id (str): ID of media file
 
@@ -104,12 +90,59 @@ def build_preview_content(media_id):
         html_preview (str): HTML preview string for image preview
     """
 
-    preview_info = get_media_preview_data(media_id)
     preview_width = str(app.config["MEDIA_PREV_W"])
     preview_height = str(app.config["MEDIA_PREV_H"])
+    cache_key = (media_id, preview_width, preview_height)
+
+    html_preview = preview_cache.get(cache_key)
+    if html_preview is not cache.MISSING:
+        return html_preview
+
+    preview_info = get_media_preview_data(media_id)
 
     if preview_info["url"] is not None and preview_info["title"] is not None:
-        return build_preview_file_from_type(preview_info["url"], preview_info["title"], preview_width, preview_height,
-                                            preview_info["width"], preview_info["height"], preview_info["size"])
+        html_preview = build_preview_file_from_type(preview_info["url"], preview_info["title"], preview_width, preview_height,
+                                                    preview_info["width"], preview_info["height"], preview_info["size"],
+                                                    preview_info["thumb_url"])
+        preview_cache.set(cache_key, html_preview)
+        return html_preview
     else:
         return None
+
+
+def prefetch_previews(media_ids):
+    """Builds the HTML previews of many media files and primes the preview cache
+
+    The imageinfo of the media files missing from the cache is fetched in
+    multi-pageid requests.
+
+    Args:
+        media_ids (list): IDs of the media files
+
+    Returns:
+        obj: HTML preview of every media id, None for files without a preview
+    """
+
+    preview_width = str(app.config["MEDIA_PREV_W"])
+    preview_height = str(app.config["MEDIA_PREV_H"])
+
+    html_previews = {}
+    for media_id in media_ids:
+        html_previews[media_id] = preview_cache.get((media_id, preview_width, preview_height))
+
+    missing_ids = [media_id for media_id, html_preview in html_previews.items() if html_preview is cache.MISSING]
+    previews_data = get_media_previews_data(missing_ids) if missing_ids else {}
+
+    for media_id in missing_ids:
+        preview_info = previews_data[media_id]
+        if preview_info is None:
+            html_previews[media_id] = None
+            continue
+
+        html_preview = build_preview_file_from_type(preview_info["url"], preview_info["title"], preview_width, preview_height,
+                                                    preview_info["width"], preview_info["height"], preview_info["size"],
+                                                    preview_info["thumb_url"])
+        preview_cache.set((media_id, preview_width, preview_height), html_preview)
+        html_previews[media_id] = html_preview
+
+    return html_previews
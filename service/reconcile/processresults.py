@@ -3,16 +3,28 @@
 # Process reconciliation query results
 
 
+import itertools
+import json
 import re
 from unittest import result
+from requests.exceptions import RequestException
 from service import app
 from service.commons import commons
 from service.wikidata import wikidata
+from service.properties import property_catalog
 from service.reconcile import handlefile
+from service.upstream import upstream
 from service.utils.utils import InvalidInputDataException
 from service.utils import utils
 
 
+# Errors of a wbgetentities batch which are caused by some of its ids, other errors fail the whole batch
+ID_ERRORS = ("no-such-entity", "invalid-entity-id")
+
+# Number of failed ids named in the warning of a failed extension
+LOGGED_FAILED_IDS = 5
+
+
 def build_query_result_object(page):
     """ Builds result object for an image info.
 
@@ -48,33 +60,40 @@ def build_query_result_object(page):
 
 
 
-def build_query_results(query_data, results):
+def build_query_results(query_data, results, normalized=None, redirects=None, query_index=None):
     """ Builds result using image search results.
 
         Parameters:
             query_data (obj): Query data from api request.
             results (obj): Results from image search from wmc api.
+            normalized (list): "normalized" array of the search response.
+            redirects (list): "redirects" array of the search response.
+            query_index (obj): File names mapped to query keys, built from query_data if not given.
 
         Returns:
             overall_query_object (obj): Reconciliation api result for queries.
     """
 
+    if query_index is None:
+        query_index = handlefile.build_query_index(query_data)
+
+    normalized_titles = {entry["from"]: entry["to"] for entry in normalized or []}
+    redirected_titles = {entry["from"]: entry["to"] for entry in redirects or []}
+    result_pages = {page["title"]: page for page in results.values()}
+
     overall_query_object = {}
-    query_labels = list(query_data.keys())
-    query_values = [handlefile.check_query_file_type(value["query"]) for value in query_data.values()]
-    result_values = list(results.values())
-
-    for i in range(len(result_values)):
-        best_match_file = handlefile.find_best_match_file(query_values, result_values[i]["title"])
-        element_index_in_results = query_values.index(best_match_file)
-        if "pageid" in result_values[i]:
-            # Files are sorted by commons api so we find the results index in query data
-            # we look for index of best_match string
-            # In case where no file in our queries matches the result we return an empty set
+    for file_name, query_keys in query_index.items():
+        # Follow the title the API normalized, then the redirect, to the returned page
+        title = normalized_titles.get(file_name, file_name)
+        title = redirected_titles.get(title, title)
+        page = result_pages.get(title)
 
-            overall_query_object[query_labels[element_index_in_results]] = build_query_result_object(result_values[i])
-        else:
-            overall_query_object[query_labels[element_index_in_results]] = {"result": []}
+        for query_key in query_keys:
+            # In case where no file in our queries matches the result we return an empty set
+            if page is not None and "pageid" in page:
+                overall_query_object[query_key] = build_query_result_object(page)
+            else:
+                overall_query_object[query_key] = {"result": []}
 
     return overall_query_object
 
@@ -175,29 +194,107 @@ def build_dataset_values(claim_object, data_value):
     return claim_object
 
 
+def get_property_batch(batch, lang):
+    """Fetch the entities of one batch of media ids
+
+    Args:
+        batch (list): Up to 50 media ids
+        lang (str): Languages of the labels, separated by "|"
+
+    Returns:
+        dict: wbgetentities response, or an object with an "error" key on failure
+    """
+    PARAMS = {
+        "action": "wbgetentities",
+        "format": "json",
+        "languages": lang,
+        "ids": "|".join(id for id in batch)
+    }
+    try:
+        return commons.make_api_request(app.config["API_URL"], PARAMS)
+    except (RequestException, ValueError) as e:
+        return {"error": {"code": "upstream-error", "info": str(e)}}
+
+
+def find_batch_id(batch, entity_id):
+    """Find an id of a batch, as written in the request
+
+    Args:
+        batch (list): Media ids
+        entity_id (str): Id returned by the API
+
+    Returns:
+        str: The id of the batch, None if it is not in the batch
+    """
+    for id in batch:
+        if id.upper() == str(entity_id).upper():
+            return id
+    return None
+
+
+def get_property_batch_bisected(batch, lang):
+    """Fetch the entities of one batch of media ids, isolating the ids which make it fail
+
+    A batch failing because of some of its ids is fetched again without the
+    id named by the error, or else in two halves, until every failing id is
+    found on its own. Only errors naming an id or with an ID_ERRORS code are
+    bisected, any other error, such as a database error or throttling of the
+    API, is an error of every id of the batch.
+
+    Args:
+        batch (list): Up to 50 media ids
+        lang (str): Languages of the labels, separated by "|"
+
+    Returns:
+        dict: Entities of the batch under "entities", and the error of every failed id under "errors"
+    """
+    batch_properties = get_property_batch(batch, lang)
+    if "error" not in batch_properties.keys():
+        return {"entities": batch_properties.get("entities", {}), "errors": {}}
+
+    error = batch_properties["error"]
+    failed_id = find_batch_id(batch, error.get("id"))
+    if len(batch) == 1 or (failed_id is None and error.get("code") not in ID_ERRORS):
+        return {"entities": {}, "errors": {id: error for id in batch}}
+
+    if failed_id is not None:
+        batch_results = get_property_batch_bisected([id for id in batch if id != failed_id], lang)
+        batch_results["errors"][failed_id] = error
+        return batch_results
+
+    halves = [batch[: len(batch) // 2], batch[len(batch) // 2 :]]
+    halves_results = upstream.fan_out(lambda half: get_property_batch_bisected(half, lang), halves)
+    return {
+        "entities": utils.merge_two_batch_dicts(halves_results[0]["entities"], halves_results[1]["entities"]),
+        "errors": utils.merge_two_batch_dicts(halves_results[0]["errors"], halves_results[1]["errors"])
+    }
+
+
 def get_property_batches(extend_ids, lang):
     """Hit commons api with batch queries
 
+    Batches are fetched concurrently, the results are merged in the order of extend_ids.
+    The ids making a batch fail are isolated by get_property_batch_bisected.
+
     Args:
         extend_ids list: List of media ids for extension
 
     Returns:
-        properties dict: Dictionary of combined batch results
+        properties dict: Dictionary of combined batch results, with the error
+            of every failed id listed under "errors"
     """
     overall_batch_results = {}
     overall_batch_results["entities"] = {}
-    batches = [extend_ids[i : i + 50] for i in range(0, len(extend_ids), 50)]
-    for batch in batches:
-        batch_properties = {}
-        PARAMS = {
-            "action": "wbgetentities",
-            "format": "json",
-            "languages": lang,
-            "ids": "|".join(id for id in batch)
-        }
-        batch_properties = commons.make_api_request(app.config["API_URL"], PARAMS)
-        if "error" not in batch_properties.keys():
-            overall_batch_results["entities"] = utils.merge_two_batch_dicts(overall_batch_results["entities"], batch_properties["entities"])
+    overall_batch_results["errors"] = {}
+    batches = upstream.chunk(extend_ids, 50)
+    batch_results = upstream.fan_out(lambda batch: get_property_batch_bisected(batch, lang), batches)
+    for batch_properties in batch_results:
+        overall_batch_results["entities"] = utils.merge_two_batch_dicts(overall_batch_results["entities"], batch_properties["entities"])
+        overall_batch_results["errors"] = utils.merge_two_batch_dicts(overall_batch_results["errors"], batch_properties["errors"])
+    if overall_batch_results["errors"]:
+        failed_ids = list(overall_batch_results["errors"].items())
+        app.logger.warning("wbgetentities failed for %s ids, e.g. %s", len(failed_ids), ", ".join(
+            id + " (" + str(error.get("code")) + ")" for id, error in failed_ids[:LOGGED_FAILED_IDS]))
     return overall_batch_results
 
 
@@ -216,10 +313,19 @@ def build_extend_rows_info(extend_ids, extend_properties, lang):
 
     rows_data = {}
     rows_data["rows"] = {}
-    captions_langs = []
+
+    # Captions are requested with the entities, in a single languages parameter
+    captions_langs = [prop["id"][len("C"):] for prop in extend_properties if prop["id"].startswith("C")]
+    entity_langs = "|".join(dict.fromkeys([lang] + captions_langs))
 
     # We want to perform batch queries in groups of 50:limit for Commons API
-    properties = get_property_batches(extend_ids, lang)
+    # The wikitext of the files is fetched alongside the entities when requested
+    upstream_requests = [lambda: get_property_batches(extend_ids, entity_langs)]
+    if any(prop["id"] == "wikitext" for prop in extend_properties):
+        upstream_requests.append(lambda: commons.get_pages_wikitext(extend_ids))
+    upstream_results = upstream.fan_out(lambda upstream_request: upstream_request(), upstream_requests)
+    properties = upstream_results[0]
+    wikitexts = upstream_results[1] if len(upstream_results) > 1 else {}
 
     # check if the input is valid - Mids
     if "entities" in properties.keys():
@@ -234,26 +340,36 @@ def build_extend_rows_info(extend_ids, extend_properties, lang):
     # Adjust rows object by already adding
     build_row_data(rows_data["rows"], extend_ids)
 
+    # Item valued cells of the rows, as (row id, property id, item ids)
+    wd_item_cells = []
+
     # For each of the rows in the above data frame build the content
     for row_data in rows_data["rows"]:
+        entity = extend_entities.get(row_data, {})
+        statements = entity.get("statements") or {}
+
+        # Ids which could not be fetched get empty cells, and the reason in their row
+        if row_data in properties["errors"]:
+            rows_data["rows"][row_data]["error"] = properties["errors"][row_data]
+        elif "missing" in entity:
+            rows_data["rows"][row_data]["error"] = {"code": "no-such-entity", "info": "Could not find an entity with the ID " + row_data}
+
         for prop in extend_properties:
 
             if prop["id"] == "wikitext":
                 rows_data["rows"][row_data]["wikitext"] = []
-                rows_data["rows"][row_data]["wikitext"].append({"str": commons.get_page_wikitext(row_data)})
+                if wikitexts.get(row_data) is not None:
+                    rows_data["rows"][row_data]["wikitext"].append({"str": wikitexts[row_data]})
 
             elif prop["id"].startswith("C"):
-                captions_langs.append(prop["id"].split("C")[1])
-
-                rows_data["rows"][row_data] = {}
-                wmc_caption_data = commons.get_commons_file_captions(extend_ids[0])
-                wmc_caption_data_keys = list(wmc_caption_data.keys())
-                for lang_key in wmc_caption_data_keys:
-                    if lang_key in captions_langs:
-                        rows_data["rows"][row_data]["C" + lang_key] = []
-                        caption_object = {}
-                        caption_object['str'] = wmc_caption_data[lang_key]["value"]
-                        rows_data["rows"][row_data]["C" + lang_key].append(caption_object)
+                # Captions are the labels of the entity, already fetched in the batch
+                caption_lang = prop["id"][len("C"):]
+                rows_data["rows"][row_data][prop["id"]] = []
+                wmc_caption_data = entity.get("labels", {})
+                if caption_lang in wmc_caption_data.keys():
+                    caption_object = {}
+                    caption_object['str'] = wmc_caption_data[caption_lang]["value"]
+                    rows_data["rows"][row_data][prop["id"]].append(caption_object)
             else:
                 wd_items_list = []
 
@@ -261,12 +377,12 @@ def build_extend_rows_info(extend_ids, extend_properties, lang):
                 rows_data["rows"][row_data][prop["id"]] = []
 
                 # Check if property has been added to Commons image
-                if prop["id"] not in extend_entities[row_data]["statements"].keys():
+                if prop["id"] not in statements:
                     pass
 
                 else:
                     # Iterate every statement in the claim and get the valus
-                    for statement in extend_entities[row_data]["statements"][prop["id"]]:
+                    for statement in statements[prop["id"]]:
 
                         # "datavalue" may not exist in mainsnak keys:add this test
                         if "datavalue" in statement["mainsnak"].keys():
@@ -291,14 +407,20 @@ def build_extend_rows_info(extend_ids, extend_properties, lang):
                                 wd_claim_object = build_dataset_values({}, data_value)
                                 rows_data["rows"][row_data][prop["id"]].append(wd_claim_object)
 
-                # Make call to Wd to get the entitis info
-                wd_items_and_labels = wikidata.get_wikidata_entity_label(wd_items_list, lang)
-                if wd_items_and_labels is not None:
-                    for item_id in wd_items_list:
-                        wd_claim_object = {}
-                        wd_claim_object["id"] = wd_items_and_labels[item_id]["id"]
-                        wd_claim_object["name"] = wd_items_and_labels[item_id]["labels"][lang]["value"]
-                        rows_data["rows"][row_data][prop["id"]].append(wd_claim_object)
+                # Labels of the items are resolved once all rows are built
+                wd_item_cells.append((row_data, prop["id"], wd_items_list))
+
+    # Make one set of calls to Wd to get the info of the entities of all rows
+    wd_items_and_labels = wikidata.get_wikidata_entity_labels(
+        [item_id for _, _, wd_items_list in wd_item_cells for item_id in wd_items_list], lang)
+    for row_data, prop_id, wd_items_list in wd_item_cells:
+        for item_id in wd_items_list:
+            wd_claim_object = {}
+            wd_claim_object["id"] = item_id
+            wd_claim_object["name"] = item_id
+            if lang in wd_items_and_labels.get(item_id, {}).get("labels", {}):
+                wd_claim_object["name"] = wd_items_and_labels[item_id]["labels"][lang]["value"]
+            rows_data["rows"][row_data][prop_id].append(wd_claim_object)
 
     return rows_data["rows"]
 
@@ -322,31 +444,127 @@ def normalize_extend_ids(extend_ids):
     return normalized_ids
 
 
-def build_extend_result(extend_data, lang):
-    """ Combine meta and rows data to make data extension results.
+def build_extend_error_rows(extend_ids, extend_properties, error):
+    """ Build the rows of a batch of ids which could not be built.
+
+        Parameters:
+            extend_ids (obj): List of image ids.
+            extend_properties (obj): Properties to be checked.
+            error (obj): Code and info of the error.
+
+        Returns:
+            rows (obj): Rows with empty cells and the error of the batch.
+    """
+    rows = {}
+    build_row_data(rows, extend_ids)
+    for row_data in rows:
+        for prop in extend_properties:
+            rows[row_data][prop["id"]] = []
+        rows[row_data]["error"] = error
+    return rows
+
+
+def build_extend_rows_or_errors(extend_ids, extend_properties, lang):
+    """ Build the rows of a batch of ids, reporting any failure in the rows themselves.
+
+        Parameters:
+            extend_ids (obj): List of image ids.
+            extend_properties (obj): Properties to be checked.
+            lang (str): Language of the result set.
+
+        Returns:
+            rows (obj): Row information of the batch, or rows with the error of the batch.
+    """
+    try:
+        return build_extend_rows_info(extend_ids, extend_properties, lang)
+    except Exception as e:
+        app.logger.warning("Data extension batch of %s ids failed: %s", len(extend_ids), e)
+        return build_extend_error_rows(extend_ids, extend_properties, {"code": "upstream-error", "info": str(e)})
+
+
+def iter_extend_rows(extend_ids, extend_properties, lang):
+    """ Build the rows of the data extension results, one batch of ids at a time.
+
+        Each batch of 50 ids goes through the entity requests, statement
+        extraction, label resolution and row assembly on its own. The next
+        EXTEND_PREFETCH_BATCHES batches are built in the background while a
+        batch is consumed, and are cancelled if the consumer stops early.
+
+        A failure of the first batch is raised, so that the request can still
+        be answered with an error. The rows of the next batches may already be
+        streamed behind a 200, a failure of theirs is written in their rows.
+
+        Parameters:
+            extend_ids (obj): List of image ids.
+            extend_properties (obj): Properties to be checked.
+            lang (str): Language of the result set.
+
+        Returns:
+            rows (generator): Row information of every batch of 50 ids, in order.
+    """
+    batches = upstream.chunk(extend_ids, 50)
+
+    def build_batch_rows(numbered_batch):
+        number, batch = numbered_batch
+        if number == 0:
+            return build_extend_rows_info(batch, extend_properties, lang)
+        return build_extend_rows_or_errors(batch, extend_properties, lang)
+
+    return upstream.iter_fan_out(build_batch_rows, enumerate(batches), app.config.get("EXTEND_PREFETCH_BATCHES", 2))
+
+
+def stream_extend_json(meta_info, row_batches, first_rows=None):
+    """ Serialize data extension results as JSON, a batch of rows at a time.
+
+        Parameters:
+            meta_info (obj): Meta information of the data extension results.
+            row_batches (iterator): Rows of every batch of ids, closed when the stream is.
+            first_rows (obj): Rows of a batch already taken from row_batches, if any.
+
+        Returns:
+            chunks (generator): Chunks of the JSON document.
+    """
+    yield '{"meta": ' + json.dumps(meta_info) + ', "rows": {'
+    separator = ""
+    try:
+        for rows in itertools.chain([first_rows] if first_rows is not None else [], row_batches):
+            chunk = []
+            for row_id, row in rows.items():
+                chunk.append(separator + json.dumps(row_id) + ": " + json.dumps(row))
+                separator = ", "
+            yield "".join(chunk)
+    finally:
+        # Stops building the next batches when the client goes away
+        if hasattr(row_batches, "close"):
+            row_batches.close()
+    yield "}}"
+
+
+def build_extend_stream(extend_data, lang):
+    """ Data extension results serialized as a stream of JSON chunks.
+
+        The meta information and the rows of the first batch of ids are built
+        before returning, so that invalid requests fail before anything is sent.
+        The rows of the next batches are built as the stream is consumed.
 
         Parameters:
             extend_data (obj): Data in extension request.
             lang (str): Language of api request.
 
         Returns:
-            extend_results (obj): Result for the data extension request.
+            chunks (iterator): Chunks of the JSON document.
     """
-    extend_results = {}
+    if not extend_data:
+        return iter(["{}"])
 
-    if extend_data:
-        extend_ids = extend_data["ids"]
-        normalized_ids = normalize_extend_ids(extend_ids)
-        extend_properties = extend_data["properties"]
+    normalized_ids = list(dict.fromkeys(normalize_extend_ids(extend_data["ids"])))
+    extend_properties = extend_data["properties"]
 
-        meta_info = build_extend_meta_info(extend_properties, lang)
-        rows_data = build_extend_rows_info(normalized_ids, extend_properties, lang)
+    meta_info = build_extend_meta_info(extend_properties, lang)
+    row_batches = iter_extend_rows(normalized_ids, extend_properties, lang)
+    first_rows = next(row_batches, {})
 
-        extend_results["meta"] = meta_info
-        extend_results["rows"] = rows_data
-        return extend_results
-    else:
-        return {}
+    return stream_extend_json(meta_info, row_batches, first_rows)
 
 
 def build_suggest_result(prefix, lang, wd_search_results):
@@ -405,6 +623,16 @@ def get_suggest_result(suggest_prefix, lang):
         Returns:
             wd_search_result (obj): Suggest result data.
     """
+    # Wikidata is only searched when the local property catalog has no match
+    local_search_result = property_catalog.search_properties(suggest_prefix, lang)
+    if local_search_result:
+        # The caption and wikitext pseudo-properties matching the prefix come
+        # first, as in the results built from Wikidata
+        merged_result = {}
+        for result_item in build_suggest_result(suggest_prefix, lang, None)["result"] + local_search_result:
+            merged_result.setdefault(result_item["id"], result_item)
+        return {"result": list(merged_result.values())[:property_catalog.SUGGEST_LIMIT]}
+
     wd_search_result = wikidata.make_suggest_request(suggest_prefix, lang)
 
     return wd_search_result
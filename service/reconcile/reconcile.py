@@ -1,20 +1,37 @@
 import json
-from flask import Blueprint, request, jsonify, render_template, make_response, redirect
+from flask import Blueprint, Response, request, jsonify, render_template, make_response, redirect, stream_with_context
 from flask_cors import cross_origin
 
-from service.commons.commons import make_commons_search
+from service.commons.commons import make_commons_query, title_batcher
 from service.manifest.manifest import get_api_manifest
 from service.properties.property_suggest import get_property_suggest_results
-from service.reconcile.processresults import (build_extend_result, build_query_results, get_suggest_result, get_entity_suggest_result)
-from service.reconcile.handlefile import extract_file_names
-from service.reconcile.media_preview import build_preview_content
-from service.utils.utils import catch_custom_exception, validate_input, return_invalid_input_object
+from service.reconcile.processresults import (build_extend_stream, build_query_results, get_suggest_result, get_entity_suggest_result)
+from service.reconcile.handlefile import build_query_index, join_file_names
+from service.reconcile.media_preview import build_preview_content, prefetch_previews
+from service.utils.utils import catch_custom_exception, validate_input, return_invalid_input_object, make_cacheable_response
 from service.normalize.normalize import InvalidInputDataException
+from service.upstream.breaker import UpstreamUnavailable
+from service.upstream.upstream import get_circuit_breakers, get_rate_limiter, upstream_flights
+from service.wikidata.wikidata import label_cache
 from service import app
 
 reconcile = Blueprint('reconcile', __name__)
 
 
+@reconcile.errorhandler(UpstreamUnavailable)
+def upstream_unavailable(e):
+    """
+    Fail fast while an upstream API is unhealthy, with the time to wait before trying again
+    """
+
+    response = make_response(jsonify({
+        "status": "error",
+        "message": str(e)
+    }), 503)
+    response.headers["Retry-After"] = str(max(1, int(round(e.retry_in))))
+    return response
+
+
 @cross_origin()
 @reconcile.route('/', methods=['GET', 'POST'])
 def home():
@@ -56,8 +73,10 @@ def get_manifest(lang):
                 return return_invalid_input_object(e), 400
 
             queries_data = json.loads(data)
-            pages = make_commons_search(extract_file_names(queries_data))
-            api_results = build_query_results(queries_data, pages)
+            query_index = build_query_index(queries_data)
+            search_data = make_commons_query(join_file_names(query_index))
+            api_results = build_query_results(queries_data, search_data["pages"], search_data["normalized"],
+                                              search_data["redirects"], query_index)
 
         # Action is extend
         elif action[0] == 'extend':
@@ -71,19 +90,22 @@ def get_manifest(lang):
 
             extend_data = json.loads(data)
 
-            # return extend data
-            api_results = build_extend_result(extend_data, lang)
+            # return extend data, streamed a batch of rows at a time
+            extend_stream = build_extend_stream(extend_data, lang)
+            return Response(stream_with_context(extend_stream), status=200, mimetype="application/json")
 
         # Action is not neither of the actions we support
         # Present service manifest
         else:
 
             api_results = get_api_manifest(lang, service_url)
+            return make_cacheable_response(jsonify(api_results), "manifest")
     
     # No action is requested present service manifest
     else:
 
         api_results = get_api_manifest(lang, service_url)
+        return make_cacheable_response(jsonify(api_results), "manifest")
 
     return jsonify(api_results), 200
 
@@ -105,7 +127,7 @@ def get_suggest(lang):
 def get_property_suggestions(lang):
     if "type" in request.args:
         property_suggest_results = get_property_suggest_results(lang)
-        return jsonify(property_suggest_results)
+        return make_cacheable_response(jsonify(property_suggest_results), "properties")
     else:
         return make_response(jsonify({
             "error": "error",
@@ -133,7 +155,50 @@ def preview_media_file(lang):
     media_id = request.args.get("id", None)
 
     preview_content = build_preview_content(media_id)
-    return preview_content
+    return make_cacheable_response(make_response(preview_content), "preview")
+
+
+@reconcile.route('/<string:lang>/api/preview/batch', methods=['GET', 'POST'])
+@cross_origin()
+def preview_media_files(lang):
+    """
+    Previews of many media files at once, given as ids=M1|M2|...
+    """
+
+    ids = request.values.get("ids", "")
+    media_ids = list(dict.fromkeys(media_id for media_id in ids.split("|") if media_id))
+
+    if not media_ids:
+        return make_response(jsonify({
+            "error": "error",
+            "message": "Missing ids argument"
+        }), 400)
+
+    max_ids = app.config.get("PREVIEW_BATCH_MAX", 500)
+    if len(media_ids) > max_ids:
+        return make_response(jsonify({
+            "error": "error",
+            "message": "Too many ids, at most " + str(max_ids) + " are allowed"
+        }), 400)
+
+    return jsonify({"previews": prefetch_previews(media_ids)}), 200
+
+
+@reconcile.route('/stats', methods=['GET'])
+@cross_origin()
+def get_stats():
+    """
+    Counters of the upstream calls, rate limits, circuit breakers, query batches and label cache of this worker
+    """
+
+    return jsonify({
+        "upstream": upstream_flights.stats(),
+        "rate_limits": get_rate_limiter().stats(),
+        "circuit_breakers": get_circuit_breakers().stats(),
+        "query_batches": title_batcher.stats(),
+        "label_cache": label_cache.stats()
+    }), 200
+
 
 @reconcile.route('/redirect_entity', methods=['GET'])
 @cross_origin()
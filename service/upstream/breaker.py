@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Circuit breakers isolating the upstream hosts which keep failing
+
+
+import threading
+import time
+
+
+class UpstreamUnavailable(Exception):
+    """Raised instead of sending a request to a host whose circuit breaker is open"""
+
+    def __init__(self, host, retry_in):
+        super().__init__("The upstream API at {} is unavailable after repeated failures, "
+                         "try again in {} seconds".format(host, max(1, int(round(retry_in)))))
+        self.host = host
+        self.retry_in = retry_in
+
+
+class CircuitBreaker(object):
+    """Stop sending requests to a host after threshold consecutive failures
+
+    The breaker stays open for cooldown seconds, then lets a single trial
+    request through: it closes again if that request succeeds, and opens
+    for another cooldown if it fails. A trial which ends without reporting
+    back, or is not reported within a cooldown, lets another one through.
+    """
+
+    def __init__(self, host, threshold, cooldown):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.trial_started_at = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Raise UpstreamUnavailable if no request may be sent to the host now"""
+        with self._lock:
+            if self.opened_at is None:
+                return
+            now = time.monotonic()
+            retry_in = self.opened_at + self.cooldown - now
+            if retry_in <= 0 and (not self.trial or now - self.trial_started_at >= self.cooldown):
+                self.trial = True
+                self.trial_started_at = now
+                return
+            raise UpstreamUnavailable(self.host, max(retry_in, 0))
+
+    def record_success(self):
+        """Record a request answered by the host"""
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        """Record a request which failed, opening the breaker after threshold failures in a row"""
+        with self._lock:
+            self.failures += 1
+            if self.threshold and (self.trial or self.failures >= self.threshold):
+                self.opened_at = time.monotonic()
+                self.trial = False
+
+    def release_trial(self):
+        """Give back the trial of a request which ended without an answer or a failure of the host"""
+        with self._lock:
+            self.trial = False
+
+    def state(self):
+        """Get the state of the breaker
+
+        Returns:
+            str: "closed", "open" or "half-open".
+        """
+        with self._lock:
+            if self.opened_at is None:
+                return "closed"
+            return "half-open" if self.trial else "open"
+
+
+class CircuitBreakers(object):
+    """The circuit breakers of every upstream host, built on first use"""
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        """Get the circuit breaker of a host
+
+        Args:
+            host (str): Host name of the upstream API.
+
+        Returns:
+            CircuitBreaker: The circuit breaker of the host.
+        """
+        with self._lock:
+            breaker = self._hosts.get(host)
+            if breaker is None:
+                breaker = self._hosts[host] = CircuitBreaker(host, self.threshold, self.cooldown)
+            return breaker
+
+    def stats(self):
+        """Get the state of the circuit breaker of every host
+
+        Returns:
+            obj: The state and consecutive failures of each breaker, by host name.
+        """
+        with self._lock:
+            hosts = dict(self._hosts)
+        return {host: {"state": breaker.state(), "failures": breaker.failures} for host, breaker in hosts.items()}
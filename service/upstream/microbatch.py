@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Micro-batching of the items of concurrent requests into full upstream calls
+
+
+import threading
+import time
+
+from service.upstream import upstream
+
+
+class MicroBatch(object):
+    """Items collected for one upstream call"""
+
+    def __init__(self):
+        self.items = {}
+        self.opened = time.monotonic()
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """Hold the items of concurrent callers for a short window and fetch them together
+
+    The first caller adding an item to a batch leads it: it waits for the
+    window to elapse, or for the batch to be full, then makes the call. The
+    other callers wait for the result of every batch holding their items.
+
+    Args:
+        fetch (function): Function making the upstream call for "|" joined items.
+        max_size (int): Maximum number of items in one call.
+    """
+
+    def __init__(self, fetch, max_size):
+        self.fetch = fetch
+        self.max_size = max_size
+        self.batches = 0
+        self.items = 0
+        self._open_batch = None
+        self._lock = threading.Lock()
+
+    def _run(self, batch):
+        try:
+            batch.result = self.fetch("|".join(batch.items))
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+    def submit(self, items, window):
+        """Add items to the open batches and wait for their calls
+
+        Args:
+            items (list): Items to fetch.
+            window (float): Seconds a new batch waits for items of other callers.
+
+        Returns:
+            list: Results of the calls of the batches holding the items, which
+                can also hold items of other callers.
+        """
+        led_batches = []
+        joined_batches = []
+
+        with self._lock:
+            for item in items:
+                batch = self._open_batch
+                if batch is None:
+                    batch = self._open_batch = MicroBatch()
+                    led_batches.append(batch)
+                    self.batches += 1
+                if item not in batch.items:
+                    batch.items[item] = None
+                    self.items += 1
+                if not joined_batches or joined_batches[-1] is not batch:
+                    joined_batches.append(batch)
+                if len(batch.items) >= self.max_size:
+                    batch.full.set()
+                    self._open_batch = None
+
+        if led_batches:
+            # Only the last batch opened can still be waiting for items
+            last_batch = led_batches[-1]
+            last_batch.full.wait(max(0, last_batch.opened + window - time.monotonic()))
+            with self._lock:
+                if self._open_batch is last_batch:
+                    self._open_batch = None
+            upstream.fan_out(self._run, led_batches)
+
+        results = []
+        for batch in joined_batches:
+            batch.done.wait()
+            if batch.error is not None:
+                raise batch.error
+            results.append(batch.result)
+        return results
+
+    def stats(self):
+        """Get the counters of the batches
+
+        Returns:
+            dict: Number of upstream calls made and of distinct items they fetched.
+        """
+        with self._lock:
+            return {
+                "batches": self.batches,
+                "items": self.items
+            }
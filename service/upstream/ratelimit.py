@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+# Adaptive rate limiting of the requests made to each upstream host
+
+
+import threading
+import time
+
+
+class HostLimiter(object):
+    """Token bucket and adaptive concurrency limit of the requests made to one host
+
+    Requests are started at most rate per second, with bursts of up to burst
+    requests. The number of requests in flight is limited by an AIMD window:
+    it grows by about one request per window of successful requests, up to
+    max_concurrency, and is halved when the host sends a throttle signal, after
+    which no request is started until its Retry-After delay has passed.
+    """
+
+    def __init__(self, rate, burst, max_concurrency):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = max(1.0, self.max_concurrency / 2)
+        self.tokens = float(self.burst)
+        self.in_flight = 0
+        self.throttled = 0
+        self.paused_until = float("-inf")
+        self._updated = time.monotonic()
+        self._condition = threading.Condition()
+
+    def _refill(self, now):
+        if self.rate > 0:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, timeout=None):
+        """Wait until a request can be started
+
+        Args:
+            timeout (float): Longest time to wait for, in seconds, None to wait as long as needed.
+
+        Returns:
+            bool: Whether the request can be started, False if the timeout passed first.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                wait = self.paused_until - now
+                if wait <= 0:
+                    wait = None
+                    if self.in_flight < int(self.concurrency):
+                        if self.rate <= 0 or self.tokens >= 1:
+                            self.tokens -= 1
+                            self.in_flight += 1
+                            return True
+                        wait = (1 - self.tokens) / self.rate
+                if deadline is not None:
+                    if now >= deadline:
+                        return False
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self._condition.wait(wait)
+
+    def release(self, retry_after=None, failed=False):
+        """Record the end of a request
+
+        Args:
+            retry_after (float): Seconds to wait before the next request when the host throttled this one, None otherwise.
+            failed (bool): Whether the request failed without a response, which leaves the concurrency limit as is.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if failed:
+                pass
+            elif retry_after is not None:
+                self.throttled += 1
+                # Requests in flight during a pause were sent before the back off, they do not shrink it again
+                if now >= self.paused_until:
+                    self.concurrency = max(1.0, self.concurrency / 2)
+                self.paused_until = max(self.paused_until, now + retry_after)
+            elif now >= self.paused_until:
+                self.concurrency = min(float(self.max_concurrency), self.concurrency + 1 / self.concurrency)
+            self._condition.notify_all()
+
+    def stats(self):
+        """Get the state of the limiter
+
+        Returns:
+            obj: The concurrency limit, requests in flight and number of throttled requests.
+        """
+        with self._condition:
+            return {
+                "concurrency": int(self.concurrency),
+                "in_flight": self.in_flight,
+                "throttled": self.throttled
+            }
+
+
+class RateLimiter(object):
+    """The limiters of every upstream host, built on first use"""
+
+    def __init__(self, rate, burst, max_concurrency):
+        self.rate = rate
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def get(self, host):
+        """Get the limiter of a host
+
+        Args:
+            host (str): Host name of the upstream API.
+
+        Returns:
+            HostLimiter: The limiter of the host.
+        """
+        with self._lock:
+            limiter = self._hosts.get(host)
+            if limiter is None:
+                limiter = self._hosts[host] = HostLimiter(self.rate, self.burst, self.max_concurrency)
+            return limiter
+
+    def stats(self):
+        """Get the state of the limiter of every host
+
+        Returns:
+            obj: The stats of each host limiter, by host name.
+        """
+        with self._lock:
+            hosts = dict(self._hosts)
+        return {host: limiter.stats() for host, limiter in hosts.items()}
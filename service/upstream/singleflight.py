@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+# Coalescing of identical upstream requests made at the same time
+
+
+import threading
+
+
+class Flight(object):
+    """An upstream call in progress, shared by every caller asking for the same key"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Run a function once per key at a time, the callers arriving while it runs share its result
+
+    Results are shared as is, callers must not modify them.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.collapsed = 0
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Call func, or wait for the call already in flight for key
+
+        Args:
+            key (str): Key identifying identical calls.
+            func (function): Function without arguments making the call.
+
+        Returns:
+            obj: The return value of the call, the exception it raised is raised to every caller.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is None:
+                flight = self._flights[key] = Flight()
+                self.calls += 1
+                leader = True
+            else:
+                self.collapsed += 1
+                leader = False
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = func()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+
+        return flight.result
+
+    def stats(self):
+        """Get the counters of the calls
+
+        Returns:
+            dict: Number of calls made, of calls collapsed into them and of calls in flight.
+        """
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "collapsed": self.collapsed,
+                "in_flight": len(self._flights)
+            }
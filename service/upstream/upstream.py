@@ -0,0 +1,431 @@
+#!/usr/bin/env python3
+
+# Shared HTTP client for the requests made to the upstream Commons and Wikidata APIs
+
+
+import collections
+import hashlib
+import itertools
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from service import app
+from service.cache import backends
+from service.upstream import breaker, ratelimit, singleflight
+
+
+# Objects which each process builds for itself, by name, with the id of the process which built them
+_per_process_objects = {}
+_per_process_lock = threading.Lock()
+
+# Longest Retry-After delay honoured, in seconds
+MAX_RETRY_AFTER = 60
+
+# HTTP statuses of transient upstream failures, which are retried with backoff
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# Request errors of transient upstream failures, which are retried with backoff
+RETRY_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                requests.exceptions.ChunkedEncodingError, requests.exceptions.ContentDecodingError)
+
+# Identical upstream requests in flight at the same time are made once
+upstream_flights = singleflight.SingleFlight()
+
+
+def _per_process(name, factory):
+    """ Get an object shared by the threads of this process, building it on first use.
+
+        The object is built again when the process id changes, so workers
+        forked from a parent never share its sockets, threads or locks.
+
+        Parameters:
+            name (str): Name of the object.
+            factory (function): Function building the object.
+
+        Returns:
+            obj: The object built by factory in this process.
+    """
+
+    pid = os.getpid()
+    entry = _per_process_objects.get(name)
+    if entry is None or entry[0] != pid:
+        with _per_process_lock:
+            entry = _per_process_objects.get(name)
+            if entry is None or entry[0] != pid:
+                entry = _per_process_objects[name] = (pid, factory())
+
+    return entry[1]
+
+
+def build_session():
+    """ Build a session which keeps connections to the upstream APIs alive.
+
+        Each host pool keeps at least UPSTREAM_HOST_CONCURRENCY connections,
+        the most requests the rate limiter lets a worker send to a host at
+        once, so that none of them is closed instead of kept alive.
+
+        Returns:
+            session (obj): requests session with pooled http and https adapters.
+    """
+
+    pool_maxsize = max(app.config.get("UPSTREAM_POOL_MAXSIZE", 10), app.config.get("UPSTREAM_HOST_CONCURRENCY", 16))
+    adapter = HTTPAdapter(pool_connections=app.config.get("UPSTREAM_POOL_CONNECTIONS", 10),
+                          pool_maxsize=pool_maxsize)
+
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    return session
+
+
+def get_session():
+    """ Get the session shared by every upstream caller of this process.
+
+        Returns:
+            session (obj): The process-wide requests session.
+    """
+
+    return _per_process("session", build_session)
+
+
+def get_timeout():
+    """ Get the connect and read timeouts for upstream requests.
+
+        Returns:
+            timeout (tuple): Connect and read timeouts in seconds.
+    """
+
+    return (app.config.get("UPSTREAM_CONNECT_TIMEOUT", 5),
+            app.config.get("UPSTREAM_READ_TIMEOUT", 30))
+
+
+def get_response_cache():
+    """ Get the response cache backend of this process.
+
+        Returns:
+            backend (obj): Backend selected by UPSTREAM_CACHE_BACKEND, None when caching is disabled.
+    """
+
+    return _per_process("response_cache", lambda: backends.build_backend(app.config))
+
+
+def get_rate_limiter():
+    """ Get the rate limiter of the upstream hosts of this process.
+
+        Returns:
+            limiter (obj): Rate limiter with the UPSTREAM_RATE, UPSTREAM_BURST and UPSTREAM_HOST_CONCURRENCY settings.
+    """
+
+    return _per_process("rate_limiter", lambda: ratelimit.RateLimiter(app.config.get("UPSTREAM_RATE", 50),
+                                                                      app.config.get("UPSTREAM_BURST", 50),
+                                                                      app.config.get("UPSTREAM_HOST_CONCURRENCY", 16)))
+
+
+def get_retry_after(response):
+    """ Get the delay asked for by an upstream host which throttled a request.
+
+        HTTP 429 responses, HTTP 503 responses with a Retry-After header, and
+        maxlag or ratelimited API errors, are throttle signals. Other HTTP 503
+        responses are failures of the host.
+
+        Parameters:
+            response (obj): Response of the upstream request.
+
+        Returns:
+            delay (float): Seconds to wait before the next request, None if the request was not throttled.
+    """
+
+    error_code = response.headers.get("MediaWiki-API-Error")
+    throttled = (response.status_code == 429
+                 or (response.status_code == 503 and "Retry-After" in response.headers)
+                 or error_code in ("maxlag", "ratelimited"))
+    if not throttled:
+        return None
+
+    default_retry_after = app.config.get("UPSTREAM_RETRY_AFTER", 5)
+    try:
+        return min(max(float(response.headers.get("Retry-After", default_retry_after)), 0), MAX_RETRY_AFTER)
+    except ValueError:
+        return default_retry_after
+
+
+def get_circuit_breakers():
+    """ Get the circuit breakers of the upstream hosts of this process.
+
+        Returns:
+            breakers (obj): Circuit breakers with the UPSTREAM_BREAKER_THRESHOLD and UPSTREAM_BREAKER_COOLDOWN settings.
+    """
+
+    return _per_process("circuit_breakers", lambda: breaker.CircuitBreakers(app.config.get("UPSTREAM_BREAKER_THRESHOLD", 5),
+                                                                            app.config.get("UPSTREAM_BREAKER_COOLDOWN", 30)))
+
+
+def get_backoff(attempt):
+    """ Get the delay before retrying a failed request, with full jitter.
+
+        Parameters:
+            attempt (int): Number of the failed attempt, starting at 0.
+
+        Returns:
+            delay (float): Seconds to wait before the next attempt.
+    """
+
+    return random.uniform(0, app.config.get("UPSTREAM_RETRY_BACKOFF", 0.5) * 2 ** attempt)
+
+
+def get(url, params):
+    """ Send a GET request to an upstream API, within the rate limits of its host.
+
+        The UPSTREAM_MAXLAG parameter is added to the request, so that the
+        API refuses it while its database replicas lag behind. Throttled
+        requests are sent again once the Retry-After delay of the host has
+        passed, up to UPSTREAM_THROTTLE_RETRIES times. Connection errors,
+        timeouts, truncated or undecodable bodies and HTTP 500, 502, 503 and
+        504 responses are retried up to UPSTREAM_RETRIES times, after a jittered
+        exponential backoff. Other request errors are raised at once.
+
+        Attempts, retries and waits all end by the UPSTREAM_DEADLINE of the
+        call. Hosts failing UPSTREAM_BREAKER_THRESHOLD times in a row get no
+        request for UPSTREAM_BREAKER_COOLDOWN seconds.
+
+        Parameters:
+            url (str): The Api url end point
+            params (obj): The parameters of the request
+
+        Returns:
+            response (obj): The last response of the host.
+
+        Raises:
+            UpstreamUnavailable: The circuit breaker of the host is open.
+            RequestException: The last attempt failed without a response, or the deadline passed.
+    """
+
+    maxlag = app.config.get("UPSTREAM_MAXLAG", 5)
+    if maxlag:
+        params = dict(params, maxlag=maxlag)
+
+    host = urlparse(url).netloc
+    limiter = get_rate_limiter().get(host)
+    host_breaker = get_circuit_breakers().get(host)
+    session = get_session()
+    connect_timeout, read_timeout = get_timeout()
+    deadline = time.monotonic() + app.config.get("UPSTREAM_DEADLINE", 60)
+
+    throttles = 0
+    failures = 0
+    while True:
+        host_breaker.check()
+
+        if time.monotonic() >= deadline or not limiter.acquire(deadline - time.monotonic()):
+            host_breaker.release_trial()
+            raise requests.exceptions.Timeout("Deadline passed before a request could be sent to " + host)
+
+        remaining = max(deadline - time.monotonic(), 0.001)
+        error = None
+        try:
+            response = session.get(url=url, params=params,
+                                   timeout=(min(connect_timeout, remaining), min(read_timeout, remaining)))
+        except requests.exceptions.RequestException as e:
+            limiter.release(failed=True)
+            host_breaker.record_failure()
+            if not isinstance(e, RETRY_ERRORS):
+                raise
+            error = e
+        except BaseException:
+            limiter.release(failed=True)
+            host_breaker.release_trial()
+            raise
+        else:
+            retry_after = get_retry_after(response)
+            limiter.release(retry_after)
+
+            if retry_after is not None:
+                # A throttled request was answered, the host is alive
+                host_breaker.record_success()
+                throttles += 1
+                if throttles > app.config.get("UPSTREAM_THROTTLE_RETRIES", 3):
+                    return response
+                app.logger.warning("%s throttled a request, retrying in %s seconds", host, retry_after)
+                continue
+
+            if response.status_code not in RETRY_STATUSES:
+                host_breaker.record_success()
+                return response
+
+            host_breaker.record_failure()
+            error = requests.exceptions.HTTPError("HTTP " + str(response.status_code) + " from " + host, response=response)
+
+        backoff = get_backoff(failures)
+        if failures >= app.config.get("UPSTREAM_RETRIES", 2) or time.monotonic() + backoff >= deadline:
+            if error.response is not None:
+                return error.response
+            raise error
+
+        failures += 1
+        app.logger.warning("Request to %s failed (%s), retry %s in %.2f seconds", host, error, failures, backoff)
+        time.sleep(backoff)
+
+
+def canonicalize_request(url, params):
+    """ Build a canonical string of an upstream request.
+
+        Parameters:
+            url (str): The Api url end point
+            params (obj): The parameters of the request
+
+        Returns:
+            request (str): The url followed by the parameters sorted by name.
+    """
+
+    return url + "?" + urlencode(sorted((str(key), str(value)) for key, value in params.items()))
+
+
+def build_cache_key(url, params):
+    """ Build the response cache key of an upstream request.
+
+        Parameters:
+            url (str): The Api url end point
+            params (obj): The parameters of the request
+
+        Returns:
+            key (str): Hash of the canonical request.
+    """
+
+    return "upstream:" + hashlib.sha256(canonicalize_request(url, params).encode("utf-8")).hexdigest()
+
+
+def get_cache_ttl(url, params):
+    """ Get the number of seconds the response of a request is cached for.
+
+        The UPSTREAM_CACHE_TTL policies are keyed by API action, optionally
+        prefixed by the API host, e.g. "www.wikidata.org/wbgetentities".
+
+        Parameters:
+            url (str): The Api url end point
+            params (obj): The parameters of the request
+
+        Returns:
+            ttl (int): Seconds to cache the response for, 0 to not cache it.
+    """
+
+    policies = app.config.get("UPSTREAM_CACHE_TTL") or {}
+    action = str(params.get("action", ""))
+    host_action = urlparse(url).netloc + "/" + action
+
+    if host_action in policies:
+        return policies[host_action]
+    return policies.get(action, policies.get("default", 0))
+
+
+def chunk(items, size, separator=None):
+    """ Split items into consecutive chunks, e.g. of the ids an API accepts in one request.
+
+        Parameters:
+            items (list): Items to split.
+            size (int): Maximum number of items per chunk.
+            separator (str): When given, each chunk is joined into a string with it, e.g. "|".
+
+        Returns:
+            chunks (list): Lists of at most size items, or their joined strings, in the order of items.
+    """
+
+    chunks = [items[i:i + size] for i in range(0, len(items), size)]
+    if separator is not None:
+        return [separator.join(chunk_items) for chunk_items in chunks]
+    return chunks
+
+
+def get_executor():
+    """ Get the thread pool shared by the fan-outs of this process.
+
+        Returns:
+            executor (obj): Thread pool of UPSTREAM_EXECUTOR_WORKERS threads.
+    """
+
+    return _per_process("executor", lambda: ThreadPoolExecutor(max_workers=app.config.get("UPSTREAM_EXECUTOR_WORKERS", 32),
+                                                               thread_name_prefix="upstream"))
+
+
+def wait_or_run(future, func, item):
+    """ Get the result of a call submitted to the shared pool, making it in this thread if it has not started.
+
+        A caller never waits for a call which is only queued, so fan-outs made
+        from the threads of the pool cannot deadlock when all of them are busy.
+
+        Parameters:
+            future (obj): Future of func called with item.
+            func (function): Function submitted to the pool.
+            item (obj): Item func was submitted with.
+
+        Returns:
+            result (obj): Return value of func.
+    """
+
+    if future.cancel():
+        return func(item)
+    return future.result()
+
+
+def fan_out(func, items):
+    """ Call func once per item, with up to UPSTREAM_MAX_CONCURRENCY calls in flight.
+
+        The calls run on the shared pool of the process, and in the calling
+        thread when the pool has not started them yet.
+
+        Parameters:
+            func (function): Function taking a single item, usually making an upstream request.
+            items (list): Items to call func with.
+
+        Returns:
+            results (list): Return values of func, in the same order as items.
+    """
+
+    max_workers = min(len(items), app.config.get("UPSTREAM_MAX_CONCURRENCY", 4))
+    if max_workers <= 1:
+        return [func(item) for item in items]
+
+    return list(iter_fan_out(func, items, max_workers))
+
+
+def iter_fan_out(func, items, depth):
+    """ Call func once per item, lazily, keeping up to depth calls running ahead of the consumer.
+
+        Results are yielded in the order of items, as soon as each one is ready,
+        while the calls for the next items run in the background on the shared
+        pool. The calls which have not started yet are cancelled when the
+        generator is closed early.
+
+        Parameters:
+            func (function): Function taking a single item, usually making upstream requests.
+            items (iterable): Items to call func with.
+            depth (int): Number of calls running ahead, 0 calls func only when a result is consumed.
+
+        Returns:
+            results (generator): Return values of func, in the same order as items.
+    """
+
+    items = iter(items)
+    if depth <= 0:
+        for item in items:
+            yield func(item)
+        return
+
+    executor = get_executor()
+    pending = collections.deque((executor.submit(func, item), item) for item in itertools.islice(items, depth))
+    try:
+        while pending:
+            future, item = pending.popleft()
+            result = wait_or_run(future, func, item)
+            pending.extend((executor.submit(func, next_item), next_item) for next_item in itertools.islice(items, 1))
+            yield result
+    finally:
+        for future, item in pending:
+            future.cancel()
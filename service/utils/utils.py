@@ -3,10 +3,12 @@
 # Uility functions of the reconciliation service
 
 from urllib import response
-from flask import jsonify
+from flask import jsonify, request
 import json
 from functools import wraps
+from service import app
 from service.normalize.normalize import InvalidInputDataException
+from service.upstream.breaker import UpstreamUnavailable
 
 
 def catch_custom_exception(func):
@@ -14,6 +16,9 @@ def catch_custom_exception(func):
     def decorated_function(*args, **kwargs):
         try:
             return func(*args, **kwargs)
+        except UpstreamUnavailable:
+            # Answered by the handler of the blueprint
+            raise
         except Exception as e:
             return jsonify({
                 "status": "error",
@@ -22,7 +27,6 @@ def catch_custom_exception(func):
     return decorated_function
 
 
-
 def check_valid_json(obj):
     """Check for valid json object
 
@@ -72,6 +76,27 @@ def return_invalid_input_object(e):
     }
 
 
+def make_cacheable_response(response, policy):
+    """Add an ETag and the Cache-Control policy to a response
+
+    Answers 304 Not Modified without a body when the If-None-Match header
+    of the request matches the ETag.
+
+    Args:
+        response (obj): flask response object with the full body
+        policy (str): Key of the max-age of the response in HTTP_CACHE_MAX_AGE
+
+    Returns:
+        obj: flask response object
+    """
+
+    response.add_etag()
+    response.cache_control.public = True
+    response.cache_control.max_age = (app.config.get("HTTP_CACHE_MAX_AGE") or {}).get(policy, 0)
+
+    return response.make_conditional(request)
+
+
 def merge_two_batch_dicts(batch1, batch2):
     merged_batch = batch1.copy()
     merged_batch.update(batch2)
@@ -5,29 +5,111 @@
 
 
 from service import app
+from service.cache import cache
 from service.commons import commons
 from service.reconcile import processresults
+from service.upstream import upstream
+from service.utils import utils
 
 
-def make_wd_properties_request(wd_properties_list, lang):
-    """ Makes request to Wikidata to get properties.
+# Maximum number of entity ids wbgetentities accepts in one request
+IDS_PER_REQUEST = 50
+
+# Labels of Wikidata items and properties keyed by (entity id, language)
+label_cache = cache.LRUCache(app.config.get("LABEL_CACHE_SIZE", 50000), app.config.get("LABEL_CACHE_TTL", 86400))
+
+
+def cache_entity_labels(entities, lang):
+    """ Store the labels of Wikidata entities in the label cache.
 
         Parameters:
-            wd_properties_list (list): list of properties.
+            entities (obj): Entities of a wbgetentities response keyed by id.
+            lang (str): language of the labels.
 
         Returns:
-            data (obj): Entities which represent the properties.
+            None
+    """
+
+    for entity_id, entity in entities.items():
+        label = entity.get("labels", {}).get(lang)
+        label_cache.set((entity_id, lang), label["value"] if label else None)
+
+
+def build_cached_entity(entity_id, lang, label):
+    """ Build a wbgetentities entity from a cached label.
+
+        Parameters:
+            entity_id (str): WD id of the entity.
+            lang (str): language of the label.
+            label (str): Cached label, None if the entity has no label in lang.
+
+        Returns:
+            entity (obj): Entity with the id and labels of a wbgetentities response.
+    """
+
+    entity = {"id": entity_id, "labels": {}}
+    if label is not None:
+        entity["labels"][lang] = {"language": lang, "value": label}
+
+    return entity
+
+
+def request_entity_labels(wd_ids, lang, use_cache=True):
+    """ Get the labels of Wikidata entities, requesting only those not in the label cache.
+
+        Parameters:
+            wd_ids (list): WD ids of the entities.
+            lang (str): language of the labels.
+            use_cache (bool): Whether cached labels may be used, False to
+                request every label again and cache the fresh ones.
+
+        Returns:
+            data (obj): wbgetentities response for the uncached entities, with
+                the cached ones added to its entities.
     """
 
+    cached_entities = {}
+    uncached_ids = []
+    for wd_id in wd_ids:
+        label = label_cache.get((wd_id, lang)) if use_cache else cache.MISSING
+        if label is cache.MISSING:
+            uncached_ids.append(wd_id)
+        else:
+            cached_entities[wd_id] = build_cached_entity(wd_id, lang, label)
+
+    if len(uncached_ids) == 0:
+        return {"entities": cached_entities}
+
     PARAMS = {
         "action": "wbgetentities",
         "format": "json",
         "languages": lang,
         "props": "labels",
-        "ids": "|".join(id for id in wd_properties_list)
+        "ids": "|".join(id for id in uncached_ids)
     }
 
-    data = commons.make_api_request(app.config["WD_API_URL"], PARAMS)
+    data = commons.make_api_request(app.config["WD_API_URL"], PARAMS, use_cache)
+    if "entities" in data.keys():
+        cache_entity_labels(data["entities"], lang)
+        if cached_entities:
+            data = dict(data)
+            data["entities"] = utils.merge_two_batch_dicts(cached_entities, data["entities"])
+
+    return data
+
+
+def make_wd_properties_request(wd_properties_list, lang, use_cache=True):
+    """ Makes request to Wikidata to get properties.
+
+        Parameters:
+            wd_properties_list (list): list of properties.
+            use_cache (bool): Whether cached labels may be used.
+
+        Returns:
+            data (obj): Entities which represent the properties.
+    """
+
+    data = request_entity_labels(wd_properties_list, lang, use_cache)
 
     return data
 
@@ -43,22 +125,36 @@ def get_wikidata_entity_label(wd_ids, lang):
             label (str): label of wikidata item with ID wd_id.
     """
 
-    PARAMS = {
-        "action": "wbgetentities",
-        "format": "json",
-        "props": "labels",
-        "languages": lang,
-        "ids": "|".join(id for id in wd_ids)
-    }
-
     if len(wd_ids) != 0:
 
-        entityies_data = commons.make_api_request(app.config["WD_API_URL"], PARAMS)
+        entityies_data = request_entity_labels(wd_ids, lang)
         return entityies_data["entities"]
     else:
         return None
 
 
+def get_wikidata_entity_labels(wd_ids, lang):
+    """ Fetch the labels of many Wikidata entities, IDS_PER_REQUEST ids per request.
+
+        Parameters:
+            wd_ids (list): WD ids of the entities, duplicates are requested once.
+            lang (str): language of the labels.
+
+        Returns:
+            entities (obj): Entities of the ids keyed by id.
+    """
+
+    wd_ids = list(dict.fromkeys(wd_ids))
+    batches = upstream.chunk(wd_ids, IDS_PER_REQUEST)
+
+    entities = {}
+    for batch_entities in upstream.fan_out(lambda batch: get_wikidata_entity_label(batch, lang), batches):
+        if batch_entities is not None:
+            entities.update(batch_entities)
+
+    return entities
+
+
 def make_suggest_request(suggest_prefix, lang):
     """ Make request to Wikidata for property suggestions.
 
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+# End-to-end benchmarks of the reconciliation service against recorded upstream fixtures
+#
+# Every scenario sends the requests of an OpenRefine project of the given
+# number of rows through the Flask test client, with the Commons and Wikidata
+# APIs replayed by FakeUpstream after an injected latency. The latencies of the
+# requests, the upstream calls and the peak memory of each scenario are
+# compared against the stored baselines, so that regressions show up.
+#
+# Usage: python -m tests.benchmark.benchmark [--rows 10 100 1000] [--latency 0.05] [--save-baseline]
+
+
+import argparse
+import json
+import math
+import os
+import sys
+import time
+import tracemalloc
+
+from service import app
+from service.properties.property_suggest import property_suggest_results
+from service.reconcile.media_preview import preview_cache
+from service.wikidata.wikidata import label_cache
+from tests.benchmark.upstream import FakeUpstream, PAGE_ID_BASE, file_title
+
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+
+# Config of the service during the benchmarks: the fake upstream does not
+# throttle, and the response cache would hide the upstream calls of a scenario
+BENCHMARK_CONFIG = {
+    "UPSTREAM_RATE": 0,
+    "UPSTREAM_CACHE_BACKEND": "none",
+    "UPSTREAM_RETRY_AFTER": 0,
+    "UPSTREAM_BREAKER_THRESHOLD": 0,
+    "QUERY_BATCH_WINDOW_MS": 0
+}
+
+DEFAULT_ROWS = [10, 100, 1000, 10000]
+
+# Rows per request: OpenRefine reconciles 10 rows per request, and a data
+# extension of many rows is sent in large requests
+QUERIES_PER_REQUEST = 10
+EXTEND_ROWS_PER_REQUEST = 500
+PREVIEWS_PER_REQUEST = 100
+
+SUGGEST_PREFIX = "depicts"
+
+# Smallest number of requests timed to compute the latency percentiles of a scenario
+MIN_TIMED_REQUESTS = 20
+
+# Metrics compared against the baselines, with the smallest increase reported as a regression
+REGRESSION_FLOORS = {
+    "p50_ms": 1.0,
+    "p95_ms": 2.0,
+    "upstream_calls": 1,
+    "peak_memory_mb": 0.5
+}
+
+# Relative increase of the upstream calls tolerated, since concurrent batches
+# of an extension may both miss the label cache for the same items
+CALLS_TOLERANCE = 0.1
+
+
+class BenchmarkError(Exception):
+    """Raised when a request of a scenario is not answered with a 200"""
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def media_ids(rows):
+    return ["M" + str(PAGE_ID_BASE + n) for n in range(1, rows + 1)]
+
+
+def build_queries_requests(rows):
+    requests = []
+    for chunk in chunks(list(range(1, rows + 1)), QUERIES_PER_REQUEST):
+        queries = {"q" + str(n): {"query": file_title(n) if n % 2 else file_title(n).replace(" ", "_")} for n in chunk}
+        requests.append(("POST", "/en/api", {"queries": json.dumps(queries)}))
+    return requests
+
+
+def build_extend_requests(*properties):
+    def build_requests(rows):
+        return [("POST", "/en/api", {"extend": json.dumps({"ids": ids, "properties": [{"id": id} for id in properties]})})
+                for ids in chunks(media_ids(rows), EXTEND_ROWS_PER_REQUEST)]
+    return build_requests
+
+
+def build_suggest_requests(path):
+    def build_requests(rows):
+        return [("GET", path + "?prefix=" + SUGGEST_PREFIX[:1 + n % len(SUGGEST_PREFIX)], None) for n in range(rows)]
+    return build_requests
+
+
+def build_preview_requests(rows):
+    return [("GET", "/en/api/preview?id=" + id, None) for id in media_ids(rows)]
+
+
+def build_preview_batch_requests(rows):
+    return [("POST", "/en/api/preview/batch", {"ids": "|".join(ids)}) for ids in chunks(media_ids(rows), PREVIEWS_PER_REQUEST)]
+
+
+SCENARIOS = {
+    "queries": build_queries_requests,
+    "extend": build_extend_requests("P180", "P571"),
+    "extend_wikitext": build_extend_requests("P180", "wikitext"),
+    "extend_captions": build_extend_requests("Cen", "Cfr"),
+    "extend_items": build_extend_requests("P180"),
+    "suggest_properties": build_suggest_requests("/en/api/suggest/properties"),
+    "suggest_entities": build_suggest_requests("/en/api/suggest"),
+    "preview": build_preview_requests,
+    "preview_batch": build_preview_batch_requests
+}
+
+
+def percentile(values, p):
+    """Get the p-th percentile of values, by nearest rank
+
+    Args:
+        values (list): Measured values
+        p (float): Percentile, from 0 to 100
+
+    Returns:
+        float: The smallest value greater than or equal to p percent of the values
+    """
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def reset_caches():
+    """Empty the caches of the service, so that every scenario starts cold"""
+    label_cache.clear()
+    preview_cache.clear()
+    property_suggest_results.clear()
+
+
+def run_scenario(name, rows, latency=0, trace_memory=True):
+    """Run a benchmark scenario
+
+    Scenarios of fewer than MIN_TIMED_REQUESTS requests are run again from
+    cold caches until that many requests are timed, unless the memory is traced.
+
+    Args:
+        name (str): Name of the scenario, a key of SCENARIOS
+        rows (int): Number of rows of the OpenRefine project
+        latency (float): Latency of every upstream call, in seconds
+        trace_memory (bool): Whether to measure the peak memory, which slows the requests down
+
+    Returns:
+        obj: Latency percentiles of the requests, throughput, upstream calls and peak memory
+
+    Raises:
+        BenchmarkError: A request was not answered with a 200.
+    """
+    requests = SCENARIOS[name](rows)
+    rounds = 1 if trace_memory else math.ceil(MIN_TIMED_REQUESTS / len(requests))
+    client = app.test_client()
+    durations = []
+    calls = None
+
+    with FakeUpstream(latency) as upstream:
+        if trace_memory:
+            tracemalloc.start()
+        started = time.perf_counter()
+        try:
+            for _ in range(rounds):
+                reset_caches()
+                for method, path, data in requests:
+                    request_started = time.perf_counter()
+                    response = client.open(path, method=method, data=data)
+                    response.get_data()
+                    durations.append(time.perf_counter() - request_started)
+                    upstream.forget_requests()
+                    if response.status_code != 200:
+                        raise BenchmarkError("{} {} answered {}".format(method, path, response.status_code))
+                if calls is None:
+                    calls = dict(sorted(upstream.calls.items()))
+            total = time.perf_counter() - started
+            peak_memory = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+
+    return {
+        "requests": len(requests),
+        "p50_ms": round(percentile(durations, 50) * 1000, 2),
+        "p95_ms": round(percentile(durations, 95) * 1000, 2),
+        "rows_per_s": round(rows * rounds / total, 1),
+        "upstream_calls": sum(calls.values()),
+        "upstream_calls_by_action": calls,
+        "peak_memory_mb": round(peak_memory / 2 ** 20, 2) if trace_memory else None
+    }
+
+
+def run_benchmarks(scenarios, rows, latency=0, trace_memory=True):
+    """Run benchmark scenarios with each number of rows
+
+    The latencies are measured without tracing the memory, the peak memory
+    comes from a second run of the scenario.
+
+    Returns:
+        obj: Results of each run, keyed by "<scenario>/<rows>"
+    """
+    results = {}
+    for name in scenarios:
+        for count in rows:
+            result = run_scenario(name, count, latency, trace_memory=False)
+            if trace_memory:
+                result["peak_memory_mb"] = run_scenario(name, count, latency)["peak_memory_mb"]
+            results[name + "/" + str(count)] = result
+    return results
+
+
+def load_baselines(path=BASELINES_PATH):
+    if not os.path.exists(path):
+        return {"settings": {}, "results": {}}
+    with open(path, encoding="utf-8") as baselines_file:
+        return json.load(baselines_file)
+
+
+def save_baselines(results, latency, path=BASELINES_PATH):
+    """Store results as the baselines, merged with the baselines of the runs not repeated"""
+    baselines = load_baselines(path)
+    if baselines["settings"].get("latency") != latency:
+        baselines = {"settings": {"latency": latency}, "results": {}}
+    baselines["results"].update(results)
+    baselines["results"] = dict(sorted(baselines["results"].items(), key=lambda item: (
+        item[0].split("/")[0], int(item[0].split("/")[1]))))
+    with open(path, "w", encoding="utf-8") as baselines_file:
+        json.dump(baselines, baselines_file, indent=2)
+        baselines_file.write("\n")
+
+
+def compare_results(results, baselines, tolerance):
+    """Find the metrics which regressed from the baselines
+
+    Args:
+        results (obj): Results of run_benchmarks
+        baselines (obj): Baseline results, with the same keys
+        tolerance (float): Relative increase of the timings and memory tolerated, 0.5 for 50%
+
+    Returns:
+        list: A description of each regression
+    """
+    regressions = []
+    for key, result in results.items():
+        baseline = baselines.get(key)
+        if baseline is None:
+            continue
+        for metric, floor in REGRESSION_FLOORS.items():
+            if result.get(metric) is None or baseline.get(metric) is None:
+                continue
+            relative = CALLS_TOLERANCE if metric == "upstream_calls" else tolerance
+            allowed = max(baseline[metric] * (1 + relative), baseline[metric] + floor)
+            if result[metric] > allowed:
+                regressions.append("{} {}: {} (baseline {})".format(key, metric, result[metric], baseline[metric]))
+    return regressions
+
+
+def format_results(results):
+    lines = ["{:<28} {:>8} {:>10} {:>10} {:>10} {:>8} {:>9}".format(
+        "scenario/rows", "requests", "p50 ms", "p95 ms", "rows/s", "calls", "peak MB")]
+    for key, result in results.items():
+        lines.append("{:<28} {:>8} {:>10} {:>10} {:>10} {:>8} {:>9}".format(
+            key, result["requests"], result["p50_ms"], result["p95_ms"], result["rows_per_s"],
+            result["upstream_calls"], "-" if result["peak_memory_mb"] is None else result["peak_memory_mb"]))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end benchmarks of the reconciliation service")
+    parser.add_argument("--scenarios", nargs="+", choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument("--rows", nargs="+", type=int, default=DEFAULT_ROWS)
+    parser.add_argument("--latency", type=float, default=0, help="latency of every upstream call, in seconds")
+    parser.add_argument("--tolerance", type=float, default=1.0,
+                        help="relative increase of the timings and memory tolerated before a regression")
+    parser.add_argument("--skip-memory", action="store_true", help="do not trace the peak memory")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baselines")
+    args = parser.parse_args(argv)
+
+    app.config.update(BENCHMARK_CONFIG)
+    results = run_benchmarks(args.scenarios, args.rows, args.latency, not args.skip_memory)
+    print(format_results(results))
+
+    if args.save_baseline:
+        save_baselines(results, args.latency)
+        return 0
+
+    baselines = load_baselines()
+    if baselines["settings"].get("latency") != args.latency:
+        print("No baselines stored with a latency of {}s".format(args.latency))
+        return 0
+    regressions = compare_results(results, baselines["results"], args.tolerance)
+    for regression in regressions:
+        print("Regression: " + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+# Smoke test of the end-to-end benchmarks of the reconciliation service
+
+
+import unittest
+from unittest import mock
+
+from service import app
+from tests.benchmark import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+    """Run every benchmark scenario on a small project."""
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.baselines = benchmark.load_baselines()["results"]
+
+    def test_scenarios_match_the_baseline_upstream_calls(self):
+        with mock.patch.dict(app.config, benchmark.BENCHMARK_CONFIG):
+            results = benchmark.run_benchmarks(benchmark.SCENARIOS, [10])
+
+        for key, result in results.items():
+            self.assertGreater(result["requests"], 0)
+            self.assertGreater(result["peak_memory_mb"], 0)
+            self.assertEqual(result["upstream_calls_by_action"], self.baselines[key]["upstream_calls_by_action"], key)
+
+    def test_compare_results(self):
+        baseline = {"p50_ms": 10.0, "p95_ms": 20.0, "upstream_calls": 20, "peak_memory_mb": 1.0}
+        result = dict(baseline, p50_ms=14.0, p95_ms=40.0, upstream_calls=25)
+
+        regressions = benchmark.compare_results({"extend/10": result}, {"extend/10": baseline}, 0.5)
+
+        self.assertEqual(regressions, ["extend/10 p95_ms: 40.0 (baseline 20.0)",
+                                       "extend/10 upstream_calls: 25 (baseline 20)"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+# Upstream Commons and Wikidata APIs replayed from recorded fixtures, for the benchmarks
+
+
+import collections
+import copy
+import json
+import os
+import re
+import threading
+import time
+
+import requests_mock
+
+from service import app
+
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "fixtures", "upstream.json")
+
+# File:Bench <n>.jpg is the file with page id PAGE_ID_BASE + n
+PAGE_ID_BASE = 1000000
+
+# Number of distinct Wikidata items depicted by the benchmark files
+DEPICTED_ITEMS = 200
+
+# Number of results of a file search
+SEARCH_RESULTS = 10
+
+
+def load_fixtures(path=FIXTURES_PATH):
+    """Load the recorded upstream responses
+
+    Args:
+        path (str): Path of the JSON fixtures file
+
+    Returns:
+        obj: Recorded page, entity and search result objects, by name
+    """
+    with open(path, encoding="utf-8") as fixtures_file:
+        return json.load(fixtures_file)
+
+
+def file_title(n):
+    """Get the title of the n-th benchmark file
+
+    Args:
+        n (int): Number of the file, from 1
+
+    Returns:
+        str: Title of the file
+    """
+    return "File:Bench " + str(n) + ".jpg"
+
+
+def file_page_id(title):
+    """Get the page id of a benchmark file from its title
+
+    Args:
+        title (str): Normalized title of the file
+
+    Returns:
+        int: Page id of the file, None for titles which are not benchmark files
+    """
+    match = re.match(r"^File:Bench (\d+)\.jpg$", title)
+    return PAGE_ID_BASE + int(match.group(1)) if match else None
+
+
+def depicted_items(page_id):
+    """Get the ids of the Wikidata items depicted by a benchmark file
+
+    Args:
+        page_id (int): Page id of the file
+
+    Returns:
+        list: Two item ids, shared with other files
+    """
+    return ["Q" + str(1 + (page_id + offset) % DEPICTED_ITEMS) for offset in range(2)]
+
+
+class FakeUpstream(object):
+    """The Commons and Wikidata APIs, answering every request from the recorded fixtures
+
+    Every benchmark file exists, and each response is sent after latency
+    seconds. Upstream calls are counted by host and action.
+    """
+
+    def __init__(self, latency=0, fixtures=None):
+        self.latency = latency
+        self.fixtures = fixtures if fixtures is not None else load_fixtures()
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+        self._mocker = requests_mock.Mocker(case_sensitive=True)
+        self._mocker.get(app.config["API_URL"], json=self.commons)
+        self._mocker.get(app.config["WD_API_URL"], json=self.wikidata)
+
+    def __enter__(self):
+        self._mocker.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._mocker.stop()
+
+    def forget_requests(self):
+        """Drop the requests recorded by the mocker, whose history would count towards the peak memory"""
+        self._mocker.reset_mock()
+
+    def record(self, request):
+        """Count a call and wait for the latency of the upstream API"""
+        with self._lock:
+            self.calls[request.netloc + "/" + request.qs["action"][0]] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def build_page(self, page_id, props):
+        """Build the page object of a benchmark file, with the requested props"""
+        n = page_id - PAGE_ID_BASE
+        page = {"pageid": page_id, "ns": 6, "title": file_title(n)}
+        if "imageinfo" in props:
+            page["imagerepository"] = "local"
+            page["imageinfo"] = self.fixtures["imageinfo_page"]["imageinfo"]
+        if "revisions" in props:
+            page["revisions"] = self.fixtures["revision_page"]["revisions"]
+        return page
+
+    def build_mediainfo(self, page_id, languages):
+        """Build the MediaInfo entity of a benchmark file, with labels in the requested languages"""
+        entity = copy.deepcopy(self.fixtures["mediainfo_entity"])
+        entity["pageid"] = page_id
+        entity["id"] = "M" + str(page_id)
+        entity["title"] = file_title(page_id - PAGE_ID_BASE)
+        entity["labels"] = {lang: label for lang, label in entity["labels"].items() if lang in languages}
+        for statement, item_id in zip(entity["statements"]["P180"], depicted_items(page_id)):
+            statement["mainsnak"]["datavalue"]["value"]["id"] = item_id
+            statement["mainsnak"]["datavalue"]["value"]["numeric-id"] = int(item_id[1:])
+        return entity
+
+    def commons(self, request, context):
+        """Answer a request to the Commons API"""
+        self.record(request)
+        params = {key: values[0] for key, values in request.qs.items()}
+        props = params.get("prop", "").split("|")
+
+        if params["action"] == "wbgetentities":
+            languages = params.get("languages", "").split("|")
+            return {"entities": {
+                id: self.build_mediainfo(int(id[1:]), languages) for id in params["ids"].split("|")}, "success": 1}
+
+        if params.get("list") == "search":
+            search_result = self.fixtures["search_result"]
+            return {"batchcomplete": "", "query": {"search": [
+                dict(search_result, pageid=PAGE_ID_BASE + n, title=file_title(n)) for n in range(1, SEARCH_RESULTS + 1)]}}
+
+        pages = {}
+        normalized = []
+        if "titles" in params:
+            for missing, title in enumerate(params["titles"].split("|"), 1):
+                if "_" in title:
+                    normalized.append({"from": title, "to": title.replace("_", " ")})
+                    title = title.replace("_", " ")
+                page_id = file_page_id(title)
+                if page_id is None:
+                    pages[str(-missing)] = {"ns": 6, "title": title, "missing": ""}
+                else:
+                    pages[str(page_id)] = self.build_page(page_id, props)
+        else:
+            for page_id in params["pageids"].split("|"):
+                pages[page_id] = self.build_page(int(page_id), props)
+
+        query = {"pages": pages}
+        if normalized:
+            query["normalized"] = normalized
+        return {"batchcomplete": "", "query": query}
+
+    def wikidata(self, request, context):
+        """Answer a request to the Wikidata API"""
+        self.record(request)
+        params = {key: values[0] for key, values in request.qs.items()}
+
+        if params["action"] == "wbsearchentities":
+            return {"searchinfo": {"search": params["search"]}, "search": [self.fixtures["property_search_result"]], "success": 1}
+
+        languages = params.get("languages", "en").split("|")
+        entities = {}
+        for id in params["ids"].split("|"):
+            fixture = self.fixtures["wikidata_property" if id.startswith("P") else "wikidata_item"]
+            entities[id] = dict(fixture, id=id, labels={
+                lang: {"language": lang, "value": label["value"] + " " + id}
+                for lang, label in fixture["labels"].items() if lang in languages})
+        return {"entities": entities, "success": 1}
@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+
+# Unit tests for the upstream response cache backends of the reconciliation service
+
+
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import requests_mock
+
+from service import app
+from service.cache import backends
+from service.commons.commons import make_api_request
+from service.upstream import upstream
+
+
+class RedisStandInHandler(socketserver.StreamRequestHandler):
+    """Serves the GET, SET and FLUSHDB commands of the Redis protocol from a dictionary"""
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        command = []
+        for i in range(int(line[1:-2])):
+            length = int(self.rfile.readline()[1:-2])
+            command.append(self.rfile.read(length + 2)[:-2])
+        return command
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            command = self.read_command()
+            if command is None:
+                return
+            name = command[0].upper()
+            if name == b"GET":
+                entry = store.get(command[1])
+                if entry is None or entry[1] < time.time():
+                    self.wfile.write(b"$-1\r\n")
+                else:
+                    self.wfile.write(b"$%d\r\n%s\r\n" % (len(entry[0]), entry[0]))
+            elif name == b"SET":
+                store[command[1]] = (command[2], time.time() + int(command[4]))
+                self.wfile.write(b"+OK\r\n")
+            elif name == b"FLUSHDB":
+                store.clear()
+                self.wfile.write(b"+OK\r\n")
+            else:
+                self.wfile.write(b"-ERR unknown command\r\n")
+
+
+class TestBackends(unittest.TestCase):
+    """Test the response cache backends."""
+
+    def setUp(self):
+        self.sample_response = {"entities": {"P180": {"id": "P180", "labels": {"en": {"language": "en", "value": "depicts"}}}}}
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+
+    def check_backend(self, backend):
+        self.assertIsNone(backend.get("upstream:key"))
+        backend.set("upstream:key", self.sample_response, 60)
+        self.assertEqual(backend.get("upstream:key"), self.sample_response)
+        backend.set("upstream:expired", self.sample_response, -1)
+        self.assertIsNone(backend.get("upstream:expired"))
+        backend.clear()
+        self.assertIsNone(backend.get("upstream:key"))
+
+
+    def test_memory_backend(self):
+        self.check_backend(backends.MemoryBackend(10))
+
+
+    def test_sqlite_backend(self):
+        self.check_backend(backends.SQLiteBackend(os.path.join(self.cache_dir, "cache.sqlite3")))
+
+
+    def test_memory_backend_is_bounded_in_bytes(self):
+        backend = backends.MemoryBackend(10, 150)
+        backend.set("upstream:first", self.sample_response, 60)
+        backend.set("upstream:second", self.sample_response, 60)
+
+        self.assertIsNone(backend.get("upstream:first"))
+        self.assertEqual(backend.get("upstream:second"), self.sample_response)
+
+
+    def test_sqlite_backend_reuses_connections_across_threads(self):
+        backend = backends.SQLiteBackend(os.path.join(self.cache_dir, "cache.sqlite3"))
+        with mock.patch.object(backend._pool, "connect", wraps=backend._pool.connect) as connect:
+            for i in range(5):
+                thread = threading.Thread(target=backend.set, args=("upstream:" + str(i), self.sample_response, 60))
+                thread.start()
+                thread.join()
+
+        self.assertEqual(connect.call_count, 1)
+        self.assertEqual(backend.get("upstream:4"), self.sample_response)
+
+
+    def test_sqlite_backend_is_shared(self):
+        path = os.path.join(self.cache_dir, "cache.sqlite3")
+        backends.SQLiteBackend(path).set("upstream:key", self.sample_response, 60)
+        self.assertEqual(backends.SQLiteBackend(path).get("upstream:key"), self.sample_response)
+
+
+    def test_redis_backend(self):
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), RedisStandInHandler)
+        server.daemon_threads = True
+        server.store = {}
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            self.check_backend(backends.RedisBackend("redis://127.0.0.1:%d/0" % server.server_address[1]))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+    def test_redis_backend_reuses_connections(self):
+        server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), RedisStandInHandler)
+        server.daemon_threads = True
+        server.store = {}
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            backend = backends.RedisBackend("redis://127.0.0.1:%d/0" % server.server_address[1])
+            with mock.patch.object(backend._pool, "connect", wraps=backend._pool.connect) as connect:
+                upstream.fan_out(lambda i: backend.set("upstream:" + str(i), self.sample_response, 60), list(range(8)))
+                upstream.fan_out(lambda i: backend.get("upstream:" + str(i)), list(range(8)))
+
+            self.assertLessEqual(connect.call_count, app.config["UPSTREAM_MAX_CONCURRENCY"])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+    def test_redis_backend_failure_is_a_miss(self):
+        server = socketserver.TCPServer(("127.0.0.1", 0), RedisStandInHandler)
+        port = server.server_address[1]
+        server.server_close()
+
+        backend = backends.RedisBackend("redis://127.0.0.1:%d/0" % port)
+        backend.set("upstream:key", self.sample_response, 60)
+        self.assertIsNone(backend.get("upstream:key"))
+
+
+    def test_build_backend(self):
+        self.assertIsNone(backends.build_backend({"UPSTREAM_CACHE_BACKEND": "none"}))
+        self.assertIsInstance(backends.build_backend({"UPSTREAM_CACHE_BACKEND": "memory"}), backends.MemoryBackend)
+        with self.assertRaises(ValueError):
+            backends.build_backend({"UPSTREAM_CACHE_BACKEND": "memcached"})
+
+
+class TestResponseCache(unittest.TestCase):
+    """Test the response cache of upstream requests."""
+
+    def setUp(self):
+        self.config = mock.patch.dict(app.config, {"UPSTREAM_CACHE_BACKEND": "memory"})
+        self.config.start()
+        upstream._per_process_objects.pop("response_cache", None)
+        self.test_wd_properties_data = """{"entities":{"P180":{"id":"P180","labels":{"en":{"language":"en","value":"depicts"}}}}}"""
+
+    def tearDown(self):
+        self.config.stop()
+        upstream._per_process_objects.pop("response_cache", None)
+
+
+    def test_get_cache_ttl(self):
+        self.assertEqual(upstream.get_cache_ttl(app.config["WD_API_URL"], {"action": "wbgetentities"}), 86400)
+        self.assertEqual(upstream.get_cache_ttl(app.config["API_URL"], {"action": "wbgetentities"}), 600)
+        self.assertEqual(upstream.get_cache_ttl(app.config["API_URL"], {"action": "upload"}), 0)
+
+
+    def test_build_cache_key_ignores_parameter_order(self):
+        self.assertEqual(upstream.build_cache_key("https://test.com/path", {"action": "query", "titles": "File:A.jpg"}),
+                         upstream.build_cache_key("https://test.com/path", {"titles": "File:A.jpg", "action": "query"}))
+
+
+    def test_make_api_request_is_cached(self):
+        params = {"action": "wbgetentities", "ids": "P180", "format": "json"}
+        with requests_mock.Mocker() as m:
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&ids=P180", text=self.test_wd_properties_data)
+            make_api_request(app.config["WD_API_URL"], params)
+            response = make_api_request(app.config["WD_API_URL"], params)
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(response["entities"]["P180"]["labels"]["en"]["value"], "depicts")
+
+
+    def test_make_api_request_does_not_cache_errors(self):
+        params = {"action": "wbgetentities", "ids": "M-1", "format": "json"}
+        with requests_mock.Mocker() as m:
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities", text="""{"error": {"code": "no-such-entity"}}""")
+            make_api_request(app.config["WD_API_URL"], params)
+            make_api_request(app.config["WD_API_URL"], params)
+
+        self.assertEqual(m.call_count, 2)
+
+
+    def test_make_api_request_without_ttl_policy(self):
+        params = {"action": "upload", "format": "json"}
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=upload", text="""{"upload": {}}""")
+            make_api_request(app.config["API_URL"], params)
+            make_api_request(app.config["API_URL"], params)
+
+        self.assertEqual(m.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+# Unit tests for the in-process caches of the reconciliation service
+
+
+import unittest
+from unittest import mock
+
+from service.cache import cache
+
+
+class TestLRUCache(unittest.TestCase):
+    """Test the LRU cache."""
+
+    def setUp(self):
+        self.lru_cache = cache.LRUCache(maxsize=2, ttl=60)
+
+    def tearDown(self):
+        pass
+
+
+    def test_get_missing_key(self):
+        self.assertIs(self.lru_cache.get(("P180", "en")), cache.MISSING)
+        self.assertEqual(self.lru_cache.get(("P180", "en"), None), None)
+
+
+    def test_set_and_get(self):
+        self.lru_cache.set(("P180", "en"), "depicts")
+        self.assertEqual(self.lru_cache.get(("P180", "en")), "depicts")
+
+
+    def test_cached_none_is_a_hit(self):
+        self.lru_cache.set(("Q7", "en"), None)
+        self.assertIsNone(self.lru_cache.get(("Q7", "en")))
+        self.assertEqual(self.lru_cache.stats()["hits"], 1)
+
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.lru_cache.set("a", 1)
+        self.lru_cache.set("b", 2)
+        self.lru_cache.get("a")
+        self.lru_cache.set("c", 3)
+
+        self.assertEqual(self.lru_cache.get("a"), 1)
+        self.assertIs(self.lru_cache.get("b"), cache.MISSING)
+        self.assertEqual(self.lru_cache.get("c"), 3)
+        self.assertEqual(len(self.lru_cache), 2)
+
+
+    def test_entries_are_evicted_beyond_maxbytes(self):
+        sized_cache = cache.LRUCache(maxsize=10, ttl=60, maxbytes=100)
+        sized_cache.set("a", "a", size=60)
+        sized_cache.set("b", "b", size=30)
+        sized_cache.set("c", "c", size=30)
+        sized_cache.set("d", "d", size=101)
+
+        self.assertIs(sized_cache.get("a"), cache.MISSING)
+        self.assertEqual(sized_cache.get("b"), "b")
+        self.assertEqual(sized_cache.get("c"), "c")
+        self.assertIs(sized_cache.get("d"), cache.MISSING)
+
+
+    def test_expired_entry_is_a_miss(self):
+        with mock.patch("time.monotonic", return_value=1000):
+            self.lru_cache.set("a", 1)
+        with mock.patch("time.monotonic", return_value=1061):
+            self.assertIs(self.lru_cache.get("a"), cache.MISSING)
+        self.assertEqual(len(self.lru_cache), 0)
+
+
+    def test_stats(self):
+        self.lru_cache.set("a", 1)
+        self.lru_cache.get("a")
+        self.lru_cache.get("b")
+        self.assertEqual(self.lru_cache.stats(), {"size": 1, "maxsize": 2, "hits": 1, "misses": 1})
+
+        self.lru_cache.clear()
+        self.assertEqual(self.lru_cache.stats(), {"size": 0, "maxsize": 2, "hits": 0, "misses": 0})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -6,10 +6,14 @@
 
 import json
 import unittest
+from unittest import mock
+
 import requests_mock
 
 from service import app
-from service.properties.property_suggest import get_property_suggest_results
+from service.wikidata.wikidata import label_cache
+from service.properties.property_suggest import (get_property_suggest_results, property_suggest_results,
+                                                 refresh_property_suggest_results)
 
 
 
@@ -22,6 +26,8 @@ class TestProperties(unittest.TestCase):
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['DEBUG'] = False
         self.app = app.test_client()
+        label_cache.clear()
+        property_suggest_results.clear()
 
         self.properties_suggest_result = """{"properties": [{"id": "wikitext","name": "Wikitext"},{"id": "P180","name": "depicts"},{"id": "P6243","name": "digital representation of"},{"id": "P921","name": "main subject"},{"id": "P170","name": "creator"},{"id": "P571","name": "inception"},{"id": "P1071","name": "location of creation"},{"id": "P195","name": "collection"},{"id": "P7482","name": "source of file"},{"id": "P6216","name": "copyright status"},{"id": "P275","name": "copyright license"},{"id": "P1259","name": "coordinates of the point of view"}],"type": "mediafile"}"""
         self.properties_suggest_mock_data = """{"entities": {"P180": {"type": "property", "datatype": "wikibase-item", "id": "P180", "labels": {"en": {"language": "en", "value": "depicts"}}}, "P6243": {"type": "property", "datatype": "wikibase-item", "id": "P6243", "labels": {"en": {"language": "en", "value": "digital representation of"}}}, "P921": {"type": "property", "datatype": "wikibase-item", "id": "P921", "labels": {"en": {"language": "en", "value": "main subject"}}}, "P170": {"type": "property", "datatype": "wikibase-item", "id": "P170", "labels": {"en": {"language": "en", "value": "creator"}}}, "P571": {"type": "property", "datatype": "time", "id": "P571", "labels": {"en": {"language": "en", "value": "inception"}}}, "P1071": {"type": "property", "datatype": "wikibase-item", "id": "P1071", "labels": {"en": {"language": "en", "value": "location of creation"}}}, "P195": {"type": "property", "datatype": "wikibase-item", "id": "P195", "labels": {"en": {"language": "en", "value": "collection"}}}, "P7482": {"type": "property", "datatype": "wikibase-item", "id": "P7482", "labels": {"en": {"language": "en", "value": "source of file"}}}, "P6216": {"type": "property", "datatype": "wikibase-item", "id": "P6216", "labels": {"en": {"language": "en", "value": "copyright status"}}}, "P275": {"type": "property", "datatype": "wikibase-item", "id": "P275", "labels": {"en": {"language": "en", "value": "copyright license"}}}, "P1259": {"type": "property", "datatype": "globe-coordinate", "id": "P1259", "labels": {"en": {"language": "en", "value": "coordinates of the point of view"}}}}, "success": 1}"""
@@ -42,5 +48,60 @@ class TestProperties(unittest.TestCase):
         self.assertEqual(suggest_properties, json.loads(self.properties_suggest_result))
 
 
+    def test_get_property_suggest_results_from_memory(self):
+        with requests_mock.Mocker() as m, mock.patch.dict(app.config, {"PROPERTIES_LANGUAGES": ["en"]}):
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&languages=en&props=labels",
+                  text=self.properties_suggest_mock_data)
+            get_property_suggest_results('en')
+            label_cache.clear()
+            suggest_properties = get_property_suggest_results('en')
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(suggest_properties, json.loads(self.properties_suggest_result))
+
+
+    def test_refresh_property_suggest_results(self):
+        with requests_mock.Mocker() as m:
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&languages=en&props=labels",
+                  text=self.properties_suggest_mock_data)
+            refresh_property_suggest_results(['en'])
+            suggest_properties = get_property_suggest_results('en')
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(suggest_properties, json.loads(self.properties_suggest_result))
+
+
+    def test_get_property_suggest_results_of_other_languages_not_kept(self):
+        with requests_mock.Mocker() as m, mock.patch.dict(app.config, {"PROPERTIES_LANGUAGES": ["en"]}):
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&languages=en&props=labels",
+                  text=self.properties_suggest_mock_data)
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&languages=xx-junk&props=labels",
+                  json={"entities": {}})
+            junk_properties = get_property_suggest_results('xx-junk')
+            get_property_suggest_results('en')
+
+        self.assertEqual(list(property_suggest_results.keys()), ['en'])
+        self.assertEqual(junk_properties["properties"][1], {"id": "P180", "name": "P180"})
+
+
+    def test_refresh_property_suggest_results_skips_label_cache(self):
+        with requests_mock.Mocker() as m:
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&languages=en&props=labels",
+                  text=self.properties_suggest_mock_data)
+            refresh_property_suggest_results(['en'])
+            refresh_property_suggest_results(['en'])
+
+        self.assertEqual(m.call_count, 2)
+
+
+    def test_refresh_property_suggest_results_keeps_results_on_failure(self):
+        property_suggest_results['en'] = json.loads(self.properties_suggest_result)
+        with requests_mock.Mocker() as m:
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities", status_code=503, text="Service Unavailable")
+            refresh_property_suggest_results(['en'])
+
+        self.assertEqual(property_suggest_results['en'], json.loads(self.properties_suggest_result))
+
+
 if __name__ == '__main__':
     unittest.main()
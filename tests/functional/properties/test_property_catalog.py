@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+# Unit tests for the local property catalog of the reconciliation service
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import requests_mock
+
+from service import app
+from service.properties import property_catalog
+from service.reconcile.processresults import get_suggest_result
+
+
+class TestPropertyCatalog(unittest.TestCase):
+
+    # setup and teardown #
+    # executed prior to each test
+    def setUp(self):
+        self.catalog_dir = tempfile.mkdtemp()
+        self.catalog_path = os.path.join(self.catalog_dir, "properties.json")
+        self.properties = [
+            {"id": "P180", "labels": {"en": "depicts", "fr": "dépeint"}, "descriptions": {"en": "depicted entity"},
+             "aliases": {"en": ["portrait of", "shows"]}},
+            {"id": "P170", "labels": {"en": "creator"}, "descriptions": {"en": "maker of this creative work"},
+             "aliases": {"en": ["author", "depicted by"]}},
+            {"id": "P1259", "labels": {"en": "coordinates of the point of view"}, "descriptions": {},
+             "aliases": {}}
+        ]
+        self.write_catalog(self.properties)
+        self.config = mock.patch.dict(app.config, {"PROPERTY_CATALOG_PATH": self.catalog_path,
+                                                   "PROPERTY_CATALOG_LANGUAGES": ["en", "fr", "de"]})
+        self.config.start()
+        property_catalog._catalog["path"] = None
+        self.suggest_mock_result = """{"search":[{"id": "P180", "label": "depicts", "description": "depicted entity"}]}"""
+
+    # executed after each test
+    def tearDown(self):
+        self.config.stop()
+        property_catalog._catalog["path"] = None
+        shutil.rmtree(self.catalog_dir)
+
+    def write_catalog(self, properties):
+        with open(self.catalog_path, "w") as snapshot:
+            json.dump({"properties": properties}, snapshot)
+
+    # tests #
+
+    def test_search_properties_by_label(self):
+        result = property_catalog.search_properties("depi", "en")
+        self.assertEqual(result[0], {"id": "P180", "name": "depicts", "description": "depicted entity"})
+        self.assertEqual(result[1]["id"], "P170")
+
+
+    def test_search_properties_by_alias_and_id(self):
+        self.assertEqual(property_catalog.search_properties("Portrait", "en")[0]["id"], "P180")
+        self.assertEqual(property_catalog.search_properties("p1259", "en")[0]["id"], "P1259")
+
+
+    def test_search_properties_falls_back_to_english(self):
+        result = property_catalog.search_properties("dép", "fr")
+        self.assertEqual(result[0]["name"], "dépeint")
+        self.assertEqual(property_catalog.search_properties("creat", "fr")[0]["name"], "creator")
+
+
+    def test_search_properties_pseudo_properties(self):
+        self.assertEqual(property_catalog.search_properties("wiki", "en")[0]["id"], "wikitext")
+        self.assertEqual(property_catalog.search_properties("capt", "de")[0],
+                         {"id": "Cde", "name": "Caption [de]", "description": "file caption"})
+
+
+    def test_search_properties_without_catalog(self):
+        with mock.patch.dict(app.config, {"PROPERTY_CATALOG_PATH": None}):
+            self.assertIsNone(property_catalog.search_properties("depi", "en"))
+
+
+    def test_search_properties_in_other_languages_goes_upstream(self):
+        self.assertIsNone(property_catalog.search_properties("depi", "xx-junk"))
+        self.assertNotIn("xx-junk", property_catalog._catalog["indexes"])
+
+        with requests_mock.Mocker() as m:
+            m.get("https://www.wikidata.org/w/api.php?action=wbsearchentities&search=depi", text=self.suggest_mock_result)
+            get_suggest_result("depi", "nl")
+
+        self.assertEqual(m.call_count, 1)
+
+
+    def test_catalog_is_reloaded_when_changed(self):
+        self.assertEqual(property_catalog.search_properties("sho", "en")[0]["id"], "P180")
+        self.write_catalog(self.properties[1:])
+        os.utime(self.catalog_path, (0, 0))
+        property_catalog._catalog["checked"] = float("-inf")
+        self.assertEqual(property_catalog.search_properties("sho", "en"), [])
+
+
+    def test_get_suggest_result_from_catalog(self):
+        with requests_mock.Mocker() as m:
+            suggest_result = get_suggest_result("depicts", "en")
+
+        self.assertEqual(m.call_count, 0)
+        self.assertEqual(suggest_result["result"][0], {"id": "P180", "name": "depicts", "description": "depicted entity"})
+
+
+    def test_get_suggest_result_from_catalog_keeps_caption_of_other_languages(self):
+        self.write_catalog(self.properties + [{"id": "P5900", "labels": {"en": "CFR code"}, "descriptions": {}, "aliases": {}}])
+
+        with requests_mock.Mocker() as m:
+            suggest_result = get_suggest_result("Cfr", "en")
+
+        self.assertEqual(m.call_count, 0)
+        self.assertEqual([result_item["id"] for result_item in suggest_result["result"]], ["Cfr", "P5900"])
+        self.assertEqual(suggest_result["result"][0]["name"], "Caption [fr]")
+
+
+    def test_get_suggest_result_falls_back_to_wikidata(self):
+        with requests_mock.Mocker() as m:
+            m.get("https://www.wikidata.org/w/api.php?action=wbsearchentities&search=inception", text=self.suggest_mock_result)
+            get_suggest_result("inception", "en")
+
+        self.assertEqual(m.call_count, 1)
+
+
+    def test_build_property_catalog(self):
+        allpages_data = {"continue": {"apcontinue": "P2", "continue": "-||"},
+                         "query": {"allpages": [{"title": "Property:P1"}]}}
+        allpages_continued_data = {"query": {"allpages": [{"title": "Property:P2"}]}}
+        terms_data = {"entities": {
+            "P1": {"id": "P1", "labels": {"en": {"value": "one"}}},
+            "P2": {"id": "P2", "labels": {"en": {"value": "two"}}, "aliases": {"en": [{"value": "second"}]}}
+        }}
+        with requests_mock.Mocker() as m:
+            m.get("https://www.wikidata.org/w/api.php?action=query&list=allpages", json=allpages_data)
+            m.get("https://www.wikidata.org/w/api.php?action=query&list=allpages&apcontinue=P2", json=allpages_continued_data)
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&ids=P1|P2", json=terms_data)
+            property_catalog.build_property_catalog(self.catalog_path, ["en"])
+
+        with open(self.catalog_path) as snapshot:
+            properties = json.load(snapshot)["properties"]
+        self.assertEqual(properties[1], {"id": "P2", "labels": {"en": "two"}, "descriptions": {}, "aliases": {"en": ["second"]}})
+
+
+if __name__ == '__main__':
+    unittest.main()
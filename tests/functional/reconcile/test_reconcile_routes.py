@@ -6,9 +6,13 @@
 
 import unittest
 import json
+import requests
 import requests_mock
 
 from service import app
+from service.wikidata.wikidata import label_cache
+from service.properties.property_suggest import property_suggest_results
+from service.reconcile.media_preview import preview_cache
 
 from service.manifest.manifest import get_api_manifest
 
@@ -23,6 +27,9 @@ class TestApi(unittest.TestCase):
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['DEBUG'] = False
         self.app = app.test_client()
+        label_cache.clear()
+        property_suggest_results.clear()
+        preview_cache.clear()
 
         self.fake_query = {
             'q0': {
@@ -76,6 +83,9 @@ class TestApi(unittest.TestCase):
         self.commons_wikitext_data = """
         {"parse":{"title":"File:Chick Corea & Stanley Clarke.jpg","pageid":74698470,"wikitext":{"*":"== {{int:filedesc}} =="}}}
         """
+        self.commons_revisions_wikitext_data = """
+        {"batchcomplete":"","query":{"pages":{"74698470":{"pageid":74698470,"ns":6,"title":"File:Chick Corea & Stanley Clarke.jpg","revisions":[{"slots":{"main":{"contentmodel":"wikitext","contentformat":"text/x-wiki","*":"== {{int:filedesc}} =="}}}]}}}}
+        """
         self.extend_data_result = """
         {"meta":[{"id": "wikitext","name": "Wikitext"},{"id":"P180","name": "depicts"}],"rows":{"M74698470":{"P180":[{"id": "Q192465","name": "Chick Corea"},{"id": "Q453406","name": "Stanley Clarke"}],"wikitext": [{"str":"== {{int:filedesc}} =="}]},"M83241361":{"P180":[],"wikitext": ["== {{int:filedesc}} =="]}}}
         """
@@ -137,6 +147,24 @@ class TestApi(unittest.TestCase):
         self.assertEqual(response_data['view']['url'], service_manifest['view']['url'])
 
 
+    def test_get_manifest_cache_headers(self):
+        response = self.app.get('/en/api', follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(response.headers.get('ETag'))
+        self.assertFalse(response.headers['ETag'].startswith('W/'))
+        self.assertIn('max-age=' + str(app.config['HTTP_CACHE_MAX_AGE']['manifest']), response.headers['Cache-Control'])
+
+
+    def test_get_manifest_not_modified(self):
+        etag = self.app.get('/en/api', follow_redirects=True).headers['ETag']
+        response = self.app.get('/en/api', headers={'If-None-Match': etag}, follow_redirects=True)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+        response = self.app.get('/fr/api', headers={'If-None-Match': etag}, follow_redirects=True)
+        self.assertEqual(response.status_code, 200)
+
+
     def test_get_manifest_with_single_query(self):
         with requests_mock.Mocker() as m:
             m.get('https://commons.wikimedia.org/w/api.php?action=query&format=json&prop=imageinfo&titles=File:Commons-logo.svg', text=self.commons_response)
@@ -149,20 +177,20 @@ class TestApi(unittest.TestCase):
         self.assertEqual(results['q0']['result'][0]['name'], 'File:Commons-logo.svg')
 
 
-    # def test_get_manifest_with_many_queries(self):
+    def test_get_manifest_with_many_queries(self):
 
-    #     with requests_mock.Mocker() as m:
-    #         m.get('https://commons.wikimedia.org/w/api.php?action=query&format=json&prop=imageinfo&titles=File:Commons-logo.svg|File:Allah-green-transparent.svg',
-    #               text=self.commons_response_many_files)
+        with requests_mock.Mocker() as m:
+            m.get('https://commons.wikimedia.org/w/api.php?action=query&format=json&prop=imageinfo&titles=File:Commons-logo.svg|File:Allah-green-transparent.svg',
+                  text=self.commons_response_many_files)
 
-    #         response = self.app.get('/en/api?queries={}'.format(json.dumps(self.fake_queries)), follow_redirects=True)
-    #         results = json.loads(response.data.decode('utf-8'))
+            response = self.app.get('/en/api?queries={}'.format(json.dumps(self.fake_queries)), follow_redirects=True)
+            results = json.loads(response.data.decode('utf-8'))
 
-    #     self.assertEqual(response.status_code, 200)
-    #     self.assertEqual(results['q0']['result'][0]['id'], 'M317966')
-    #     self.assertEqual(results['q0']['result'][0]['name'], 'File:Commons-logo.svg')
-    #     self.assertEqual(results['q1']['result'][0]['id'], 'M74943657')
-    #     self.assertEqual(results['q1']['result'][0]['name'], 'File:Allah-green-transparent.svg')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(results['q0']['result'][0]['id'], 'M317966')
+        self.assertEqual(results['q0']['result'][0]['name'], 'File:Commons-logo.svg')
+        self.assertEqual(results['q1']['result'][0]['id'], 'M74943657')
+        self.assertEqual(results['q1']['result'][0]['name'], 'File:Allah-green-transparent.svg')
 
 
     def test_get_manifest_with_file_not_found(self):
@@ -175,6 +203,16 @@ class TestApi(unittest.TestCase):
         self.assertEqual(results, self.fake_page_not_found_result)
 
 
+    def test_get_manifest_with_upstream_error(self):
+        with requests_mock.Mocker() as m:
+            m.get('https://commons.wikimedia.org/w/api.php?action=query&prop=imageinfo',
+                  json={"error": {"code": "maxlag", "info": "Waiting for a database server"}})
+            response = self.app.get('/en/api?queries={}'.format(json.dumps(self.file_not_found)), follow_redirects=True)
+            results = json.loads(response.data.decode('utf-8'))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("maxlag", results["message"])
+
+
     def test_extend_with_no_parameters(self):
         response = self.app.get('/en/api?extend={}'.format(json.dumps({})), follow_redirects=True)
         response_data = json.loads(response.data.decode('utf8'))
@@ -190,14 +228,98 @@ class TestApi(unittest.TestCase):
                   text=self.wd_entity_label_data_2)
             m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&ids=P180&format=json",
                   text=self.test_wd_properties_data)
-            m.get("https://commons.wikimedia.org/w/api.php?action=parse&format=json&pageid=74698470&prop=wikitext",
-                  text=self.commons_wikitext_data)
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&format=json&prop=revisions&rvprop=content&rvslots=main&pageids=74698470",
+                  text=self.commons_revisions_wikitext_data)
 
             response = self.app.get('/en/api?extend={}'.format(json.dumps(self.extend_data)), follow_redirects=True)
             response_data = json.loads(response.data.decode('utf8'))
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response_data['meta'], json.loads(self.extend_data_result)['meta'])
         self.assertEqual(response_data['rows']['M74698470']['P180'], json.loads(self.extend_data_result)['rows']['M74698470']['P180'])
+        self.assertEqual(response_data['rows']['M74698470']['wikitext'], json.loads(self.extend_data_result)['rows']['M74698470']['wikitext'])
+
+
+    def test_extend_streams_rows_of_many_batches(self):
+        extend_ids = ["M" + str(i) for i in range(1, 61)]
+        extend_caption_data = {"ids": extend_ids, "properties": [{"id": "Cen"}]}
+        captions_data = json.dumps({"entities": {
+            media_id: {"labels": {"en": {"language": "en", "value": "Caption " + media_id}}} for media_id in extend_ids}})
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities&format=json&languages=en",
+                  text=captions_data)
+
+            response = self.app.get('/en/api?extend={}'.format(json.dumps(extend_caption_data)), follow_redirects=True)
+            response_data = json.loads(response.data.decode('utf8'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(list(response_data['rows'].keys()), extend_ids)
+        self.assertEqual(response_data['rows']['M60'], {"Cen": [{"str": "Caption M60"}]})
+
+
+    def test_extend_reports_failure_of_later_batch_in_rows(self):
+        extend_ids = ["M" + str(i) for i in range(1, 61)]
+        extend_data = {"ids": extend_ids, "properties": [{"id": "P180"}]}
+
+        def entities_callback(request, context):
+            ids = request.qs["ids"][0].split("|")
+            return {"entities": {id: {"statements": {"P180": [{"mainsnak": {"datavalue": {
+                "type": "wikibase-entityid", "value": {"id": "Q" + id[1:]}}}}]}} for id in ids}}
+
+        def labels_callback(request, context):
+            if "Q60" in request.qs["ids"][0].split("|"):
+                raise requests.exceptions.ConnectionError("Connection reset")
+            return {"entities": {id: {"labels": {"en": {"language": "en", "value": "Item " + id}}}
+                                 for id in request.qs["ids"][0].split("|")}}
+
+        with requests_mock.Mocker(case_sensitive=True) as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities", json=entities_callback)
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&ids=P180", text=self.test_wd_properties_data)
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&languages=en&props=labels", json=labels_callback)
+
+            response = self.app.get('/en/api?extend={}'.format(json.dumps(extend_data)), follow_redirects=True)
+            response_data = json.loads(response.data.decode('utf8'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(list(response_data['rows'].keys()), extend_ids)
+        self.assertEqual(response_data['rows']['M1']['P180'], [{"id": "Q1", "name": "Item Q1"}])
+        self.assertEqual(response_data['rows']['M60']['P180'], [])
+        self.assertEqual(response_data['rows']['M60']['error']['code'], "upstream-error")
+
+
+    def test_extend_with_invalid_id(self):
+        def entities_callback(request, context):
+            ids = request.qs["ids"][0].upper().split("|")
+            if "M0" in ids:
+                return {"error": {"code": "no-such-entity", "info": "Could not find an entity with the ID \"M0\".", "id": "M0"}}
+            return {"entities": {id: {"labels": {"en": {"language": "en", "value": "Caption " + id}}} for id in ids}}
+
+        extend_caption_data = {"ids": ["M1", "M0"], "properties": [{"id": "Cen"}]}
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities&format=json&languages=en", json=entities_callback)
+
+            response = self.app.get('/en/api?extend={}'.format(json.dumps(extend_caption_data)), follow_redirects=True)
+            response_data = json.loads(response.data.decode('utf8'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response_data['rows']['M1'], {"Cen": [{"str": "Caption M1"}]})
+        self.assertEqual(response_data['rows']['M0']['Cen'], [])
+        self.assertEqual(response_data['rows']['M0']['error']['code'], "no-such-entity")
+
+
+    def test_extend_with_invalid_first_batch(self):
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities&format=json&languages=en&ids=M1",
+                  text="""{"entities": {"M1": {"statements": {"P180": [{"mainsnak": {"datavalue": {"type": "wikibase-entityid"}}}]}}}}""")
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&ids=P180&format=json",
+                  text=self.test_wd_properties_data)
+
+            response = self.app.get('/en/api?extend={}'.format(json.dumps({"ids": ["M1"], "properties": [{"id": "P180"}]})),
+                                    follow_redirects=True)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.data.decode('utf8'))["status"], "error")
 
 
     def test_suggest_properties_with_true_params(self):
@@ -224,10 +346,26 @@ class TestApi(unittest.TestCase):
             response = self.app.get('/en/api?extend={}'.format(json.dumps(self.extend_caption_data)), follow_redirects=True)
             response_data = json.loads(response.data.decode('utf8'))
             self.assertEqual(response.status_code, 200)
+            self.assertEqual(m.call_count, 1)
             self.assertEqual(response_data['meta'], json.loads(self.caption_extend_data_result)['meta'])
             self.assertEqual(response_data['rows'], json.loads(self.caption_extend_data_result)['rows'])
 
 
+    def test_extend_for_captions_in_many_languages(self):
+        extend_caption_data = {"ids": ["M86236603"], "properties": [{"id": "Cen"}, {"id": "Cfr"}, {"id": "Cde"}]}
+        captions_data = """{"entities":{"M86236603":{"labels":{"en":{"language":"en","value":"World map"},"fr":{"language":"fr","value":"Carte du monde"}}}}}"""
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities&format=json&languages=en|fr|de&ids=M86236603",
+                  text=captions_data)
+
+            response = self.app.get('/en/api?extend={}'.format(json.dumps(extend_caption_data)), follow_redirects=True)
+            response_data = json.loads(response.data.decode('utf8'))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(response_data['rows'], {"M86236603": {"Cen": [{"str": "World map"}], "Cfr": [{"str": "Carte du monde"}], "Cde": []}})
+
+
     def test_get_entity_suggest(self):
         with requests_mock.Mocker() as m:
             m.get("https://commons.wikimedia.org/w/api.php?action=query&list=search&srsearch=food&srnamespace=6&srlimit=10&format=json",
@@ -251,6 +389,19 @@ class TestApi(unittest.TestCase):
         self.assertEqual(response.data.decode("utf-8") , self.sample_media_preview_result)
 
 
+    def test_preview_media_file_from_cache(self):
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&pageids=317966&format=json&prop=imageinfo&iiprop=url%7Csize",
+                  text=self.media_preview_mock_data)
+
+            self.app.get("/en/api/preview?id=M317966", follow_redirects=True)
+            response = self.app.get("/en/api/preview?id=M317966", follow_redirects=True)
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data.decode("utf-8"), self.sample_media_preview_result)
+
+
     def test_preview_media_file_audio(self):
         with requests_mock.Mocker() as m:
             m.get("https://commons.wikimedia.org/w/api.php?action=query&pageids=112471826&format=json&prop=imageinfo&iiprop=url%7Csize",
@@ -283,5 +434,49 @@ class TestApi(unittest.TestCase):
         self.assertEqual(response_data, json.loads(self.properties_suggest_result))
 
 
+    def test_suggest_properties_not_modified(self):
+        with requests_mock.Mocker() as m:
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&format=json&languages=en&props=labels&ids=P180|P6243|P921|P170|P571|P1071|P195|P7482|P6216|P275|P1259",
+                  text=self.properties_suggest_mock_data)
+            etag = self.app.get('en/api/properties?type=', follow_redirects=True).headers['ETag']
+            response = self.app.get('en/api/properties?type=', headers={'If-None-Match': etag}, follow_redirects=True)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertIn('max-age=' + str(app.config['HTTP_CACHE_MAX_AGE']['properties']), response.headers['Cache-Control'])
+
+
+    def test_preview_media_file_not_modified(self):
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&pageids=317966&format=json&prop=imageinfo&iiprop=url%7Csize",
+                  text=self.media_preview_mock_data)
+            etag = self.app.get("/en/api/preview?id=M317966", follow_redirects=True).headers['ETag']
+            response = self.app.get("/en/api/preview?id=M317966", headers={'If-None-Match': etag}, follow_redirects=True)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+
+
+    def test_preview_media_files_batch(self):
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&pageids=317966|404&format=json&prop=imageinfo&iiprop=url%7Csize",
+                  text=self.media_preview_mock_data)
+            response = self.app.get("/en/api/preview/batch?ids=M317966|M404", follow_redirects=True)
+            preview_response = self.app.get("/en/api/preview?id=M317966", follow_redirects=True)
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data.decode("utf-8")),
+                         {"previews": {"M317966": self.sample_media_preview_result, "M404": None}})
+        self.assertEqual(preview_response.data.decode("utf-8"), self.sample_media_preview_result)
+
+
+    def test_preview_media_files_batch_too_many_ids(self):
+        ids = "|".join("M" + str(i) for i in range(app.config["PREVIEW_BATCH_MAX"] + 1))
+        response = self.app.post("/en/api/preview/batch", data={"ids": ids})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.data.decode("utf-8"))["error"], "error")
+
+
 if __name__ == '__main__':
     unittest.main()
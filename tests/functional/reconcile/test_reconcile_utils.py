@@ -10,7 +10,9 @@ import requests_mock
 import json
 
 from service import app
-from service.commons.commons import make_api_request, get_page_wikitext, get_media_preview_data
+from service.wikidata.wikidata import label_cache
+from service.commons.commons import make_api_request, make_commons_search, get_pages_wikitext, get_media_preview_data, \
+    get_media_titles_from_ids, get_media_previews_data, CommonsApiError
 from service.reconcile import handlefile
 from service.reconcile import processresults, media_preview
 
@@ -19,6 +21,8 @@ class TestApiUtils(unittest.TestCase):
     """Test utility functions in the api blueprint."""
 
     def setUp(self):
+        label_cache.clear()
+
 
         self.fake_arbitrary_data = """
         {"file": "SomeFIle.png"}
@@ -65,7 +69,7 @@ class TestApiUtils(unittest.TestCase):
             }
         }
 
-        self.query_string = handlefile.extract_file_names(self.fake_query)
+        self.query_string = handlefile.join_file_names(handlefile.build_query_index(self.fake_query))
 
         self.fake_queries = {
             "q0": {
@@ -195,6 +199,9 @@ class TestApiUtils(unittest.TestCase):
         self.commons_wikitext_data = """
         {"parse":{"title":"File:Chick Corea & Stanley Clarke.jpg","pageid":74698470,"wikitext":{"*":"== {{int:filedesc}} =="}}}
         """
+        self.commons_revisions_wikitext_data = """
+        {"batchcomplete":"","query":{"pages":{"74698470":{"pageid":74698470,"ns":6,"title":"File:Chick Corea & Stanley Clarke.jpg","revisions":[{"slots":{"main":{"contentmodel":"wikitext","contentformat":"text/x-wiki","*":"== {{int:filedesc}} =="}}}]}}}}
+        """
         self.extend_rows_info_data = """
         {"M74698470":{"P180": [{"id": "Q192465","name": "Chick Corea"},{"id": "Q453406","name": "Stanley Clarke"}],"wikitext": ["== {{int:filedesc}} =="]}}
         """
@@ -216,7 +223,8 @@ class TestApiUtils(unittest.TestCase):
         self.entity_suggest_sample_result = """{"result":[{"id":"M60008323","name": "File:Parboiled rice with chicken, peppers, cucurbita, peas and tomato.jpg"}]}"""
 
         self.media_preview_mock_data = """{"query": {"pages": {"317966": {"title": "File:Commons-logo.svg","imageinfo": [{"size": 932,"width": 1024,"height": 1376,"url": "https://upload.wikimedia.org/wikipedia/commons/4/4a/Commons-logo.svg"}]}}}}"""
-        self.media_preview_sample_data = """{"title": "File:Commons-logo.svg", "url": "https://upload.wikimedia.org/wikipedia/commons/4/4a/Commons-logo.svg", "width": "1024", "height": "1376", "size": 932}"""
+        self.media_preview_thumb_mock_data = """{"query": {"pages": {"317966": {"title": "File:Commons-logo.svg","imageinfo": [{"size": 932,"width": 1024,"height": 1376,"thumburl": "https://upload.wikimedia.org/wikipedia/commons/thumb/4/4a/Commons-logo.svg/37px-Commons-logo.svg.png","thumbwidth": 37,"thumbheight": 50,"url": "https://upload.wikimedia.org/wikipedia/commons/4/4a/Commons-logo.svg"}]}}}}"""
+        self.media_preview_sample_data = """{"title": "File:Commons-logo.svg", "url": "https://upload.wikimedia.org/wikipedia/commons/4/4a/Commons-logo.svg", "thumb_url": null, "width": "1024", "height": "1376", "size": 932}"""
 
 
         self.sample_media_preview_result = """<div width='1024' height='100px' style='position: fixed; overflow:hidden; width:400px'> <span style='float: left'><img style='padding-right: 5px' src=https://upload.wikimedia.org/wikipedia/commons/4/4a/Commons-logo.svg width=100                 height=50 style='float: left'></span><span style='float: left; margin-top: -10px'><p style='color: #11c; font-weight: bold; position: fixed; font-size: 10px; font-family: Arial, sans-serif'>File:Commons-logo.svg </p></span><span style='float: left; margin-top:20px'><p style='font-size: 10px;'>1024 x 1376; 932.0 B</p></span></div>"""
@@ -227,7 +235,7 @@ class TestApiUtils(unittest.TestCase):
         pass
 
 
-    def test_extract_file_names(self):
+    def test_join_file_names(self):
         self.assertEqual(self.query_string, "File:Commons-logo.svg")
 
 
@@ -246,6 +254,58 @@ class TestApiUtils(unittest.TestCase):
         self.assertEqual(fake_build_object, self.fake_page_not_found_result)
 
 
+    def test_build_query_results_with_duplicate_queries(self):
+        duplicate_queries = {
+            "q0": {"query": "File:Commons-logo.svg"},
+            "q1": {"query": "Commons-logo.svg"},
+            "q2": {"query": "File:Hudson Commons (95051).jpg"}
+        }
+        fake_build_objects = processresults.build_query_results(duplicate_queries, self.fake_pages)
+        self.assertEqual(fake_build_objects["q0"], self.fake_results["q0"])
+        self.assertEqual(fake_build_objects["q1"], self.fake_results["q0"])
+        self.assertEqual(fake_build_objects["q2"], self.fake_results["q1"])
+
+
+    def test_build_query_results_with_normalized_and_redirects(self):
+        queries = {
+            "q0": {"query": "File:Commons logo.svg"},
+            "q1": {"query": "File:Hudson Commons (95051).jpg"}
+        }
+        normalized = [{"from": "File:Commons logo.svg", "to": "File:Commons logo.SVG"}]
+        redirects = [{"from": "File:Commons logo.SVG", "to": "File:Commons-logo.svg"}]
+        fake_build_objects = processresults.build_query_results(queries, self.fake_pages, normalized, redirects)
+        self.assertEqual(fake_build_objects, self.fake_results)
+
+
+    def test_build_query_index(self):
+        query_index = handlefile.build_query_index({"q0": {"query": "Commons-logo.svg"}, "q1": {"query": "File:Commons-logo.svg"}})
+        self.assertEqual(query_index, {"File:Commons-logo.svg": ["q0", "q1"]})
+
+
+    def test_build_query_index_resolves_media_ids_in_batches(self):
+        queries = {"q" + str(i): {"query": "https://commons.wikimedia.org/entity/M" + str(1000 + i)} for i in range(120)}
+        queries["q120"] = {"query": "File:Commons-logo.svg"}
+
+        def pages_callback(request, context):
+            pages = {}
+            for page_id in request.qs["pageids"][0].split("|"):
+                if page_id == "1007":
+                    pages[page_id] = {"pageid": int(page_id), "missing": ""}
+                else:
+                    pages[page_id] = {"pageid": int(page_id), "ns": 6, "title": "File:Sample " + page_id + ".jpg"}
+            return {"query": {"pages": pages}}
+
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&format=json", json=pages_callback)
+            query_index = handlefile.build_query_index(queries)
+
+        self.assertEqual(m.call_count, 3)
+        self.assertEqual(query_index["File:Sample 1000.jpg"], ["q0"])
+        self.assertEqual(query_index[None], ["q7"])
+        self.assertEqual(query_index["File:Commons-logo.svg"], ["q120"])
+        self.assertEqual(len(query_index), 121)
+
+
     def test_build_query_result_object(self):
         query_result = processresults.build_query_result_object(self.fake_page["317966"])
         self.assertEqual(query_result, self.fake_query_result_object)
@@ -259,14 +319,79 @@ class TestApiUtils(unittest.TestCase):
         self.assertEqual(response, json.loads(self.test_api_request_data))
 
 
-    def test_get_page_wikitext(self):
-        media_id = "M74698470"
+    def test_make_commons_search_in_chunks(self):
+        titles = ["File:Sample " + str(i) + ".jpg" for i in range(120)]
+
+        def titles_callback(request, context):
+            pages = {}
+            for i, title in enumerate(request.qs["titles"][0].split("|")):
+                number = int(title.split(" ")[1].split(".")[0])
+                if number % 10 == 0:
+                    pages[str(-(i + 1))] = {"ns": 6, "title": title, "missing": ""}
+                else:
+                    pages[str(1000 + number)] = {"pageid": 1000 + number, "ns": 6, "title": title}
+            return {"query": {"pages": pages}}
+
         with requests_mock.Mocker() as m:
-            m.get("https://commons.wikimedia.org/w/api.php?action=parse&format=json&pageid=74698470&prop=wikitext",
-                  text=self.commons_wikitext_data)
-            response = get_page_wikitext(media_id)
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&prop=imageinfo", json=titles_callback)
+            pages = make_commons_search("|".join(titles))
 
-        self.assertEqual(response, json.loads(self.commons_wikitext_data)["parse"]["wikitext"]["*"])
+        chunk_sizes = sorted(len(request.qs["titles"][0].split("|")) for request in m.request_history)
+        self.assertEqual(chunk_sizes, [20, 50, 50])
+        self.assertEqual(len(pages), 120)
+        self.assertEqual(len([page for page in pages.values() if "missing" in page]), 12)
+
+
+    def test_commons_api_errors_are_raised(self):
+        error = {"error": {"code": "maxlag", "info": "Waiting for a database server"}}
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=query", json=error)
+            for request, argument in ((make_commons_search, "File:Sample.jpg"), (get_media_titles_from_ids, ["1"]),
+                                      (get_pages_wikitext, ["M1"]), (get_media_previews_data, ["M1"])):
+                with self.assertRaises(CommonsApiError) as context:
+                    request(argument)
+                self.assertEqual(context.exception.code, "maxlag")
+
+
+    def test_get_pages_wikitext(self):
+        media_ids = ["M" + str(i) for i in range(1, 76)]
+
+        def revisions_callback(request, context):
+            pages = {}
+            for page_id in request.qs["pageids"][0].split("|"):
+                if page_id == "5":
+                    pages[page_id] = {"pageid": int(page_id), "missing": ""}
+                else:
+                    pages[page_id] = {"pageid": int(page_id), "revisions": [{"slots": {"main": {"*": "wikitext " + page_id}}}]}
+            return {"query": {"pages": pages}}
+
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&prop=revisions", json=revisions_callback)
+            response = get_pages_wikitext(media_ids)
+
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(response["M1"], "wikitext 1")
+        self.assertEqual(response["M75"], "wikitext 75")
+        self.assertIsNone(response["M5"])
+
+
+    def test_get_pages_wikitext_follows_continuation(self):
+        def revisions_callback(request, context):
+            if "rvcontinue" not in request.qs:
+                return {"continue": {"rvcontinue": "2|102", "continue": "||"}, "query": {"pages": {
+                    "1": {"pageid": 1, "revisions": [{"slots": {"main": {"*": "wikitext 1"}}}]},
+                    "2": {"pageid": 2}}}}
+            return {"batchcomplete": "", "query": {"pages": {
+                "1": {"pageid": 1},
+                "2": {"pageid": 2, "revisions": [{"slots": {"main": {"*": "wikitext 2"}}}]}}}}
+
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&prop=revisions", json=revisions_callback)
+            response = get_pages_wikitext(["M1", "M2"])
+
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(m.request_history[1].qs["rvcontinue"], ["2|102"])
+        self.assertEqual(response, {"M1": "wikitext 1", "M2": "wikitext 2"})
 
 
     def test_build_row_data(self):
@@ -289,31 +414,42 @@ class TestApiUtils(unittest.TestCase):
         self.assertEqual(json.loads(self.result_for_geocordinates), processresults.build_dataset_values({}, json.loads(self.extend_data_geocordinates_test)))
 
 
-    def test_build_extend_result(self):
+    def test_build_extend_stream(self):
         with requests_mock.Mocker() as m:
             m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities&format=json&languages=en&ids=M74698470",
                   text=self.test_wmc_properties_data)
-            m.get("https://commons.wikimedia.org/w/api.php?action=parse&format=json&pageid=74698470&prop=wikitext",
-                  text=self.commons_wikitext_data)
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&format=json&prop=revisions&rvprop=content&rvslots=main&pageids=74698470",
+                  text=self.commons_revisions_wikitext_data)
             m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&ids=Q192465|Q453406&format=json&languages=en&props=labels",
                   text=self.wd_entity_label_data_2)
             m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&ids=P180&format=json",
                   text=self.test_wd_properties_data)
 
-            extend_result = processresults.build_extend_result(json.loads(self.extend_data), self.test_lang)
+            extend_stream = processresults.build_extend_stream(json.loads(self.extend_data), self.test_lang)
+            self.assertEqual(m.call_count, 4)
+            chunks = list(extend_stream)
 
+        extend_result = json.loads("".join(chunks))
+        self.assertEqual(len(chunks), 3)
         self.assertEqual(extend_result["meta"], json.loads(self.extend_data_result)["meta"])
         self.assertEqual(extend_result["rows"]["M74698470"]["P180"], json.loads(self.extend_data_result)["rows"]["M74698470"]["P180"])
 
 
+    def test_stream_extend_json(self):
+        chunks = list(processresults.stream_extend_json([{"id": "Cen"}], iter([{"M1": {"Cen": []}}, {}, {"M2": {"Cen": []}}])))
+
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(json.loads("".join(chunks)), {"meta": [{"id": "Cen"}], "rows": {"M1": {"Cen": []}, "M2": {"Cen": []}}})
+
+
     def test_build_extend_rows_info(self):
         extend_ids = ["M74698470"]
 
         with requests_mock.Mocker() as m:
             m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities&format=json&languages=en&ids=M74698470",
                   text=self.test_wmc_properties_data)
-            m.get("https://commons.wikimedia.org/w/api.php?action=parse&format=json&pageid=74698470&prop=wikitext",
-                  text=self.commons_wikitext_data)
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&format=json&prop=revisions&rvprop=content&rvslots=main&pageids=74698470",
+                  text=self.commons_revisions_wikitext_data)
             m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&ids=Q192465|Q453406&format=json&languages=en&props=labels",
                   text=self.wd_entity_label_data_2)
 
@@ -321,14 +457,119 @@ class TestApiUtils(unittest.TestCase):
 
         self.assertEqual(response["M74698470"]["P180"], json.loads(self.extend_rows_info_data)["M74698470"]["P180"])
 
-    def test_find_best_match_for_match(self):
-        match_result = handlefile.find_best_match_file(['File:Commons-logo.svg'], "File:Commons-logo.svg")
-        self.assertEqual(match_result, "File:Commons-logo.svg")
+    def test_get_property_batches(self):
+        extend_ids = ["M" + str(i) for i in range(1, 121)]
+
+        def entities_callback(request, context):
+            ids = request.qs["ids"][0].upper().split("|")
+            if "M60" in ids:
+                return {"error": {"code": "no-such-entity", "info": "Could not find an entity with the ID \"M60\"."}}
+            return {"entities": {id: {"id": id} for id in ids}}
+
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities", json=entities_callback)
+            response = processresults.get_property_batches(extend_ids, self.test_lang)
+
+        # The failed batch is bisected until M60 is fetched on its own
+        self.assertLessEqual(m.call_count, 3 + 2 * 6)
+        self.assertEqual(list(response["entities"].keys()), [id for id in extend_ids if id != "M60"])
+        self.assertEqual(list(response["errors"].keys()), ["M60"])
+        self.assertEqual(response["errors"]["M60"]["code"], "no-such-entity")
+
+
+    def test_get_property_batches_drops_id_named_by_error(self):
+        extend_ids = ["M" + str(i) for i in range(1, 51)]
 
+        def entities_callback(request, context):
+            ids = request.qs["ids"][0].upper().split("|")
+            if "M7" in ids:
+                return {"error": {"code": "no-such-entity", "info": "Could not find an entity with the ID \"M7\".", "id": "M7"}}
+            return {"entities": {id: {"id": id} for id in ids}}
 
-    def test_find_best_match_for_no_match(self):
-        match_result = handlefile.find_best_match_file(['File:Commons-logo.svg'], self.file_not_found["q0"]["query"])
-        self.assertEqual(match_result, self.file_not_found["q0"]["query"])
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities", json=entities_callback)
+            response = processresults.get_property_batches(extend_ids, self.test_lang)
+
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(len(response["entities"]), 49)
+        self.assertEqual(list(response["errors"].keys()), ["M7"])
+
+
+    def test_get_property_batches_does_not_bisect_upstream_errors(self):
+        extend_ids = ["M" + str(i) for i in range(1, 51)]
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities",
+                  json={"error": {"code": "maxlag", "info": "Waiting for a database server"}})
+            response = processresults.get_property_batches(extend_ids, self.test_lang)
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(len(response["errors"]), 50)
+
+
+    def test_get_property_batches_does_not_bisect_server_errors(self):
+        extend_ids = ["M" + str(i) for i in range(1, 51)]
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities",
+                  json={"error": {"code": "internal_api_error_DBQueryError", "info": "A database query error has occurred."}})
+            with self.assertLogs(app.logger, "WARNING") as logs:
+                response = processresults.get_property_batches(extend_ids, self.test_lang)
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(len(response["errors"]), 50)
+        # The warning counts the failed ids and names only a few of them
+        self.assertIn("50 ids", logs.output[0])
+        self.assertNotIn("M50", logs.output[0])
+
+
+    def test_build_extend_rows_info_reports_failed_ids(self):
+        def entities_callback(request, context):
+            ids = request.qs["ids"][0].upper().split("|")
+            if "M2" in ids:
+                return {"error": {"code": "no-such-entity", "info": "Could not find an entity with the ID \"M2\"."}}
+            return {"entities": {id: {"id": id, "statements": {"P6790": [
+                {"mainsnak": {"datavalue": {"value": {"amount": "+1.9"}, "type": "quantity"}}}]}} for id in ids}}
+
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities", json=entities_callback)
+            response = processresults.build_extend_rows_info(["M1", "M2", "M3"], [{"id": "P6790"}], self.test_lang)
+
+        self.assertEqual(response["M1"], {"P6790": [{"str": "+1.9"}]})
+        self.assertEqual(response["M2"]["P6790"], [])
+        self.assertEqual(response["M2"]["error"]["code"], "no-such-entity")
+        self.assertEqual(response["M3"], {"P6790": [{"str": "+1.9"}]})
+
+
+    def test_build_extend_rows_info_resolves_labels_once(self):
+        extend_ids = ["M1", "M2", "M3"]
+        extend_properties = [{"id": "P180"}, {"id": "P170"}]
+
+        def item_statement(item_id):
+            return {"mainsnak": {"datavalue": {"value": {"id": item_id}, "type": "wikibase-entityid"}}}
+
+        entities_data = {"entities": {
+            "M1": {"statements": {"P180": [item_statement("Q5"), item_statement("Q42")], "P170": [item_statement("Q42")]}},
+            "M2": {"statements": {"P180": [item_statement("Q5")]}},
+            "M3": {"statements": {"P170": [item_statement("Q7")]}}
+        }}
+        labels_data = {"entities": {
+            "Q5": {"id": "Q5", "labels": {"en": {"language": "en", "value": "human"}}},
+            "Q42": {"id": "Q42", "labels": {"en": {"language": "en", "value": "Douglas Adams"}}},
+            "Q7": {"id": "Q7", "labels": {}}
+        }}
+
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=wbgetentities&format=json&languages=en&ids=M1|M2|M3",
+                  json=entities_data)
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&ids=Q5|Q42|Q7&props=labels",
+                  json=labels_data)
+
+            response = processresults.build_extend_rows_info(extend_ids, extend_properties, self.test_lang)
+
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(response["M1"]["P180"], [{"id": "Q5", "name": "human"}, {"id": "Q42", "name": "Douglas Adams"}])
+        self.assertEqual(response["M1"]["P170"], [{"id": "Q42", "name": "Douglas Adams"}])
+        self.assertEqual(response["M2"], {"P180": [{"id": "Q5", "name": "human"}], "P170": []})
+        self.assertEqual(response["M3"]["P170"], [{"id": "Q7", "name": "Q7"}])
 
 
     def test_check_query_file_type_link(self):
@@ -382,6 +623,26 @@ class TestApiUtils(unittest.TestCase):
         self.assertEqual(preview_media_data, json.loads(self.media_preview_sample_data))
 
 
+    def test_get_media_preview_data_thumbnail(self):
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&pageids=317966&format=json&prop=imageinfo&iiprop=url%7Csize&iiurlwidth=100&iiurlheight=50",
+                  text=self.media_preview_thumb_mock_data)
+            preview_media_data = media_preview.get_media_preview_data('M317966')
+
+        self.assertEqual(preview_media_data["url"], "https://upload.wikimedia.org/wikipedia/commons/4/4a/Commons-logo.svg")
+        self.assertEqual(preview_media_data["thumb_url"], "https://upload.wikimedia.org/wikipedia/commons/thumb/4/4a/Commons-logo.svg/37px-Commons-logo.svg.png")
+
+
+    def test_get_media_previews_data(self):
+        with requests_mock.Mocker() as m:
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&pageids=317966|404&format=json&prop=imageinfo&iiprop=url%7Csize",
+                  text=self.media_preview_mock_data)
+            previews_data = media_preview.get_media_previews_data(['M317966', 'M404'])
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(previews_data, {"M317966": json.loads(self.media_preview_sample_data), "M404": None})
+
+
     def test_convert_size(self):
         converted_size = media_preview.convert_size(932)
         self.assertEqual(converted_size, "932.0 B")
@@ -395,6 +656,13 @@ class TestApiUtils(unittest.TestCase):
                                                                   str(preview_height), file_width="1024", file_height="1376", file_size=932)
         self.assertEqual(expected_dom, self.sample_media_preview_result)
 
+    def test_build_preview_file_from_type_escapes_title(self):
+        sample_test_url = "https://upload.wikimedia.org/wikipedia/commons/4/4a/Commons-logo.svg"
+        expected_dom = media_preview.build_preview_file_from_type(sample_test_url, "File:<b>Logo</b>.svg", "100", "50",
+                                                                  file_width="1024", file_height="1376", file_size=932)
+        self.assertIn("File:&lt;b&gt;Logo&lt;/b&gt;.svg", expected_dom)
+
+
     def test_build_preview_file_from_type_audio(self):
         preview_width = app.config["MEDIA_PREV_W"]
         preview_height = app.config["MEDIA_PREV_H"]
@@ -415,5 +683,24 @@ class TestApiUtils(unittest.TestCase):
         self.assertEqual(expected_dom, self.sample_media_video_preview_result)
 
 
+    def test_build_preview_file_from_type_image_thumbnail(self):
+        sample_test_url = "https://upload.wikimedia.org/wikipedia/commons/4/4a/Commons-logo.svg"
+        sample_thumb_url = "https://upload.wikimedia.org/wikipedia/commons/thumb/4/4a/Commons-logo.svg/37px-Commons-logo.svg.png"
+        expected_dom = media_preview.build_preview_file_from_type(sample_test_url, "File:Commons-logo.svg", "100", "50",
+                                                                  file_width="1024", file_height="1376", file_size=932,
+                                                                  thumb_url=sample_thumb_url)
+        self.assertEqual(expected_dom, self.sample_media_preview_result.replace(sample_test_url, sample_thumb_url))
+
+
+    def test_build_preview_file_from_type_video_poster(self):
+        sample_test_url = "https://upload.wikimedia.org/wikipedia/commons/f/f1/Aljazeeraasset-WarOnGazaDay18793.ogv"
+        sample_thumb_url = "https://upload.wikimedia.org/wikipedia/commons/thumb/f/f1/Aljazeeraasset-WarOnGazaDay18793.ogv/63px--Aljazeeraasset-WarOnGazaDay18793.ogv.jpg"
+        expected_dom = media_preview.build_preview_file_from_type(sample_test_url, "File:Aljazeeraasset-WarOnGazaDay18793.ogv", "100", "50",
+                                                                  file_width="720", file_height="576", file_size=84801115,
+                                                                  thumb_url=sample_thumb_url)
+        self.assertIn("poster=" + sample_thumb_url + " preload='none' controls>", expected_dom)
+        self.assertIn("<source src=" + sample_test_url + " ", expected_dom)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+
+# Unit tests for the retries and circuit breakers of upstream requests of the reconciliation service
+
+
+import json
+import time
+import unittest
+from unittest import mock
+
+import requests
+import requests_mock
+
+from service import app
+from service.commons.commons import make_api_request
+from service.upstream import breaker, upstream
+
+
+class TestBreaker(unittest.TestCase):
+    """Test the retries and circuit breakers of upstream requests."""
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        self.sample_arbitrary_url = "https://breaker.test/path"
+        self.circuit_breakers = breaker.CircuitBreakers(3, 30)
+        patcher = mock.patch.object(upstream, "get_circuit_breakers", return_value=self.circuit_breakers)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+    def test_breaker_opens_after_threshold_failures(self):
+        host_breaker = breaker.CircuitBreaker("breaker.test", 2, 30)
+        host_breaker.record_failure()
+        host_breaker.check()
+        host_breaker.record_failure()
+
+        self.assertEqual(host_breaker.state(), "open")
+        with self.assertRaises(breaker.UpstreamUnavailable):
+            host_breaker.check()
+
+
+    def test_breaker_lets_one_trial_request_through_after_cooldown(self):
+        host_breaker = breaker.CircuitBreaker("breaker.test", 1, 0.05)
+        host_breaker.record_failure()
+        time.sleep(0.06)
+
+        host_breaker.check()
+        self.assertEqual(host_breaker.state(), "half-open")
+        with self.assertRaises(breaker.UpstreamUnavailable):
+            host_breaker.check()
+
+        host_breaker.record_success()
+        self.assertEqual(host_breaker.state(), "closed")
+
+
+    def test_failed_trial_request_opens_breaker_again(self):
+        host_breaker = breaker.CircuitBreaker("breaker.test", 3, 0.05)
+        for _ in range(3):
+            host_breaker.record_failure()
+        time.sleep(0.06)
+
+        host_breaker.check()
+        host_breaker.record_failure()
+        self.assertEqual(host_breaker.state(), "open")
+
+
+    def test_unreported_trial_request_is_let_through_again(self):
+        host_breaker = breaker.CircuitBreaker("breaker.test", 1, 0.05)
+        host_breaker.record_failure()
+        time.sleep(0.06)
+        host_breaker.check()
+
+        time.sleep(0.06)
+        host_breaker.check()
+        self.assertEqual(host_breaker.state(), "half-open")
+
+
+    def test_failed_trial_request_reports_to_breaker(self):
+        host_breaker = self.circuit_breakers.get("breaker.test")
+        host_breaker.threshold = 1
+        host_breaker.cooldown = 0.05
+        host_breaker.record_failure()
+        time.sleep(0.06)
+
+        with requests_mock.Mocker() as m:
+            m.get(self.sample_arbitrary_url, exc=requests.exceptions.TooManyRedirects)
+            with self.assertRaises(requests.exceptions.TooManyRedirects):
+                upstream.get(self.sample_arbitrary_url, {})
+            time.sleep(0.06)
+            m.get(self.sample_arbitrary_url, json={"fetch": "file.jpg"})
+            response = upstream.get(self.sample_arbitrary_url, {})
+
+        self.assertEqual(response.json(), {"fetch": "file.jpg"})
+        self.assertEqual(host_breaker.state(), "closed")
+
+
+    def test_trial_request_timing_out_in_limiter_is_given_back(self):
+        host_breaker = self.circuit_breakers.get("breaker.test")
+        host_breaker.threshold = 1
+        host_breaker.record_failure()
+        host_breaker.opened_at -= host_breaker.cooldown
+
+        with mock.patch.object(upstream.ratelimit.HostLimiter, "acquire", return_value=False):
+            with self.assertRaises(requests.exceptions.Timeout):
+                upstream.get(self.sample_arbitrary_url, {})
+
+        self.assertEqual(host_breaker.state(), "open")
+        host_breaker.check()
+        self.assertEqual(host_breaker.state(), "half-open")
+
+
+    def test_transient_failures_are_retried(self):
+        with requests_mock.Mocker() as m:
+            m.get(self.sample_arbitrary_url, [
+                {"exc": requests.exceptions.ConnectTimeout},
+                {"status_code": 502, "text": "Bad Gateway"},
+                {"json": {"fetch": "file.jpg"}}
+            ])
+            data = make_api_request(self.sample_arbitrary_url, {"fetch": "file.jpg"})
+
+        self.assertEqual(m.call_count, 3)
+        self.assertEqual(data, {"fetch": "file.jpg"})
+        self.assertEqual(self.circuit_breakers.stats()["breaker.test"], {"state": "closed", "failures": 0})
+
+
+    def test_unavailable_host_is_a_failure(self):
+        with requests_mock.Mocker() as m:
+            m.get(self.sample_arbitrary_url, status_code=503, text="Service Unavailable")
+            response = upstream.get(self.sample_arbitrary_url, {})
+
+        self.assertEqual(m.call_count, app.config["UPSTREAM_RETRIES"] + 1)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(self.circuit_breakers.stats()["breaker.test"]["state"], "open")
+
+
+    def test_unavailable_host_with_retry_after_is_throttling(self):
+        with requests_mock.Mocker() as m:
+            m.get(self.sample_arbitrary_url, [
+                {"status_code": 503, "text": "Service Unavailable", "headers": {"Retry-After": "0"}},
+                {"json": {"fetch": "file.jpg"}}
+            ])
+            response = upstream.get(self.sample_arbitrary_url, {})
+
+        self.assertEqual(response.json(), {"fetch": "file.jpg"})
+        self.assertEqual(self.circuit_breakers.stats()["breaker.test"], {"state": "closed", "failures": 0})
+
+
+    def test_retries_are_bounded(self):
+        with requests_mock.Mocker() as m:
+            m.get(self.sample_arbitrary_url, exc=requests.exceptions.ConnectionError)
+            with self.assertRaises(requests.exceptions.ConnectionError):
+                upstream.get(self.sample_arbitrary_url, {})
+
+        self.assertEqual(m.call_count, app.config["UPSTREAM_RETRIES"] + 1)
+        self.assertEqual(self.circuit_breakers.stats()["breaker.test"]["state"], "open")
+
+
+    def test_truncated_responses_are_retried(self):
+        with requests_mock.Mocker() as m:
+            m.get(self.sample_arbitrary_url, [
+                {"exc": requests.exceptions.ChunkedEncodingError},
+                {"json": {"fetch": "file.jpg"}}
+            ])
+            data = make_api_request(self.sample_arbitrary_url, {"fetch": "file.jpg"})
+
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(data, {"fetch": "file.jpg"})
+
+
+    def test_request_errors_release_the_host_limiter(self):
+        self.circuit_breakers.threshold = 0
+        with requests_mock.Mocker() as m:
+            m.get(self.sample_arbitrary_url, exc=requests.exceptions.ChunkedEncodingError)
+            for _ in range(3):
+                with self.assertRaises(requests.exceptions.ChunkedEncodingError):
+                    upstream.get(self.sample_arbitrary_url, {})
+            m.get(self.sample_arbitrary_url, exc=requests.exceptions.TooManyRedirects)
+            with self.assertRaises(requests.exceptions.TooManyRedirects):
+                upstream.get(self.sample_arbitrary_url, {})
+
+        self.assertEqual(m.call_count, 3 * (app.config["UPSTREAM_RETRIES"] + 1) + 1)
+        self.assertEqual(upstream.get_rate_limiter().stats()["breaker.test"]["in_flight"], 0)
+
+
+    def test_client_errors_are_not_retried(self):
+        with requests_mock.Mocker() as m:
+            m.get(self.sample_arbitrary_url, status_code=404, text="Not Found")
+            response = upstream.get(self.sample_arbitrary_url, {})
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(response.status_code, 404)
+
+
+    def test_retries_stop_at_deadline(self):
+        with requests_mock.Mocker() as m, mock.patch.dict(app.config, {"UPSTREAM_DEADLINE": 0.05, "UPSTREAM_RETRY_BACKOFF": 1}):
+            m.get(self.sample_arbitrary_url, status_code=504, text="Gateway Timeout")
+            start = time.monotonic()
+            response = upstream.get(self.sample_arbitrary_url, {})
+
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertEqual(response.status_code, 504)
+
+
+    def test_open_breaker_fails_fast(self):
+        for _ in range(3):
+            self.circuit_breakers.get("breaker.test").record_failure()
+        with requests_mock.Mocker() as m:
+            m.get(self.sample_arbitrary_url, json={})
+            with self.assertRaises(breaker.UpstreamUnavailable):
+                make_api_request(self.sample_arbitrary_url, {"fetch": "file.jpg"})
+
+        self.assertEqual(m.call_count, 0)
+
+
+    def test_reconcile_answers_503_while_upstream_unavailable(self):
+        for _ in range(3):
+            self.circuit_breakers.get("commons.wikimedia.org").record_failure()
+
+        queries = {"q0": {"query": "File:Commons-logo.svg"}}
+        response = self.app.get('/en/api?queries={}'.format(json.dumps(queries)), follow_redirects=True)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("commons.wikimedia.org", json.loads(response.data.decode("utf-8"))["message"])
+        self.assertEqual(response.headers["Retry-After"], "30")
+
+
+if __name__ == "__main__":
+    unittest.main()
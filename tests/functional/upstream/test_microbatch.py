@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+# Unit tests for the micro-batching of concurrent reconciliation requests
+
+
+import json
+import threading
+import unittest
+from unittest import mock
+
+import requests_mock
+
+from service import app
+from service.commons import commons
+from service.upstream import microbatch
+
+
+class TestMicroBatcher(unittest.TestCase):
+    """Test the merging of concurrent requests into full upstream calls."""
+
+    def setUp(self):
+        self.fetched = []
+        self.fetched_lock = threading.Lock()
+        self.batcher = microbatch.MicroBatcher(self.fetch, 50)
+
+    def tearDown(self):
+        pass
+
+
+    def fetch(self, items):
+        with self.fetched_lock:
+            self.fetched.append(items.split("|"))
+        return {"items": items.split("|")}
+
+
+    def submit_concurrently(self, requests, window):
+        results = {}
+
+        def submit(name, items):
+            results[name] = self.batcher.submit(items, window)
+
+        threads = [threading.Thread(target=submit, args=(name, items)) for name, items in requests.items()]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+
+    def test_concurrent_requests_are_merged(self):
+        requests = {"r" + str(i): ["File:" + str(i) + "-" + str(j) + ".jpg" for j in range(10)] for i in range(10)}
+        results = self.submit_concurrently(requests, 0.2)
+
+        self.assertEqual(sorted(len(items) for items in self.fetched), [50, 50])
+        for name, items in requests.items():
+            returned_items = [item for result in results[name] for item in result["items"]]
+            self.assertTrue(set(items) <= set(returned_items))
+
+
+    def test_large_request_is_split(self):
+        items = ["File:" + str(i) + ".jpg" for i in range(120)]
+        results = self.batcher.submit(items, 0)
+
+        self.assertEqual([len(items) for items in self.fetched], [50, 50, 20])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(self.batcher.stats(), {"batches": 3, "items": 120})
+
+
+    def test_duplicate_items_are_fetched_once(self):
+        self.batcher.submit(["File:A.jpg", "File:A.jpg", "File:B.jpg"], 0)
+        self.assertEqual(self.fetched, [["File:A.jpg", "File:B.jpg"]])
+
+
+    def test_errors_are_raised_to_every_waiting_request(self):
+        def failing_fetch(items):
+            raise ValueError("upstream failure")
+
+        self.batcher.fetch = failing_fetch
+        with self.assertRaises(ValueError):
+            self.batcher.submit(["File:A.jpg"], 0)
+
+
+    def test_make_commons_query_with_batch_window(self):
+        def titles_callback(request, context):
+            titles = request.qs["titles"][0].split("|")
+            return {"query": {"pages": {str(1000 + i): {"pageid": 1000 + i, "ns": 6, "title": title} for i, title in enumerate(titles)}}}
+
+        queries = {}
+
+        def query(name, titles):
+            queries[name] = commons.make_commons_query("|".join(titles))
+
+        requests = {"r" + str(i): ["file:" + str(i) + "-" + str(j) + ".jpg" for j in range(10)] for i in range(5)}
+        with requests_mock.Mocker() as m, mock.patch.dict(app.config, {"QUERY_BATCH_WINDOW_MS": 200}):
+            m.get("https://commons.wikimedia.org/w/api.php?action=query&prop=imageinfo", json=titles_callback)
+            threads = [threading.Thread(target=query, args=(name, titles)) for name, titles in requests.items()]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(m.call_count, 1)
+        for name, titles in requests.items():
+            returned_titles = [page["title"] for page in queries[name]["pages"].values()]
+            self.assertTrue(set(titles) <= set(returned_titles))
+
+
+if __name__ == "__main__":
+    unittest.main()
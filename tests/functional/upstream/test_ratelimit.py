@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+# Unit tests for the adaptive rate limiting of upstream requests of the reconciliation service
+
+
+import threading
+import time
+import unittest
+
+import requests_mock
+
+from service import app
+from service.commons.commons import make_api_request
+from service.upstream import ratelimit, upstream
+
+
+class TestRateLimit(unittest.TestCase):
+    """Test the rate limiter of the upstream hosts."""
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.sample_arbitrary_url = "https://ratelimit.test/path"
+        upstream.get_rate_limiter()._hosts.clear()
+
+
+    def test_concurrency_grows_while_requests_succeed(self):
+        limiter = ratelimit.HostLimiter(0, 1, 4)
+        self.assertEqual(limiter.stats()["concurrency"], 2)
+
+        for _ in range(10):
+            limiter.acquire()
+            limiter.release()
+
+        self.assertEqual(limiter.stats()["concurrency"], 4)
+
+
+    def test_concurrency_halved_once_per_throttle_signal(self):
+        limiter = ratelimit.HostLimiter(0, 1, 16)
+        for _ in range(2):
+            limiter.acquire()
+
+        limiter.release(retry_after=0.05)
+        limiter.release(retry_after=0.05)
+
+        self.assertEqual(limiter.stats(), {"concurrency": 4, "in_flight": 0, "throttled": 2})
+
+
+    def test_requests_wait_for_retry_after(self):
+        limiter = ratelimit.HostLimiter(0, 1, 4)
+        limiter.acquire()
+        limiter.release(retry_after=0.1)
+
+        start = time.monotonic()
+        limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+    def test_requests_wait_for_a_free_slot(self):
+        limiter = ratelimit.HostLimiter(0, 1, 2)
+        limiter.acquire()
+        threading.Timer(0.1, limiter.release).start()
+
+        start = time.monotonic()
+        limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+    def test_token_bucket_limits_request_rate(self):
+        limiter = ratelimit.HostLimiter(20, 1, 16)
+
+        start = time.monotonic()
+        for _ in range(3):
+            limiter.acquire()
+            limiter.release()
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+
+    def test_maxlag_sent_with_requests(self):
+        with requests_mock.Mocker() as m:
+            m.get(self.sample_arbitrary_url, json={})
+            make_api_request(self.sample_arbitrary_url, {"fetch": "file.jpg"})
+
+        self.assertEqual(m.request_history[0].qs["maxlag"], [str(app.config["UPSTREAM_MAXLAG"])])
+
+
+    def test_throttled_request_sent_again(self):
+        with requests_mock.Mocker() as m:
+            m.get(self.sample_arbitrary_url, [
+                {"json": {"error": {"code": "maxlag"}}, "headers": {"MediaWiki-API-Error": "maxlag", "Retry-After": "0"}},
+                {"json": {"fetch": "file.jpg"}}
+            ])
+            data = make_api_request(self.sample_arbitrary_url, {"fetch": "file.jpg"})
+
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(data, {"fetch": "file.jpg"})
+        self.assertEqual(upstream.get_rate_limiter().stats()["ratelimit.test"]["throttled"], 1)
+
+
+    def test_throttled_request_retries_are_bounded(self):
+        with requests_mock.Mocker() as m:
+            m.get(self.sample_arbitrary_url, status_code=429, json={"error": {"code": "ratelimited"}})
+            data = make_api_request(self.sample_arbitrary_url, {"fetch": "file.jpg"})
+
+        self.assertEqual(m.call_count, app.config["UPSTREAM_THROTTLE_RETRIES"] + 1)
+        self.assertEqual(data, {"error": {"code": "ratelimited"}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+# Unit tests for the coalescing of identical upstream requests
+
+
+import json
+import threading
+import time
+import unittest
+
+import requests_mock
+
+from service import app
+from service.commons.commons import make_api_request
+from service.upstream import singleflight, upstream
+
+
+class TestSingleFlight(unittest.TestCase):
+    """Test the coalescing of identical calls."""
+
+    def setUp(self):
+        self.flights = singleflight.SingleFlight()
+        self.app = app.test_client()
+
+    def tearDown(self):
+        pass
+
+
+    def call_concurrently(self, func, count):
+        results = []
+        errors = []
+
+        def call():
+            try:
+                results.append(func())
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results, errors
+
+
+    def test_identical_calls_are_collapsed(self):
+        calls = []
+
+        def slow_call():
+            calls.append(1)
+            time.sleep(0.05)
+            return {"result": "shared"}
+
+        results, errors = self.call_concurrently(lambda: self.flights.do("key", slow_call), 5)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [{"result": "shared"}] * 5)
+        self.assertEqual(self.flights.stats(), {"calls": 1, "collapsed": 4, "in_flight": 0})
+
+
+    def test_errors_are_shared(self):
+        def failing_call():
+            time.sleep(0.05)
+            raise ValueError("upstream failure")
+
+        results, errors = self.call_concurrently(lambda: self.flights.do("key", failing_call), 3)
+
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(self.flights.stats()["calls"], 1)
+
+
+    def test_sequential_calls_are_not_collapsed(self):
+        self.flights.do("key", lambda: 1)
+        self.flights.do("key", lambda: 2)
+        self.assertEqual(self.flights.stats(), {"calls": 2, "collapsed": 0, "in_flight": 0})
+
+
+    def test_make_api_request_collapses_identical_requests(self):
+        def slow_response(request, context):
+            time.sleep(0.05)
+            return {"fetch": "file.jpg"}
+
+        collapsed = upstream.upstream_flights.stats()["collapsed"]
+        with requests_mock.Mocker() as m:
+            m.get("https://test.com/path?action=fetch", json=slow_response)
+            results, errors = self.call_concurrently(
+                lambda: make_api_request("https://test.com/path", {"action": "fetch", "file": "file.jpg"}), 4)
+
+        self.assertEqual(m.call_count, 1)
+        self.assertEqual(results, [{"fetch": "file.jpg"}] * 4)
+        self.assertEqual(upstream.upstream_flights.stats()["collapsed"], collapsed + 3)
+
+
+    def test_stats_route(self):
+        response = self.app.get("/stats")
+        response_data = json.loads(response.data.decode("utf-8"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response_data["upstream"].keys()), {"calls", "collapsed", "in_flight"})
+        self.assertIn("hits", response_data["label_cache"])
+
+
+if __name__ == "__main__":
+    unittest.main()
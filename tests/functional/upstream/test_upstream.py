@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+# Unit tests for the shared upstream client of the reconciliation service
+
+
+import os
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import requests_mock
+
+from service import app
+from service.commons.commons import make_api_request
+from service.upstream import upstream
+
+
+class TestUpstream(unittest.TestCase):
+    """Test the shared upstream client."""
+
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.sample_arbitrary_url = "https://test.com/path"
+        self.test_api_request_data = """{"fetch": "file.jpg"}"""
+
+    def tearDown(self):
+        pass
+
+
+    def test_get_session_is_shared(self):
+        self.assertIs(upstream.get_session(), upstream.get_session())
+
+
+    def test_get_session_is_rebuilt_after_fork(self):
+        session = upstream.get_session()
+        with mock.patch("os.getpid", return_value=-1):
+            forked_session = upstream.get_session()
+        self.assertIsNot(session, forked_session)
+
+
+    def test_session_adapter_uses_configured_pool_size(self):
+        with mock.patch.dict(app.config, {"UPSTREAM_POOL_MAXSIZE": 20, "UPSTREAM_HOST_CONCURRENCY": 16}):
+            adapter = upstream.build_session().get_adapter("https://commons.wikimedia.org/w/api.php")
+        self.assertEqual(adapter._pool_maxsize, 20)
+        self.assertEqual(adapter._pool_connections, app.config["UPSTREAM_POOL_CONNECTIONS"])
+
+
+    def test_session_adapter_keeps_host_concurrency_alive(self):
+        with mock.patch.dict(app.config, {"UPSTREAM_POOL_MAXSIZE": 10, "UPSTREAM_HOST_CONCURRENCY": 16}):
+            adapter = upstream.build_session().get_adapter("https://commons.wikimedia.org/w/api.php")
+        self.assertEqual(adapter._pool_maxsize, 16)
+
+
+    def test_get_timeout(self):
+        self.assertEqual(upstream.get_timeout(), (app.config["UPSTREAM_CONNECT_TIMEOUT"], app.config["UPSTREAM_READ_TIMEOUT"]))
+
+
+    def test_make_api_request_uses_shared_session(self):
+        upstream.get_session()
+        with requests_mock.Mocker() as m, mock.patch.object(upstream, "build_session", wraps=upstream.build_session) as build:
+            m.get("https://test.com/path?action=fetch", text=self.test_api_request_data)
+            make_api_request(self.sample_arbitrary_url, {"action": "fetch"})
+            make_api_request(self.sample_arbitrary_url, {"action": "fetch"})
+
+        self.assertEqual(m.call_count, 2)
+        build.assert_not_called()
+        self.assertEqual(m.request_history[0].timeout, upstream.get_timeout())
+
+
+    def test_chunk(self):
+        self.assertEqual(upstream.chunk(list("abcde"), 2), [["a", "b"], ["c", "d"], ["e"]])
+        self.assertEqual(upstream.chunk(list("abcde"), 2, "|"), ["a|b", "c|d", "e"])
+        self.assertEqual(upstream.chunk([], 50, "|"), [])
+
+
+    def test_fan_out_keeps_order(self):
+        results = upstream.fan_out(lambda item: item * 2, [3, 1, 2])
+        self.assertEqual(results, [6, 2, 4])
+
+
+    def test_fan_out_respects_concurrency_ceiling(self):
+        in_flight = []
+        peak = []
+        lock = threading.Lock()
+
+        def track(item):
+            with lock:
+                in_flight.append(item)
+                peak.append(len(in_flight))
+            time.sleep(0.01)
+            with lock:
+                in_flight.remove(item)
+            return item
+
+        upstream.fan_out(track, list(range(20)))
+        self.assertLessEqual(max(peak), app.config["UPSTREAM_MAX_CONCURRENCY"])
+
+
+    def test_fan_out_reuses_shared_executor(self):
+        threads = set()
+        upstream.fan_out(lambda item: threads.add(threading.current_thread().name), list(range(8)))
+        upstream.fan_out(lambda item: threads.add(threading.current_thread().name), list(range(8)))
+
+        self.assertIs(upstream.get_executor(), upstream.get_executor())
+        self.assertLessEqual(len(threads), app.config["UPSTREAM_MAX_CONCURRENCY"] + 1)
+
+
+    def test_get_executor_is_rebuilt_after_fork(self):
+        executor = upstream.get_executor()
+        with mock.patch("os.getpid", return_value=-1):
+            forked_executor = upstream.get_executor()
+        self.assertIsNot(executor, forked_executor)
+
+
+    def test_nested_fan_out_does_not_deadlock_on_busy_pool(self):
+        results = []
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        def nested(item):
+            return sum(upstream.fan_out(lambda sub_item: item * sub_item, [1, 2, 3]))
+
+        with mock.patch.dict(upstream._per_process_objects, {"executor": (os.getpid(), executor)}):
+            caller = threading.Thread(target=lambda: results.append(upstream.fan_out(nested, [1, 2, 3, 4])))
+            caller.start()
+            caller.join(5)
+
+        executor.shutdown()
+        self.assertEqual(results, [[6, 12, 18, 24]])
+
+
+    def test_iter_fan_out_keeps_order(self):
+        results = upstream.iter_fan_out(lambda item: item * 2, [3, 1, 2], 2)
+        self.assertEqual(list(results), [6, 2, 4])
+
+
+    def test_iter_fan_out_without_depth_is_lazy(self):
+        called = []
+        results = upstream.iter_fan_out(called.append, [1, 2, 3], 0)
+
+        next(results)
+        self.assertEqual(called, [1])
+
+
+    def test_iter_fan_out_runs_ahead_of_consumer(self):
+        started = []
+        release = threading.Event()
+
+        def track(item):
+            started.append(item)
+            release.wait(1)
+            return item
+
+        results = upstream.iter_fan_out(track, list(range(10)), 2)
+        release.set()
+        self.assertEqual(next(results), 0)
+        time.sleep(0.05)
+        self.assertEqual(sorted(started), [0, 1, 2])
+        results.close()
+
+
+    def test_iter_fan_out_cancels_pending_calls_on_close(self):
+        started = []
+        release = threading.Event()
+
+        def track(item):
+            started.append(item)
+            release.wait(1)
+            return item
+
+        results = upstream.iter_fan_out(track, list(range(10)), 1)
+        release.set()
+        next(results)
+        results.close()
+        time.sleep(0.05)
+        self.assertLessEqual(len(started), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
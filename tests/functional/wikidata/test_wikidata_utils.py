@@ -9,7 +9,8 @@ import unittest
 import requests_mock
 
 from service import app
-from service.wikidata.wikidata import make_wd_properties_request, get_wikidata_entity_label
+from service.wikidata.wikidata import label_cache
+from service.wikidata.wikidata import make_wd_properties_request, get_wikidata_entity_label, get_wikidata_entity_labels
 from service.reconcile.processresults import get_suggest_result, build_suggest_result, build_extend_meta_info
 
 
@@ -22,6 +23,7 @@ class TestWikidata(unittest.TestCase):
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['DEBUG'] = False
         self.app = app.test_client()
+        label_cache.clear()
 
         self.test_wd_properties_data = """
         {"entities":{"P180":{"type":"property","datatype":"wikibase-item","id":"P180","labels":{"en":{"language":"en","value":"depicts"}}}},"success":1}
@@ -65,6 +67,39 @@ class TestWikidata(unittest.TestCase):
         self.assertEqual(response, json.loads(self.wd_entity_label_data_2)["entities"])
 
 
+    def test_get_wikidata_entity_labels(self):
+        wd_ids = ["Q" + str(i) for i in range(1, 121)] + ["Q1", "Q2"]
+
+        def labels_callback(request, context):
+            ids = request.qs["ids"][0].upper().split("|")
+            return {"entities": {id: {"id": id, "labels": {"en": {"language": "en", "value": "label " + id}}} for id in ids}}
+
+        with requests_mock.Mocker() as m:
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&props=labels", json=labels_callback)
+            response = get_wikidata_entity_labels(wd_ids, self.test_lang)
+
+        batch_sizes = sorted(len(request.qs["ids"][0].split("|")) for request in m.request_history)
+        self.assertEqual(batch_sizes, [20, 50, 50])
+        self.assertEqual(len(response), 120)
+        self.assertEqual(response["Q120"]["labels"]["en"]["value"], "label Q120")
+
+
+    def test_get_wikidata_entity_label_uses_label_cache(self):
+        with requests_mock.Mocker() as m:
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&ids=Q192465|Q453406&format=json&languages=en&props=labels",
+                  text=self.wd_entity_label_data_2)
+            get_wikidata_entity_label(["Q192465", "Q453406"], self.test_lang)
+            m.get("https://www.wikidata.org/w/api.php?action=wbgetentities&ids=P180&format=json",
+                  text=self.test_wd_properties_data)
+            response = get_wikidata_entity_label(["Q453406", "P180"], self.test_lang)
+
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(m.last_request.qs["ids"], ["p180"])
+        self.assertEqual(response["Q453406"]["labels"]["en"]["value"], "Stanley Clarke")
+        self.assertEqual(response["P180"]["labels"]["en"]["value"], "depicts")
+        self.assertEqual(label_cache.stats()["hits"], 1)
+
+
     def test_make_suggest_request(self):
         prefix = "depicts"
         with requests_mock.Mocker() as m: